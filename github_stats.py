@@ -4,24 +4,268 @@ GitHub Profile Statistics Automation Script
 Fetches and displays comprehensive statistics for any GitHub profile
 """
 
-import requests
 import json
+import os
 import sys
+import argparse
+from collections.abc import Sequence
 from datetime import datetime
 from collections import Counter
 import time
 
+# `requests` (and its dependency tree) is imported on first use in
+# GitHubStats._get(), so --help, offline snapshot reports and argument errors
+# never pay for it. The same goes for the modules only the snapshot code and
+# the retry loop need (mmap, struct, zlib, array, random, urllib.parse).
+
+# Binary snapshot layout: magic, little-endian u64 header length, zlib-compressed
+# JSON header, then an 8-byte aligned data section with one block per repository
+# column (raw int64/uint8 arrays for numbers and flags, zlib text for strings).
+# A last 'extra' column holds, per repository, the API fields the typed columns
+# cannot reproduce exactly (other fields, full license objects, nulls), as JSON.
+SNAPSHOT_MAGIC = b'GHSNAP1\n'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_INT_FIELDS = ('stargazers_count', 'forks_count', 'watchers_count', 'size', 'open_issues_count')
+SNAPSHOT_BOOL_FIELDS = ('private', 'fork', 'archived', 'has_issues', 'has_wiki',
+                        'has_projects', 'has_downloads')
+SNAPSHOT_STR_FIELDS = ('name', 'full_name', 'description', 'html_url', 'languages_url', 'language',
+                       'created_at', 'updated_at', 'pushed_at', 'license', 'topics')
+
+
+class RepoSnapshot(Sequence):
+    """Read-only, memory-mapped view of the repositories stored in a snapshot.
+
+    Numeric and boolean columns are used straight from the mapping; string
+    columns are decompressed the first time they are needed. The report reads
+    single columns through values(); full rows (plain dicts with every field
+    of the exported API payload) are only built when asked for, e.g. by
+    export_to_json().
+    
+    The mapping stays open until close() (or the end of a `with` block).
+    Raises OSError if the file cannot be read and ValueError if it is not a
+    valid snapshot.
+    """
+
+    def __init__(self, filename):
+        import mmap
+        import struct
+        import zlib
+        
+        self._columns = {}
+        self._views = []
+        with open(filename, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < len(SNAPSHOT_MAGIC) + 8:
+                raise ValueError(f"{filename} is not a GitHub stats snapshot (file too short)")
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        try:
+            if self._mmap[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                raise ValueError(f"{filename} is not a GitHub stats snapshot")
+            
+            start = len(SNAPSHOT_MAGIC) + 8
+            (header_length,) = struct.unpack_from('<Q', self._mmap, len(SNAPSHOT_MAGIC))
+            try:
+                header = json.loads(zlib.decompress(self._mmap[start:start + header_length]))
+            except zlib.error as e:
+                raise ValueError(f"{filename} has a corrupt snapshot header: {e}")
+            if header.get('version') != SNAPSHOT_VERSION:
+                raise ValueError(f"Unsupported snapshot version: {header.get('version')}")
+        except Exception:
+            self._mmap.close()
+            raise
+        
+        self.header = header
+        self._data_start = start + header_length + (-(start + header_length) % 8)
+    
+    def close(self):
+        """Release the column views and unmap the file."""
+        self._columns = {}
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self._mmap.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+    
+    def to_list(self):
+        """All rows as a list of plain dicts (e.g. for json.dump)."""
+        return list(self)
+    
+    def __len__(self):
+        return self.header['repo_count']
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('snapshot index out of range')
+        return self._row(index)
+    
+    def __iter__(self):
+        columns = self._loaded_columns()
+        for i in range(len(self)):
+            yield self._build_row(columns, i)
+    
+    def column(self, field):
+        """Return a single column as a sequence, loading it on first use."""
+        if field not in self._columns:
+            kind, offset, length = self.header['columns'][field]
+            offset += self._data_start
+            block = memoryview(self._mmap)[offset:offset + length]
+            self._views.append(block)
+            
+            if kind == 'int':
+                if sys.byteorder == 'little':
+                    values = block.cast('q')
+                    self._views.append(values)
+                else:
+                    from array import array
+                    values = array('q', bytes(block))
+                    values.byteswap()
+            elif kind == 'bool':
+                values = block
+            else:
+                # 'str' and 'json' columns
+                import zlib
+                text = zlib.decompress(block).decode('utf-8')
+                values = text.split('\x00') if len(self) else []
+            
+            self._columns[field] = values
+        return self._columns[field]
+    
+    def values(self, field):
+        """A column decoded like the rows (topics as lists, empty text as None), without building rows."""
+        values = self.column(field)
+        if self.header['columns'][field][0] != 'str':
+            return values
+        if field == 'topics':
+            return [value.split(',') if value else [] for value in values]
+        # The license column holds the license name
+        return [value or None for value in values]
+    
+    def _loaded_columns(self):
+        return [(field, spec[0], self.column(field))
+                for field, spec in self.header['columns'].items()]
+    
+    def _row(self, index):
+        return self._build_row(self._loaded_columns(), index)
+    
+    def _build_row(self, columns, index):
+        row = {}
+        for field, kind, values in columns:
+            if kind == 'json':
+                # Exact values for whatever the typed columns could not hold
+                if values[index]:
+                    row.update(json.loads(values[index]))
+            else:
+                row[field] = _decode_snapshot_value(field, kind, values[index])
+        return row
+
+
+def _encode_snapshot_value(field, kind, value):
+    """How a repository field is stored in its typed snapshot column."""
+    if kind == 'int':
+        return int(value or 0)
+    if kind == 'bool':
+        return 1 if value else 0
+    if field == 'license':
+        value = value.get('name', 'Unknown') if value else ''
+    elif field == 'topics':
+        value = ','.join(value or [])
+    return str(value or '').replace('\x00', '')
+
+
+def _decode_snapshot_value(field, kind, stored):
+    """The field value a row gets back from its typed snapshot column."""
+    if kind == 'bool':
+        return bool(stored)
+    if kind == 'str':
+        if field == 'topics':
+            return stored.split(',') if stored else []
+        if field == 'license':
+            return {'name': stored} if stored else None
+        return stored or None
+    return stored
+
+
+class GitHubAPIError(Exception):
+    """A GitHub API request that failed for good (after any retries)."""
+
+    def __init__(self, message, kind, status=None):
+        super().__init__(message)
+        self.kind = kind
+        self.status = status
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker.
+    
+    After `failure_threshold` consecutive transient failures the circuit opens
+    and calls fail fast for `reset_timeout` seconds. After that the circuit is
+    half-open: exactly one call at a time is let through as a trial. Success
+    closes the circuit, failure re-opens it, and release() hands the trial to
+    the next caller when the call said nothing about the host's health.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+    
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        if self.trial_in_flight or time.monotonic() - self.opened_at < self.reset_timeout:
+            return False
+        self.trial_in_flight = True
+        return True
+    
+    def release(self):
+        """End a call without changing the circuit (e.g. a permanent 4xx)."""
+        self.trial_in_flight = False
+    
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self.trial_in_flight = False
+
+
 class GitHubStats:
-    def __init__(self, username, token=None):
+    # Retry settings for transient API failures (timeouts, 5xx, rate limiting)
+    max_attempts = 5
+    backoff_base = 1.0
+    backoff_cap = 30.0
+    max_rate_limit_wait = 90.0
+    transient_statuses = (500, 502, 503, 504)
+    
+    def __init__(self, username, token=None, session=None):
         """
         Initialize GitHub Stats fetcher
         
         Args:
             username (str): GitHub username
             token (str, optional): GitHub Personal Access Token for higher rate limits
+            session (requests.Session, optional): Shared session, so a long-running
+                worker reuses connections across users
         """
         self.username = username
         self.token = token
+        self.session = session
         self.base_url = "https://api.github.com"
         self.headers = {
             'Accept': 'application/vnd.github.v3+json',
@@ -36,6 +280,107 @@ class GitHubStats:
         self.total_forks = 0
         self.total_watchers = 0
         self.total_size = 0
+        
+        self.breakers = {}
+        self.retry_stats = Counter()
+        self.failed_requests = []
+    
+    def _classify_response(self, response):
+        """Classify a non-2xx response as 'transient', 'rate_limited' or 'permanent'"""
+        if response.status_code in self.transient_statuses:
+            return 'transient'
+        if response.status_code == 429:
+            return 'rate_limited'
+        # Primary (remaining quota is 0) and secondary (Retry-After) rate limits
+        if response.status_code == 403 and (response.headers.get('X-RateLimit-Remaining') == '0'
+                                            or 'Retry-After' in response.headers):
+            return 'rate_limited'
+        return 'permanent'
+    
+    def _rate_limit_wait(self, response):
+        """Seconds the API asked us to wait, from Retry-After or X-RateLimit-Reset"""
+        retry_after = response.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        reset = response.headers.get('X-RateLimit-Reset')
+        if reset and reset.isdigit():
+            return max(0.0, int(reset) - time.time())
+        return None
+    
+    def _get(self, url, what, params=None):
+        """
+        GET an API URL with classified retries.
+        
+        Transient errors (timeouts, connection errors, 5xx) are retried with
+        full-jitter exponential backoff; rate limiting waits for the time the
+        API asks for when that is reasonably short (429, or 403 with
+        Retry-After or an exhausted quota). Permanent errors (other 4xx) are
+        not retried and leave the circuit breaker alone. Repeated transient failures open the circuit for
+        the host so the remaining calls fail fast instead of piling up.
+        
+        Args:
+            url (str): URL to fetch
+            what (str): Short description used in the retry summary
+            params (dict, optional): Query parameters
+        
+        Returns:
+            The successful response
+        
+        Raises:
+            GitHubAPIError: when the request failed for good
+        """
+        import random
+        import requests
+        from urllib.parse import urlsplit
+        
+        host = urlsplit(url).netloc
+        http = self.session or requests
+        breaker = self.breakers.setdefault(host, CircuitBreaker())
+        
+        for attempt in range(1, self.max_attempts + 1):
+            if not breaker.allow():
+                self.retry_stats['circuit_open'] += 1
+                self.failed_requests.append((what, f'circuit open for {host}'))
+                raise GitHubAPIError(f"Circuit open for {host}", 'circuit_open')
+            
+            wait = None
+            try:
+                response = http.get(url, headers=self.headers, params=params, timeout=10)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                kind, status, message = 'transient', None, str(e)
+            except requests.exceptions.RequestException as e:
+                kind, status, message = 'permanent', None, str(e)
+            else:
+                if response.ok:
+                    breaker.record_success()
+                    return response
+                kind, status = self._classify_response(response), response.status_code
+                message = f"HTTP {status} for {url}"
+                if kind == 'rate_limited':
+                    wait = self._rate_limit_wait(response)
+            
+            if kind == 'transient':
+                breaker.record_failure()
+            else:
+                # Neither proof that the host is healthy nor that it is failing
+                breaker.release()
+            
+            if kind == 'permanent':
+                self.retry_stats['permanent'] += 1
+                self.failed_requests.append((what, message))
+                raise GitHubAPIError(message, kind, status)
+            
+            if attempt == self.max_attempts or (wait is not None and wait > self.max_rate_limit_wait):
+                self.retry_stats['gave_up'] += 1
+                self.failed_requests.append((what, message))
+                raise GitHubAPIError(message, kind, status)
+            
+            delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** (attempt - 1)))
+            if wait is not None:
+                delay = max(delay, wait)
+            self.retry_stats[kind] += 1
+            print(f"   ⏳ {what}: {message} - retrying in {delay:.1f}s (attempt {attempt + 1}/{self.max_attempts})")
+            time.sleep(delay)
     
     def fetch_user_profile(self):
         """Fetch basic user profile information"""
@@ -43,12 +388,11 @@ class GitHubStats:
         
         url = f"{self.base_url}/users/{self.username}"
         try:
-            response = requests.get(url, headers=self.headers, timeout=10)
-            response.raise_for_status()
+            response = self._get(url, 'user profile')
             self.user_data = response.json()
             print("✅ Profile data fetched successfully")
             return True
-        except requests.exceptions.RequestException as e:
+        except GitHubAPIError as e:
             print(f"❌ Error fetching user profile: {e}")
             return False
     
@@ -69,8 +413,7 @@ class GitHubStats:
             }
             
             try:
-                response = requests.get(url, headers=self.headers, params=params, timeout=10)
-                response.raise_for_status()
+                response = self._get(url, f'repositories page {page}', params=params)
                 repos = response.json()
                 
                 if not repos:
@@ -83,8 +426,9 @@ class GitHubStats:
                 # Respect rate limits
                 time.sleep(0.5)
                 
-            except requests.exceptions.RequestException as e:
+            except GitHubAPIError as e:
                 print(f"❌ Error fetching repositories: {e}")
+                print(f"⚠️  Repository list is incomplete (stopped at page {page})")
                 break
         
         print(f"✅ Total repositories fetched: {len(self.repos_data)}")
@@ -100,8 +444,7 @@ class GitHubStats:
             
             url = repo['languages_url']
             try:
-                response = requests.get(url, headers=self.headers, timeout=10)
-                response.raise_for_status()
+                response = self._get(url, f"languages for {repo['name']}")
                 languages = response.json()
                 
                 for lang, bytes_count in languages.items():
@@ -110,20 +453,36 @@ class GitHubStats:
                 # Respect rate limits
                 time.sleep(0.3)
                 
-            except requests.exceptions.RequestException:
+            except GitHubAPIError:
                 continue
         
-        print(f"✅ Language analysis complete")
+        skipped = sum(1 for what, _ in self.failed_requests if what.startswith('languages for '))
+        if skipped:
+            print(f"⚠️  Language analysis incomplete: {skipped} repositories skipped")
+        else:
+            print(f"✅ Language analysis complete")
+    
+    def _column(self, field, default=None):
+        """One repository field for every repository, license reduced to its name.
+
+        Snapshots hand out their stored column, so the report never builds
+        whole rows for them.
+        """
+        if isinstance(self.repos_data, RepoSnapshot):
+            return self.repos_data.values(field)
+        if field == 'license':
+            return [repo['license'].get('name', 'Unknown') if repo.get('license') else None
+                    for repo in self.repos_data]
+        return [repo.get(field, default) for repo in self.repos_data]
     
     def calculate_statistics(self):
         """Calculate various statistics from repository data"""
         print(f"📊 Calculating statistics...")
         
-        for repo in self.repos_data:
-            self.total_stars += repo.get('stargazers_count', 0)
-            self.total_forks += repo.get('forks_count', 0)
-            self.total_watchers += repo.get('watchers_count', 0)
-            self.total_size += repo.get('size', 0)
+        self.total_stars += sum(self._column('stargazers_count', 0))
+        self.total_forks += sum(self._column('forks_count', 0))
+        self.total_watchers += sum(self._column('watchers_count', 0))
+        self.total_size += sum(self._column('size', 0))
         
         print(f"✅ Statistics calculated")
     
@@ -177,10 +536,10 @@ class GitHubStats:
         print(f"   Total Size: {self.total_size / 1024:.2f} MB")
         
         # Repository types
-        public_repos = sum(1 for repo in self.repos_data if not repo.get('private', False))
-        forked_repos = sum(1 for repo in self.repos_data if repo.get('fork', False))
+        public_repos = sum(1 for private in self._column('private', False) if not private)
+        forked_repos = sum(1 for fork in self._column('fork', False) if fork)
         original_repos = len(self.repos_data) - forked_repos
-        archived_repos = sum(1 for repo in self.repos_data if repo.get('archived', False))
+        archived_repos = sum(1 for archived in self._column('archived', False) if archived)
         
         print(f"\n📂 Repository Types:")
         print(f"   Public: {public_repos:,}")
@@ -188,34 +547,37 @@ class GitHubStats:
         print(f"   Forked: {forked_repos:,}")
         print(f"   Archived: {archived_repos:,}")
         
+        names = self._column('name')
+        
         # Top repositories by stars
-        top_starred = sorted(self.repos_data, key=lambda x: x.get('stargazers_count', 0), reverse=True)[:10]
+        stars = self._column('stargazers_count', 0)
+        top_starred = sorted(range(len(stars)), key=stars.__getitem__, reverse=True)[:10]
         
-        if top_starred and top_starred[0].get('stargazers_count', 0) > 0:
+        if top_starred and stars[top_starred[0]] > 0:
             print(f"\n⭐ Top 10 Most Starred Repositories:")
-            for i, repo in enumerate(top_starred, 1):
-                stars = repo.get('stargazers_count', 0)
-                if stars > 0:
-                    print(f"   {i:2d}. {repo['name']:<30} ⭐ {stars:,}")
+            for i, index in enumerate(top_starred, 1):
+                if stars[index] > 0:
+                    print(f"   {i:2d}. {names[index]:<30} ⭐ {stars[index]:,}")
         
         # Most forked repositories
-        top_forked = sorted(self.repos_data, key=lambda x: x.get('forks_count', 0), reverse=True)[:5]
+        forks = self._column('forks_count', 0)
+        top_forked = sorted(range(len(forks)), key=forks.__getitem__, reverse=True)[:5]
         
-        if top_forked and top_forked[0].get('forks_count', 0) > 0:
+        if top_forked and forks[top_forked[0]] > 0:
             print(f"\n🍴 Top 5 Most Forked Repositories:")
-            for i, repo in enumerate(top_forked, 1):
-                forks = repo.get('forks_count', 0)
-                if forks > 0:
-                    print(f"   {i}. {repo['name']:<30} 🍴 {forks:,}")
+            for i, index in enumerate(top_forked, 1):
+                if forks[index] > 0:
+                    print(f"   {i}. {names[index]:<30} 🍴 {forks[index]:,}")
         
         # Recently updated repositories
-        recent_repos = sorted(self.repos_data, key=lambda x: x.get('updated_at', ''), reverse=True)[:5]
+        updated_at = [updated or '' for updated in self._column('updated_at', '')]
+        recent_repos = sorted(range(len(updated_at)), key=updated_at.__getitem__, reverse=True)[:5]
         
         print(f"\n🔄 Recently Updated Repositories:")
-        for i, repo in enumerate(recent_repos, 1):
-            updated = datetime.strptime(repo['updated_at'], '%Y-%m-%dT%H:%M:%SZ')
+        for i, index in enumerate(recent_repos, 1):
+            updated = datetime.strptime(updated_at[index], '%Y-%m-%dT%H:%M:%SZ')
             days_ago = (datetime.now() - updated).days
-            print(f"   {i}. {repo['name']:<30} ({days_ago} days ago)")
+            print(f"   {i}. {names[index]:<30} ({days_ago} days ago)")
     
     def display_language_stats(self):
         """Display programming language statistics"""
@@ -251,13 +613,7 @@ class GitHubStats:
             return
         
         # License analysis
-        licenses = Counter()
-        for repo in self.repos_data:
-            license_info = repo.get('license')
-            if license_info:
-                licenses[license_info.get('name', 'Unknown')] += 1
-            else:
-                licenses['No License'] += 1
+        licenses = Counter(license_name or 'No License' for license_name in self._column('license'))
         
         print(f"\n📜 License Distribution:")
         for license_name, count in licenses.most_common(10):
@@ -265,8 +621,7 @@ class GitHubStats:
         
         # Topics analysis
         all_topics = []
-        for repo in self.repos_data:
-            topics = repo.get('topics', [])
+        for topics in self._column('topics', []):
             all_topics.extend(topics)
         
         if all_topics:
@@ -276,10 +631,10 @@ class GitHubStats:
                 print(f"   {i:2d}. {topic:<30} {count:,} repos")
         
         # Has issues/wiki/projects enabled
-        has_issues = sum(1 for repo in self.repos_data if repo.get('has_issues', False))
-        has_wiki = sum(1 for repo in self.repos_data if repo.get('has_wiki', False))
-        has_projects = sum(1 for repo in self.repos_data if repo.get('has_projects', False))
-        has_downloads = sum(1 for repo in self.repos_data if repo.get('has_downloads', False))
+        has_issues = sum(1 for enabled in self._column('has_issues', False) if enabled)
+        has_wiki = sum(1 for enabled in self._column('has_wiki', False) if enabled)
+        has_projects = sum(1 for enabled in self._column('has_projects', False) if enabled)
+        has_downloads = sum(1 for enabled in self._column('has_downloads', False) if enabled)
         
         print(f"\n⚙️  Repository Features:")
         print(f"   Issues Enabled: {has_issues:,} repos")
@@ -291,8 +646,7 @@ class GitHubStats:
         """Check GitHub API rate limit"""
         url = f"{self.base_url}/rate_limit"
         try:
-            response = requests.get(url, headers=self.headers, timeout=10)
-            response.raise_for_status()
+            response = self._get(url, 'rate limit')
             data = response.json()
             
             core = data['resources']['core']
@@ -306,9 +660,31 @@ class GitHubStats:
             
             if remaining < 10:
                 print(f"   ⚠️  Warning: Low rate limit remaining!")
-        except requests.exceptions.RequestException as e:
+        except GitHubAPIError as e:
             print(f"❌ Error checking rate limit: {e}")
     
+    def display_retry_summary(self):
+        """Display what was retried or given up during the analysis"""
+        if not self.retry_stats:
+            return
+        
+        print("\n" + "=" * 70)
+        print("🔁 API RETRY SUMMARY")
+        print("=" * 70)
+        
+        print(f"\n   Transient errors retried: {self.retry_stats['transient']:,}")
+        print(f"   Rate limit waits: {self.retry_stats['rate_limited']:,}")
+        print(f"   Requests given up: {self.retry_stats['gave_up']:,}")
+        print(f"   Permanent errors: {self.retry_stats['permanent']:,}")
+        print(f"   Skipped (circuit open): {self.retry_stats['circuit_open']:,}")
+        
+        if self.failed_requests:
+            print(f"\n⚠️  Failed requests (statistics may be incomplete):")
+            for what, reason in self.failed_requests[:20]:
+                print(f"   - {what}: {reason}")
+            if len(self.failed_requests) > 20:
+                print(f"   ... and {len(self.failed_requests) - 20} more")
+    
     def export_to_json(self, filename=None):
         """Export all statistics to JSON file"""
         if filename is None:
@@ -326,19 +702,166 @@ class GitHubStats:
                 'total_size_kb': self.total_size,
             },
             'languages': dict(self.languages),
-            'repositories': self.repos_data
+            'repositories': list(self.repos_data),
+            'retry_summary': {
+                'counts': dict(self.retry_stats),
+                'failed_requests': [{'request': what, 'reason': reason}
+                                    for what, reason in self.failed_requests],
+            }
         }
         
         try:
+            # Serialize first, so a failure never leaves a half-written file
+            text = json.dumps(export_data, indent=2, ensure_ascii=False)
             with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(export_data, f, indent=2, ensure_ascii=False)
+                f.write(text)
             print(f"\n💾 Statistics exported to: {filename}")
             return True
         except Exception as e:
             print(f"❌ Error exporting to JSON: {e}")
             return False
     
-    def run_full_analysis(self, export_json=False):
+    def export_snapshot(self, filename=None):
+        """Export statistics to a compact, memory-mappable binary snapshot"""
+        import struct
+        import zlib
+        from array import array
+        
+        if filename is None:
+            filename = f"{self.username}_github_stats_{datetime.now().strftime('%Y%m%d_%H%M%S')}.ghsnap"
+        
+        typed = ([(field, 'int') for field in SNAPSHOT_INT_FIELDS] +
+                 [(field, 'bool') for field in SNAPSHOT_BOOL_FIELDS] +
+                 [(field, 'str') for field in SNAPSHOT_STR_FIELDS])
+        columns = {field: [] for field, _ in typed}
+        extras = []
+        for repo in self.repos_data:
+            extra = {key: value for key, value in repo.items() if key not in columns}
+            for field, kind in typed:
+                value = repo.get(field)
+                stored = _encode_snapshot_value(field, kind, value)
+                columns[field].append(stored)
+                decoded = _decode_snapshot_value(field, kind, stored)
+                if field in repo and (decoded != value or type(decoded) is not type(value)):
+                    extra[field] = value
+            extras.append(json.dumps(extra, ensure_ascii=False, separators=(',', ':')) if extra else '')
+        
+        blocks = []
+        for field, kind in typed:
+            if kind == 'int':
+                values = array('q', columns[field])
+                if sys.byteorder != 'little':
+                    values.byteswap()
+                data = values.tobytes()
+            elif kind == 'bool':
+                data = bytes(columns[field])
+            else:
+                data = zlib.compress('\x00'.join(columns[field]).encode('utf-8'), 6)
+            blocks.append((field, kind, data))
+        # JSON escapes control characters, so NUL still separates the rows
+        blocks.append(('extra', 'json', zlib.compress('\x00'.join(extras).encode('utf-8'), 6)))
+        
+        header = {
+            'version': SNAPSHOT_VERSION,
+            'username': self.username,
+            'generated_at': datetime.now().isoformat(),
+            'profile': self.user_data,
+            'statistics': {
+                'total_repos': len(self.repos_data),
+                'total_stars': self.total_stars,
+                'total_forks': self.total_forks,
+                'total_watchers': self.total_watchers,
+                'total_size_kb': self.total_size,
+            },
+            'languages': dict(self.languages),
+            'repo_count': len(self.repos_data),
+            'columns': {},
+        }
+        
+        # Column offsets are relative to the 8-byte aligned data section
+        # that follows the header.
+        offset = 0
+        for field, kind, data in blocks:
+            offset += -offset % 8
+            header['columns'][field] = [kind, offset, len(data)]
+            offset += len(data)
+        encoded_header = zlib.compress(json.dumps(header, ensure_ascii=False).encode('utf-8'), 6)
+        
+        try:
+            with open(filename, 'wb') as f:
+                f.write(SNAPSHOT_MAGIC)
+                f.write(struct.pack('<Q', len(encoded_header)))
+                f.write(encoded_header)
+                data_start = f.tell() + (-f.tell() % 8)
+                for field, kind, data in blocks:
+                    f.write(b'\x00' * (data_start + header['columns'][field][1] - f.tell()))
+                    f.write(data)
+            print(f"\n💾 Snapshot exported to: {filename}")
+            return True
+        except Exception as e:
+            print(f"❌ Error exporting snapshot: {e}")
+            return False
+    
+    @classmethod
+    def from_snapshot(cls, filename):
+        """
+        Create a GitHubStats instance from a binary snapshot
+        
+        Nothing is fetched from the API; the repository list is a lazy,
+        memory-mapped RepoSnapshot, so all display_* methods can run offline.
+        Call close() when done with it.
+        
+        Args:
+            filename (str): Path to a file written by export_snapshot()
+        
+        Raises:
+            OSError: The file cannot be read
+            ValueError: The file is not a valid snapshot
+        """
+        snapshot = RepoSnapshot(filename)
+        header = snapshot.header
+        statistics = header['statistics']
+        
+        stats = cls(header['username'])
+        stats.user_data = header['profile']
+        stats.repos_data = snapshot
+        stats.languages = Counter(header['languages'])
+        stats.total_stars = statistics['total_stars']
+        stats.total_forks = statistics['total_forks']
+        stats.total_watchers = statistics['total_watchers']
+        stats.total_size = statistics['total_size_kb']
+        return stats
+    
+    def close(self):
+        """Unmap the repository list of an instance loaded by from_snapshot()."""
+        if isinstance(self.repos_data, RepoSnapshot):
+            self.repos_data.close()
+    
+    @classmethod
+    def from_json_export(cls, filename):
+        """Create a GitHubStats instance from a file written by export_to_json()"""
+        with open(filename, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        
+        statistics = data.get('statistics', {})
+        stats = cls(data['username'])
+        stats.user_data = data.get('profile')
+        stats.repos_data = data.get('repositories', [])
+        stats.languages = Counter(data.get('languages', {}))
+        stats.total_stars = statistics.get('total_stars', 0)
+        stats.total_forks = statistics.get('total_forks', 0)
+        stats.total_watchers = statistics.get('total_watchers', 0)
+        stats.total_size = statistics.get('total_size_kb', 0)
+        return stats
+    
+    def display_all(self):
+        """Display every statistics section"""
+        self.display_profile_info()
+        self.display_repository_stats()
+        self.display_language_stats()
+        self.display_contribution_insights()
+    
+    def run_full_analysis(self, export_json=False, export_snapshot=False):
         """Run complete analysis and display all statistics"""
         print("\n" + "=" * 70)
         print("🚀 GITHUB PROFILE STATISTICS ANALYZER")
@@ -362,17 +885,17 @@ class GitHubStats:
             self.calculate_statistics()
         
         # Display all statistics
-        self.display_profile_info()
-        self.display_repository_stats()
-        self.display_language_stats()
-        self.display_contribution_insights()
+        self.display_all()
         
         # Check rate limit after analysis
         self.check_rate_limit()
+        self.display_retry_summary()
         
         # Export if requested
         if export_json:
             self.export_to_json()
+        if export_snapshot:
+            self.export_snapshot()
         
         print("\n" + "=" * 70)
         print("✅ Analysis Complete!")
@@ -381,15 +904,98 @@ class GitHubStats:
         return True
 
 
-def main():
+def build_parser():
+    """Build the command line parser"""
+    parser = argparse.ArgumentParser(
+        description='Fetch and display statistics for a GitHub profile',
+        epilog='The token can also be provided through the GITHUB_TOKEN environment variable.')
+    parser.add_argument('username', nargs='?', help='GitHub username')
+    parser.add_argument('token', nargs='?', help='GitHub Personal Access Token')
+    parser.add_argument('-e', '--export', action='store_true', help='Export statistics to JSON')
+    parser.add_argument('-s', '--snapshot', action='store_true', help='Export statistics to a binary snapshot')
+    parser.add_argument('--from-snapshot', metavar='FILE', help='Display the report stored in a snapshot (offline)')
+    parser.add_argument('--json-to-snapshot', metavar='FILE', help='Convert a JSON export into a snapshot')
+    parser.add_argument('-o', '--output', help='Output file for --json-to-snapshot')
+    parser.add_argument('--serve', action='store_true',
+                        help='Worker mode: read one "username [--export] [--snapshot]" per line from stdin')
+    return parser
+
+
+def serve(token=None, export_json=False, export_snapshot=False, stream=None):
+    """
+    Persistent worker: analyze one user per input line without restarting Python.
+    
+    Each line holds a username optionally followed by --export/--snapshot.
+    A single HTTP session is shared by all users so connections are reused.
+    After every user a "### <username> OK|FAILED" line is printed so the
+    caller can tell where one report ends.
+    """
+    import requests
+    
+    session = requests.Session()
+    stream = stream or sys.stdin
+    
+    for line in stream:
+        parts = line.split()
+        if not parts or parts[0].startswith('#'):
+            continue
+        
+        username, flags = parts[0], parts[1:]
+        analyzer = GitHubStats(username, token, session=session)
+        try:
+            success = analyzer.run_full_analysis(
+                export_json=export_json or '--export' in flags or '-e' in flags,
+                export_snapshot=export_snapshot or '--snapshot' in flags or '-s' in flags)
+        except Exception as e:
+            print(f"❌ Unexpected error analyzing @{username}: {e}")
+            success = False
+        
+        print(f"### {username} {'OK' if success else 'FAILED'}", flush=True)
+
+
+def main(argv=None):
     """Main execution function"""
+    argv = sys.argv[1:] if argv is None else argv
+    # Older invocations passed a bare "export" as the third argument
+    if len(argv) > 2 and argv[2].lower() == 'export':
+        argv = argv[:2] + ['--export'] + argv[3:]
+    args = build_parser().parse_args(argv)
+    
     print("🚀 GitHub Profile Statistics Automation Script")
     print("=" * 70)
     
+    # Offline modes: render a snapshot, or convert a JSON export into one
+    if args.from_snapshot:
+        try:
+            analyzer = GitHubStats.from_snapshot(args.from_snapshot)
+        except (OSError, ValueError) as e:
+            print(f"❌ Error reading snapshot: {e}")
+            sys.exit(1)
+        try:
+            analyzer.display_all()
+        finally:
+            analyzer.close()
+        return
+    
+    if args.json_to_snapshot:
+        try:
+            analyzer = GitHubStats.from_json_export(args.json_to_snapshot)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"❌ Error reading JSON export: {e}")
+            sys.exit(1)
+        if not analyzer.export_snapshot(args.output):
+            sys.exit(1)
+        return
+    
+    token = args.token or os.environ.get('GITHUB_TOKEN')
+    
+    if args.serve:
+        serve(token, export_json=args.export, export_snapshot=args.snapshot)
+        return
+    
     # Get username from command line or prompt
-    if len(sys.argv) > 1:
-        username = sys.argv[1]
-    else:
+    username = args.username
+    if not username and sys.stdin.isatty():
         username = input("Enter GitHub username: ").strip()
     
     if not username:
@@ -397,30 +1003,23 @@ def main():
         sys.exit(1)
     
     # Optional: Get GitHub token for higher rate limits
-    token = None
-    if len(sys.argv) > 2:
-        token = sys.argv[2]
-    else:
+    if not args.token:
         print("\n💡 Tip: Provide a GitHub Personal Access Token for higher rate limits")
         print("   Usage: python github_stats.py <username> <token>")
         print("   Or set GITHUB_TOKEN environment variable")
         
-        import os
-        token = os.environ.get('GITHUB_TOKEN')
         if token:
             print("   ✅ Using token from GITHUB_TOKEN environment variable")
     
-    # Ask about JSON export
-    export_json = False
-    if len(sys.argv) > 3 and sys.argv[3].lower() in ['--export', '-e', 'export']:
-        export_json = True
-    else:
+    # Ask about JSON export (only when someone is there to answer)
+    export_json = args.export
+    if not (args.export or args.snapshot) and sys.stdin.isatty():
         response = input("\nExport statistics to JSON? (y/n): ").strip().lower()
         export_json = response in ['y', 'yes']
     
     # Create analyzer and run
     analyzer = GitHubStats(username, token)
-    success = analyzer.run_full_analysis(export_json=export_json)
+    success = analyzer.run_full_analysis(export_json=export_json, export_snapshot=args.snapshot)
     
     if not success:
         sys.exit(1)
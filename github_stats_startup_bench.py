@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+GitHub Stats Startup Benchmark
+Measures how long github_stats.py takes to start for short-lived invocations
+and checks that heavy dependencies are not imported up front.
+
+Usage:
+    python github_stats_startup_bench.py [--runs 20] [--max-ms 60] [--json]
+
+Exits non-zero when the --help overhead exceeds --max-ms (60 ms by default)
+or when github_stats imports a heavy module the bare interpreter had not
+already loaded.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_PATH = os.path.join(SCRIPT_DIR, 'github_stats.py')
+
+# Modules that must only be loaded once an API call is actually made
+HEAVY_MODULES = ['requests', 'urllib3', 'charset_normalizer', 'idna', 'certifi']
+
+# Default budget for --help startup on top of a bare interpreter
+DEFAULT_MAX_MS = 60.0
+
+
+def time_command(command, runs):
+    """Run a command `runs` times and return the wall times in milliseconds."""
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=SCRIPT_DIR)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def summarize(timings):
+    """Reduce a list of timings to min/median/p95."""
+    ordered = sorted(timings)
+    return {
+        'min_ms': round(ordered[0], 2),
+        'median_ms': round(statistics.median(ordered), 2),
+        'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 2),
+    }
+
+
+def heavy_modules_loaded():
+    """Import github_stats in a fresh interpreter and list heavy modules it pulled in.
+
+    Modules the interpreter already loaded before the import (e.g. certifi
+    from a site-packages .pth file) are not counted.
+    """
+    probe = (
+        "import sys; before = set(sys.modules); import json, github_stats; "
+        f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules and m not in before]))"
+    )
+    result = subprocess.run([sys.executable, '-c', probe], capture_output=True, text=True, cwd=SCRIPT_DIR)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip())
+    return json.loads(result.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark github_stats.py startup time')
+    parser.add_argument('--runs', type=int, default=20, help='Number of runs per measurement')
+    parser.add_argument('--max-ms', type=float, default=DEFAULT_MAX_MS,
+                        help='Fail if median --help time exceeds bare interpreter startup by more than '
+                             f'this (default: {DEFAULT_MAX_MS:.0f})')
+    parser.add_argument('--json', action='store_true', help='Print machine-readable results')
+    args = parser.parse_args()
+
+    baseline = summarize(time_command([sys.executable, '-c', 'pass'], args.runs))
+    help_run = summarize(time_command([sys.executable, SCRIPT_PATH, '--help'], args.runs))
+    import_run = summarize(time_command([sys.executable, '-c', 'import github_stats'], args.runs))
+    loaded = heavy_modules_loaded()
+
+    overhead = round(help_run['median_ms'] - baseline['median_ms'], 2)
+    results = {
+        'python': sys.version.split()[0],
+        'runs': args.runs,
+        'interpreter': baseline,
+        'import': import_run,
+        'help': help_run,
+        'help_overhead_ms': overhead,
+        'max_ms': args.max_ms,
+        'heavy_modules_at_import': loaded,
+    }
+
+    failed = bool(loaded) or overhead > args.max_ms
+    results['ok'] = not failed
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print("⏱️  GitHub Stats Startup Benchmark")
+        print("=" * 60)
+        print(f"Runs per measurement: {args.runs}")
+        print(f"Bare interpreter:     {baseline['median_ms']:.1f} ms (median)")
+        print(f"import github_stats:  {import_run['median_ms']:.1f} ms (median)")
+        print(f"github_stats --help:  {help_run['median_ms']:.1f} ms (median), "
+              f"{help_run['p95_ms']:.1f} ms (p95)")
+        print(f"Overhead vs Python:   {overhead:.1f} ms")
+        if loaded:
+            print(f"❌ Heavy modules imported at startup: {', '.join(loaded)}")
+        else:
+            print("✅ No heavy modules imported at startup")
+        status = '✅' if overhead <= args.max_ms else '❌'
+        print(f"{status} Budget: {args.max_ms:.1f} ms")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,15 +12,738 @@ import json
 import xml.etree.ElementTree as ET
 import os
 import sys
+import io
 import argparse
+import threading
+import queue
+import asyncio
+from collections import Counter
+from contextlib import AsyncExitStack, ExitStack, nullcontext
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 import socket
 import ipaddress
+import struct
+import gzip
+import zlib
+import time
+import hashlib
+
+# The data model, storage, streaming and sweep/sharding code live in their
+# own modules; their public names are re-exported here
+from nmap_scanner_results import (HostRecord, NmapRun, NmapXMLParser, OSMatch, PortRecord, ScanResults,
+                                  StageInfo, iter_nmap_xml, read_result_stream, target_args)
+from nmap_scanner_storage import (DNSCache, ResultIndex, ScanCache, ScanStateDB, parse_query, print_matches,
+                                  version_key)
+from nmap_scanner_stream import LiveHostWriter, ResultStreamWriter, load_checkpoint
+from nmap_scanner_sweep import (SWEEP_PORTS, AddressBlock, ShardQueue, TCPSweep, expand_targets, load_targets,
+                                merge_scan_results, run_sharded_scan, scan_shard, shard_targets)
+
+
+class _RawCapture:
+    """Compresses raw nmap output while it streams, for --keep-raw."""
+    __slots__ = ('_compressor', '_parts')
+
+    def __init__(self):
+        self._compressor = zlib.compressobj(6)
+        self._parts = []
+
+    def append(self, chunk):
+        self._parts.append(self._compressor.compress(chunk))
+
+    def getvalue(self):
+        return b''.join(self._parts) + self._compressor.copy().flush()
+
+
+# Port selection and timing for each --scan-type
+SCAN_CONFIGS = {
+    'quick': ['-T4', '--top-ports', '1000'],
+    'common': ['-T4', '--top-ports', '2000'],
+    'comprehensive': ['-T4', '-p-'],
+    'stealth': ['-sS', '-T2', '--top-ports', '1000'],
+    'udp': ['-sU', '--top-ports', '100']
+}
+
+# Python-side timeouts (seconds) for each stage's nmap run
+STAGE_TIMEOUTS = {
+    'host_discovery': 300,
+    'port_scan': 600,
+    'service_detection': 600,
+    'os_detection': 300,
+    'vulnerability_scan': 900,
+}
+
+
+def port_list_args(ports):
+    """
+    Build nmap arguments that restrict a scan to the given PortRecords.
+    
+    TCP and UDP ports are written as T:/U: lists; -sU is added when UDP
+    ports are present so nmap actually probes them.
+    """
+    tcp = sorted({port.port for port in ports if port.protocol == 'tcp'})
+    udp = sorted({port.port for port in ports if port.protocol == 'udp'})
+    spec = []
+    if tcp:
+        spec.append('T:' + ','.join(map(str, tcp)))
+    if udp:
+        spec.append('U:' + ','.join(map(str, udp)))
+    args = ['-p', ','.join(spec)]
+    if udp:
+        args.insert(0, '-sU')
+        if tcp:
+            # -sU alone would skip the TCP ports; pick the default TCP scan too
+            args.insert(0, '-sS' if os.geteuid() == 0 else '-sT')
+    return args
+
+
+def _is_range(target):
+    """Whether a target string covers more than one address."""
+    return isinstance(target, str) and not _is_single_target(target)
+
+
+def _is_single_target(target):
+    """Whether a target names one host (an address or hostname, not a range or list)."""
+    if not isinstance(target, str) or any(char in target for char in '/, *'):
+        return False
+    # 10.0.0.1-20 is an nmap range; web-01.example.com is a hostname
+    return not ('-' in target and all(char in '0123456789.-' for char in target))
+
+
+class HostTiming:
+    """Round-trip time (seconds) and probe loss measured for a host or subnet."""
+    __slots__ = ('srtt', 'rttvar', 'loss', 'source')
+
+    def __init__(self, srtt, rttvar, loss=None, source='host'):
+        self.srtt = srtt
+        self.rttvar = rttvar
+        self.loss = loss
+        self.source = source
+
+    @property
+    def rto(self):
+        return self.srtt + 4 * self.rttvar
+
+
+class TimingController:
+    """
+    Adaptive nmap timing and per-host time budgets.
+    
+    Registered as a host listener, it learns each host's round-trip time (and,
+    after a TCP sweep, probe loss) from discovery. Every later per-host nmap
+    run then gets timing options fitted to that host -- or to its subnet when
+    the host itself was not measured -- and a time budget that scales with
+    how slow the host is, enforced with --host-timeout. Fast hosts finish
+    quickly and a slow host gives up on its own instead of stalling a batch.
+    """
+    # Per-host budgets (seconds) for a typical host, scaled by _factor()
+    STAGE_BUDGETS = {'host_discovery': 60, 'port_scan': 120, 'service_detection': 240,
+                     'os_detection': 90, 'vulnerability_scan': 480}
+    # Relative port scan cost of each --scan-type
+    SCAN_TYPE_WEIGHTS = {'quick': 1.0, 'common': 1.5, 'comprehensive': 8.0, 'stealth': 4.0, 'udp': 6.0}
+    REFERENCE_RTO = 0.1
+    DEFAULT = HostTiming(0.1, 0.05, None, 'default')
+
+    def __init__(self, budget_scale=1.0):
+        self.budget_scale = budget_scale
+        self._hosts = {}
+        self._subnets = {}
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _subnet(address):
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return None
+        return ipaddress.ip_network(f"{ip}/{24 if ip.version == 4 else 64}", strict=False)
+
+    def __call__(self, stage, host):
+        """Host listener: learn RTT and loss from discovery results."""
+        if stage not in ('host_discovery', 'tcp_sweep') or not host.is_up or not host.times.get('srtt'):
+            return
+        srtt = host.times['srtt'] / 1e6
+        rttvar = host.times.get('rttvar', host.times['srtt'] // 2) / 1e6
+        probes = host.times.get('probes')
+        loss = host.times.get('lost', 0) / probes if probes else None
+        timing = HostTiming(srtt, rttvar, loss)
+        with self._lock:
+            self._hosts[host.address] = timing
+            subnet = self._subnet(host.address)
+            if subnet is not None:
+                self._subnets.setdefault(subnet, []).append(timing)
+
+    def profile(self, address):
+        """HostTiming for an address: measured, from its subnet, or the default."""
+        with self._lock:
+            timing = self._hosts.get(address)
+            if timing is not None:
+                return timing
+            samples = self._subnets.get(self._subnet(address), [])
+        if not samples:
+            return self.DEFAULT
+        srtts = sorted(sample.srtt for sample in samples)
+        losses = [sample.loss for sample in samples if sample.loss is not None]
+        return HostTiming(srtts[len(srtts) // 2], max(sample.rttvar for sample in samples),
+                          max(losses) if losses else None, 'subnet')
+
+    def _factor(self, timing):
+        # nmap probes many ports in parallel, so time grows slower than RTT
+        factor = min(4.0, max(0.5, (timing.rto / self.REFERENCE_RTO) ** 0.5))
+        return factor * (1 + 2 * (timing.loss or 0))
+
+    def budget(self, address, stages, scan_type='quick'):
+        """Seconds a run over `stages` may take on this host."""
+        base = sum(self.STAGE_BUDGETS[stage] * (self.SCAN_TYPE_WEIGHTS.get(scan_type, 1.0)
+                                                if stage == 'port_scan' else 1.0)
+                   for stage in stages)
+        return round(base * self._factor(self.profile(address)) * self.budget_scale)
+
+    @staticmethod
+    def grace(budget):
+        """Extra Python-side time on top of nmap's own --host-timeout."""
+        return 30 + budget * 0.25
+
+    def nmap_args(self, address, budget, scan_type='quick'):
+        """nmap timing options for one host."""
+        timing = self.profile(address)
+        rto = min(3.0, max(0.05, timing.rto))
+        loss = timing.loss
+        if loss is None:
+            retries = 3
+        elif loss < 0.01:
+            retries = 2
+        elif loss < 0.1:
+            retries = 4
+        else:
+            retries = 6
+        args = ['--initial-rtt-timeout', f"{int(rto * 1000)}ms",
+                '--max-rtt-timeout', f"{int(min(5.0, max(0.1, rto * 3)) * 1000)}ms",
+                '--max-retries', str(retries),
+                '--host-timeout', f"{budget}s"]
+        if scan_type != 'stealth' and timing.source != 'default' and (loss or 0) < 0.01:
+            # Fast, clean paths can take a higher packet rate
+            if timing.srtt < 0.005:
+                args += ['--min-rate', '1000']
+            elif timing.srtt < 0.05:
+                args += ['--min-rate', '300']
+        if (loss or 0) >= 0.1:
+            # Fewer probes in flight on lossy paths, so retries don't add to the congestion
+            args += ['--max-parallelism', '16']
+        return args
+
+    def record(self, address, stages, elapsed, budget, run):
+        """Remember how long a run took against its budget, for the report."""
+        timing = self.profile(address)
+        if run.timed_out:
+            status = 'killed'
+        elif run.interrupted:
+            status = 'interrupted'
+        elif elapsed >= budget * 0.98:
+            status = 'host-timeout'
+        else:
+            status = 'ok'
+        with self._lock:
+            entry = self.timings.setdefault(address, {
+                'srtt_ms': round(timing.srtt * 1000, 2),
+                'rttvar_ms': round(timing.rttvar * 1000, 2),
+                'loss': None if timing.loss is None else round(timing.loss, 3),
+                'source': timing.source,
+                'runs': [],
+            })
+            entry['runs'].append({'stages': list(stages), 'budget_s': budget,
+                                  'elapsed_s': round(elapsed, 2), 'status': status})
+
+    def report(self):
+        """Print per-host timings: measured RTT, budget and time used per run."""
+        if not self.timings:
+            return
+        print(f"\n{'='*60}")
+        print("HOST TIMINGS")
+        print('='*60)
+        print(f"  {'HOST':<18} {'SRTT':>9} {'LOSS':>6} {'BUDGET':>8} {'USED':>8}  STAGES")
+        for address, entry in sorted(self.timings.items()):
+            loss = '-' if entry['loss'] is None else f"{entry['loss']:.0%}"
+            srtt = f"{entry['srtt_ms']}ms" + ('*' if entry['source'] != 'host' else '')
+            for run in entry['runs']:
+                flag = '' if run['status'] == 'ok' else f"  ⚠️ {run['status']}"
+                print(f"  {address:<18} {srtt:>9} {loss:>6} {run['budget_s']:>7}s {run['elapsed_s']:>7.1f}s  "
+                      f"{','.join(run['stages'])}{flag}")
+        if any(entry['source'] != 'host' for entry in self.timings.values()):
+            print("  * RTT estimated from the subnet or defaults")
+
+
+class ScanMetrics:
+    """
+    Per-stage scan instrumentation, safe to update from worker threads.
+    
+    Every nmap run reports its stage, duration, hosts and probed ports;
+    nmap's --stats-every updates are kept as the latest progress per stage,
+    and the schedulers publish queue depths and active/waiting hosts as
+    gauges. to_dict() gives the structured view saved with the results,
+    to_prometheus() the Prometheus text exposition format.
+    """
+    QUANTILES = (0.5, 0.9, 1.0)
+    # Prometheus label name for each gauge's label; gauges not listed have none
+    GAUGE_LABELS = {'scheduler_hosts': 'state', 'stage_active': 'stage', 'stage_waiting': 'stage',
+                    'queue_depth': 'queue'}
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        # stage -> Counter(runs, cached, partial, hosts, hosts_up, ports_probed, busy_seconds)
+        self.stages = {}
+        # stage -> [first run start, last run end] (monotonic seconds)
+        self._spans = {}
+        # address -> {stage: seconds} for runs against a single host
+        self.host_durations = {}
+        # stage -> latest --stats-every update
+        self.progress = {}
+        # (name, label) -> current value, and the highest value seen
+        self.gauges = {}
+        self.peaks = {}
+
+    def _stage(self, stage):
+        return self.stages.setdefault(stage or 'nmap', Counter())
+
+    def record_run(self, stage, run, elapsed=None, ports_probed=None, cached=False):
+        """
+        Account for one finished nmap run (or a cache hit, or a TCP sweep).
+        
+        Args:
+            elapsed: Run duration; defaults to the time since run.started
+            ports_probed: Ports probed in total; by default the per-host
+                port count from nmap's <scaninfo> times the hosts that were up
+        """
+        now = time.monotonic()
+        if elapsed is None:
+            elapsed = now - run.started if run.started is not None else 0.0
+        hosts_up = sum(1 for host in run.hosts if host.is_up)
+        if ports_probed is None:
+            ports_probed = sum(int(info.get('numservices', 0)) for info in run.scan_info) * hosts_up
+        with self._lock:
+            counters = self._stage(stage)
+            counters['runs'] += 1
+            counters['cached'] += cached
+            counters['partial'] += run.partial
+            counters['hosts'] += len(run.hosts)
+            counters['hosts_up'] += hosts_up
+            counters['ports_probed'] += ports_probed
+            counters['busy_seconds'] += elapsed
+            span = self._spans.setdefault(stage or 'nmap', [now - elapsed, now])
+            span[0] = min(span[0], now - elapsed)
+            span[1] = max(span[1], now)
+            if len(run.hosts) == 1 and not cached:
+                durations = self.host_durations.setdefault(run.hosts[0].address, {})
+                key = stage or 'nmap'
+                durations[key] = durations.get(key, 0.0) + elapsed
+
+    def record_progress(self, stage, progress):
+        """Keep the latest nmap --stats-every update for a stage."""
+        with self._lock:
+            self.progress[stage or 'nmap'] = {
+                'task': progress.get('task'),
+                'percent': float(progress.get('percent', 0)),
+                'remaining_s': int(progress['remaining']) if progress.get('remaining') else None,
+                'updated_s': round(time.monotonic() - self.started, 1),
+            }
+
+    def set_gauge(self, name, label, value):
+        """Set a gauge such as ('queue_depth', 'port_scan'); label may be None."""
+        with self._lock:
+            self.gauges[(name, label)] = value
+            self.peaks[(name, label)] = max(value, self.peaks.get((name, label), value))
+
+    def adjust_gauge(self, name, label, delta):
+        """Add delta (e.g. +1/-1 around a section) to a gauge."""
+        with self._lock:
+            value = self.gauges.get((name, label), 0) + delta
+            self.gauges[(name, label)] = value
+            self.peaks[(name, label)] = max(value, self.peaks.get((name, label), value))
+        return value
+
+    def _quantiles(self, values):
+        ordered = sorted(values)
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in self.QUANTILES}
+
+    def _stage_durations(self):
+        by_stage = {}
+        for durations in self.host_durations.values():
+            for stage, seconds in durations.items():
+                by_stage.setdefault(stage, []).append(seconds)
+        return by_stage
+
+    def to_dict(self):
+        """Structured snapshot: per-stage totals and rates, progress and gauges."""
+        with self._lock:
+            durations = self._stage_durations()
+            stages = {}
+            for stage, counters in self.stages.items():
+                start, end = self._spans.get(stage, (0.0, 0.0))
+                wall = max(end - start, 1e-6)
+                entry = {key: counters[key] for key in ('runs', 'cached', 'partial', 'hosts', 'hosts_up', 'ports_probed')}
+                entry['busy_s'] = round(counters['busy_seconds'], 3)
+                entry['wall_s'] = round(end - start, 3)
+                entry['hosts_per_s'] = round(counters['hosts'] / wall, 3)
+                entry['ports_per_s'] = round(counters['ports_probed'] / wall, 1)
+                if stage in durations:
+                    entry['host_seconds'] = {f"p{int(q * 100)}": round(v, 3)
+                                             for q, v in self._quantiles(durations[stage]).items()}
+                stages[stage] = entry
+            return {
+                'elapsed_s': round(time.monotonic() - self.started, 3),
+                'stages': stages,
+                'progress': dict(self.progress),
+                'gauges': {f"{name}:{label}" if label else name: value for (name, label), value in self.gauges.items()},
+                'peaks': {f"{name}:{label}" if label else name: value for (name, label), value in self.peaks.items()},
+                'host_durations': {address: {stage: round(seconds, 3) for stage, seconds in entry.items()}
+                                   for address, entry in self.host_durations.items()},
+            }
+
+    def to_prometheus(self, prefix='nmap_scanner'):
+        """The metrics in Prometheus text exposition format."""
+        snapshot = self.to_dict()
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            if not samples:
+                return
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for labels, value in samples:
+                label_text = ','.join(f'{key}="{val}"' for key, val in labels.items())
+                lines.append(f"{prefix}_{name}{{{label_text}}} {value}" if label_text else f"{prefix}_{name} {value}")
+
+        stages = snapshot['stages']
+        family('elapsed_seconds', 'gauge', 'Seconds since the scan started', [({}, snapshot['elapsed_s'])])
+        for key, name, kind, help_text in (
+                ('runs', 'stage_runs_total', 'counter', 'nmap runs per stage'),
+                ('cached', 'stage_cached_runs_total', 'counter', 'Runs served from the result cache'),
+                ('partial', 'stage_partial_runs_total', 'counter', 'Runs cut short by a timeout or interrupt'),
+                ('hosts', 'stage_hosts_total', 'counter', 'Hosts reported per stage'),
+                ('hosts_up', 'stage_hosts_up_total', 'counter', 'Hosts reported up per stage'),
+                ('ports_probed', 'stage_ports_probed_total', 'counter', 'Ports probed per stage'),
+                ('busy_s', 'stage_busy_seconds_total', 'counter', 'Summed run time per stage'),
+                ('wall_s', 'stage_wall_seconds', 'gauge', 'Time from the first run start to the last run end'),
+                ('hosts_per_s', 'stage_hosts_per_second', 'gauge', 'Hosts per second over the stage wall time'),
+                ('ports_per_s', 'stage_ports_per_second', 'gauge', 'Ports probed per second over the stage wall time')):
+            family(name, kind, help_text, [({'stage': stage}, entry[key]) for stage, entry in stages.items()])
+
+        durations = self._stage_durations()
+        samples = []
+        for stage, values in durations.items():
+            for q, value in self._quantiles(values).items():
+                samples.append(({'stage': stage, 'quantile': str(q)}, round(value, 3)))
+        family('host_stage_seconds', 'summary', 'Per-host run time per stage', samples)
+        for stage, values in durations.items():
+            lines.append(f'{prefix}_host_stage_seconds_sum{{stage="{stage}"}} {round(sum(values), 3)}')
+            lines.append(f'{prefix}_host_stage_seconds_count{{stage="{stage}"}} {len(values)}')
+
+        progress = snapshot['progress']
+        family('stage_progress_percent', 'gauge', 'Latest nmap --stats-every percentage',
+               [({'stage': stage}, entry['percent']) for stage, entry in progress.items()])
+        family('stage_remaining_seconds', 'gauge', 'Latest nmap --stats-every time remaining',
+               [({'stage': stage}, entry['remaining_s']) for stage, entry in progress.items()
+                if entry['remaining_s'] is not None])
+
+        with self._lock:
+            gauges, peaks = dict(self.gauges), dict(self.peaks)
+        for name in sorted({name for name, _ in gauges}):
+            label_key = self.GAUGE_LABELS.get(name)
+            series = (('', gauges, 'Current'), ('_max', peaks, 'Highest')) if label_key else (('', gauges, 'Current'),)
+            for suffix, values, help_text in series:
+                family(name + suffix, 'gauge', f"{help_text} {name.replace('_', ' ')}",
+                       [({label_key: label} if label_key else {}, value)
+                        for (gauge, label), value in sorted(values.items()) if gauge == name])
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, filename):
+        """Atomically replace `filename` (e.g. for node_exporter's textfile collector)."""
+        temp = f"{filename}.{os.getpid()}.tmp"
+        with open(temp, 'w') as f:
+            f.write(self.to_prometheus())
+        os.replace(temp, filename)
+
+    def report(self):
+        """Print per-stage totals, rates and per-host durations."""
+        snapshot = self.to_dict()
+        if not snapshot['stages']:
+            return
+        print(f"\n{'='*60}")
+        print("STAGE METRICS")
+        print('='*60)
+        print(f"  {'STAGE':<19} {'RUNS':>5} {'HOSTS':>6} {'WALL':>8} {'BUSY':>8} {'HOSTS/S':>8} {'PORTS/S':>9}  P50/MAX")
+        for stage, entry in sorted(snapshot['stages'].items(), key=lambda item: -item[1]['busy_s']):
+            host_seconds = entry.get('host_seconds')
+            per_host = f"{host_seconds['p50']:.1f}s/{host_seconds['p100']:.1f}s" if host_seconds else '-'
+            print(f"  {stage:<19} {entry['runs']:>5} {entry['hosts']:>6} {entry['wall_s']:>7.1f}s "
+                  f"{entry['busy_s']:>7.1f}s {entry['hosts_per_s']:>8.2f} {entry['ports_per_s']:>9.1f}  {per_host}")
+        peaks = {key: value for key, value in snapshot['peaks'].items()
+                 if key.startswith(('queue_depth', 'stage_active', 'stage_waiting'))}
+        if peaks:
+            print(f"  Peaks: {', '.join(f'{key} {value}' for key, value in sorted(peaks.items()))}")
+
+
+class PrometheusExporter:
+    """Rewrites a Prometheus textfile from a ScanMetrics every `interval` seconds."""
+
+    def __init__(self, metrics, filename, interval=15.0):
+        self.metrics = metrics
+        self.filename = filename
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def _write(self):
+        try:
+            self.metrics.write_prometheus(self.filename)
+        except OSError as e:
+            print(f"⚠️  Cannot write metrics to {self.filename}: {e}")
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            self._write()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        """Stop the writer and write the final metrics."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self._write()
+
+
+class LocalNetwork:
+    """A network directly attached to one of this machine's interfaces."""
+    __slots__ = ('interface', 'address', 'network', 'default')
+
+    def __init__(self, interface, address, network, default=False):
+        self.interface = interface
+        self.address = address
+        self.network = network
+        # The interface carries the default route
+        self.default = default
+
+
+_local_networks = None
+
+
+def _default_route_interfaces():
+    """Interfaces with an IPv4 default route, from /proc/net/route (Linux only)."""
+    try:
+        with open('/proc/net/route') as f:
+            rows = [line.split() for line in f.readlines()[1:]]
+    except OSError:
+        return set()
+    return {row[0] for row in rows if len(row) > 7 and row[1] == '00000000' and row[7] == '00000000'}
+
+
+def _psutil_networks():
+    """Up interfaces' networks via psutil, or None when psutil is not installed."""
+    try:
+        import psutil
+    except ImportError:
+        return None
+    stats = psutil.net_if_stats()
+    networks = []
+    for interface, addresses in psutil.net_if_addrs().items():
+        if interface in stats and not stats[interface].isup:
+            continue
+        for entry in addresses:
+            if entry.family not in (socket.AF_INET, socket.AF_INET6) or not entry.netmask:
+                continue
+            address = entry.address.split('%', 1)[0]
+            prefix = bin(int(ipaddress.ip_address(entry.netmask.split('/')[0]))).count('1')
+            networks.append(LocalNetwork(interface, address, ipaddress.ip_interface(f"{address}/{prefix}").network))
+    return networks
+
+
+def _interface_up(interface):
+    """IFF_UP from /sys/class/net (Linux); unknown counts as up."""
+    try:
+        with open(f'/sys/class/net/{interface}/flags') as f:
+            return bool(int(f.read(), 16) & 0x1)
+    except (OSError, ValueError):
+        return True
+
+
+def _proc_networks():
+    """
+    Up interfaces' networks from /proc (Linux), without psutil.
+    
+    IPv4 networks are the gateway-less routes in /proc/net/route (with the
+    interface address from SIOCGIFADDR); IPv6 ones come from
+    /proc/net/if_inet6.
+    """
+    networks = []
+    try:
+        with open('/proc/net/route') as f:
+            rows = [line.split() for line in f.readlines()[1:]]
+    except OSError:
+        return networks
+    try:
+        import fcntl
+    except ImportError:
+        fcntl = None
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for row in rows:
+            if len(row) < 8 or row[2] != '00000000' or row[1] == '00000000' or not int(row[3], 16) & 0x1:
+                continue
+            # Routes are little-endian hex
+            destination = ipaddress.IPv4Address(struct.pack('<I', int(row[1], 16)))
+            mask = ipaddress.IPv4Address(struct.pack('<I', int(row[7], 16)))
+            network = ipaddress.IPv4Network(f"{destination}/{mask}")
+            address = None
+            if fcntl is not None:
+                try:
+                    packed = fcntl.ioctl(sock.fileno(), 0x8915,  # SIOCGIFADDR
+                                         struct.pack('256s', row[0][:15].encode()))
+                    address = socket.inet_ntoa(packed[20:24])
+                except OSError:
+                    pass
+            networks.append(LocalNetwork(row[0], address, network))
+    try:
+        with open('/proc/net/if_inet6') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 6:
+                    continue
+                if not _interface_up(fields[5]):
+                    continue
+                address = str(ipaddress.IPv6Address(bytes.fromhex(fields[0])))
+                networks.append(LocalNetwork(fields[5], address,
+                                             ipaddress.ip_interface(f"{address}/{int(fields[2], 16)}").network))
+    except OSError:
+        pass
+    return networks
+
+
+def local_networks(refresh=False):
+    """
+    Networks directly attached to this machine's up interfaces, cached.
+    
+    Reads interface addresses and netmasks through psutil when it is
+    installed, otherwise from /proc on Linux. No DNS lookups and no
+    outbound sockets. Loopback and link-local networks are left out;
+    networks on the default-route interface come first.
+    
+    Returns:
+        list: LocalNetwork entries (empty when nothing could be read)
+    """
+    global _local_networks
+    if _local_networks is None or refresh:
+        found = _psutil_networks()
+        if found is None:
+            found = _proc_networks()
+        defaults = _default_route_interfaces()
+        networks, seen = [], set()
+        for entry in found:
+            if entry.network.is_loopback or entry.network.is_link_local or (entry.interface, entry.network) in seen:
+                continue
+            seen.add((entry.interface, entry.network))
+            entry.default = entry.interface in defaults
+            networks.append(entry)
+        networks.sort(key=lambda entry: (not entry.default, entry.network.version))
+        _local_networks = networks
+    return list(_local_networks)
+
 
 class NetworkScanner:
+    # Per-host stages in the order they run, mapped to their methods
+    STAGES = ('port_scan', 'service_detection', 'os_detection', 'vulnerability_scan')
+    
     def __init__(self):
-        self.scan_results = {}
+        self.scan_results = ScanResults()
         self.start_time = datetime.now()
+        self._nse_lock = threading.Lock()
+        self._nse_categories = {}
+        # Interval for nmap --stats-every progress updates (e.g. '10s'), or None
+        self.stats_interval = None
+        # Keep nmap's raw XML (zlib-compressed) in scan_results
+        self.keep_raw_output = False
+        # Callables (stage, HostRecord) invoked as soon as each host completes
+        self.host_listeners = []
+        # Callables (stage, target, HostRecords, stage snapshot, raw=, partial=,
+        # complete=) invoked whenever a stage result is recorded (e.g.
+        # ResultStreamWriter)
+        self.result_listeners = []
+        # Keep raw output in scan_results too; off when only a stream keeps it
+        self.retain_raw = True
+        # Hosts and ranges nmap must skip (--exclude), e.g. excluded hostnames
+        self.nmap_exclude = []
+        # Optional TimingController for per-host timing options and time budgets
+        self.timing = None
+        # Optional ScanCache reused by the deep stages
+        self.cache = None
+        self._nmap_version = None
+        # Optional callable (target, PortRecords) -> PortRecords choosing which
+        # known open ports the deep stages probe (used by incremental scans)
+        self.deep_port_filter = None
+        # Per-stage run times, rates, progress and scheduler queue depths
+        self.metrics = ScanMetrics()
+        # time.monotonic() at which the scan window closes, or None; runs are
+        # cut off there and stages not started are deferred
+        self.deadline = None
+        # address -> stages left undone when the window closed
+        self.deferred = {}
+        # Let nmap resolve hostnames itself; off (-n) when a HostnameEnricher
+        # resolves them concurrently instead
+        self.nmap_dns = True
+        self._defer_lock = threading.Lock()
+    
+    def out_of_time(self):
+        """Whether the --time-budget window has closed."""
+        return self.deadline is not None and time.monotonic() >= self.deadline
+    
+    def _defer(self, target, stages):
+        with self._defer_lock:
+            pending = self.deferred.setdefault(target, [])
+            pending += [stage for stage in stages if stage not in pending]
+    
+    def _capped_timeout(self, timeout):
+        """A run's timeout, shortened so it ends with the scan window."""
+        if self.deadline is None:
+            return timeout
+        return max(0.0, min(timeout, self.deadline - time.monotonic()))
+    
+    def _record_result(self, stage, target, hosts, raw=None, ran=True, **kwargs):
+        """
+        Merge a stage's hosts into scan_results; safe to call from worker threads.
+        
+        Args:
+            ran: False when the stage was settled without running it (e.g.
+                nothing left to probe); listeners then do not count it as a
+                finished run, so --resume looks at it again
+        """
+        section = self.scan_results.add(stage, target, hosts, raw=raw if self.retain_raw else None, **kwargs)
+        if self.result_listeners:
+            snapshot = self.scan_results.stage_snapshot(stage)
+            partial = kwargs.get('partial', False)
+            for listener in self.result_listeners:
+                listener(stage, target, hosts, snapshot, raw=raw, partial=partial, complete=ran and not partial)
+        return section
+    
+    def run_stage(self, stage, target, scan_type='quick', open_ports=None):
+        """
+        Run one of STAGES against a target and return its HostRecords.
+        
+        Args:
+            open_ports: PortRecords the deep stages probe; None uses the ports
+                this scan's port scan found for the target
+        """
+        if stage == 'port_scan':
+            return self.port_scan(target, scan_type)
+        if stage == 'service_detection':
+            return self.service_version_detection(target, open_ports)
+        if stage == 'os_detection':
+            return self.os_detection(target, open_ports)
+        if stage == 'vulnerability_scan':
+            return self.vulnerability_scan(target, open_ports)
+        raise ValueError(f"Unknown scan stage: {stage}")
         
     def check_nmap_installation(self):
         """Check if Nmap is installed on the system."""
@@ -29,6 +752,7 @@ class NetworkScanner:
                                   capture_output=True, text=True, timeout=10)
             if result.returncode == 0:
                 version_info = result.stdout.split('\n')[0]
+                self._nmap_version = version_info
                 print(f"✅ Nmap found: {version_info}")
                 return True
             else:
@@ -48,275 +772,1967 @@ class NetworkScanner:
         print("\n🔗 Official website: https://nmap.org/")
         
     def get_local_network_info(self):
-        """Get information about the local network."""
+        """
+        Print the local interfaces and return the network to scan by default:
+        the first IPv4 network attached to the default-route interface, with
+        its real netmask (see local_networks()).
+        """
         print(f"\n{'='*60}")
         print("LOCAL NETWORK INFORMATION")
         print('='*60)
+        print(f"Hostname: {socket.gethostname()}")
+        
+        networks = local_networks()
+        for entry in networks:
+            route = " (default route)" if entry.default else ""
+            print(f"  {entry.interface:<12} {entry.address or '-':<26} {entry.network}{route}")
+        
+        ipv4 = [entry for entry in networks if entry.network.version == 4]
+        if not ipv4:
+            print("⚠️  No IPv4 network found on any up interface; pass a target explicitly")
+            return "192.168.1.0/24"  # Default fallback
+        
+        network = ipv4[0].network
+        print(f"Local IP: {ipv4[0].address or '-'}")
+        print(f"Network Range: {network}")
+        if network.num_addresses > 65536:
+            print(f"⚠️  {network} has {network.num_addresses:,} addresses; consider a narrower target")
+        return str(network)
+    
+    def _run_nmap(self, args, timeout, stage=None):
+        """
+        Run nmap to completion (or until it times out / is interrupted).
+        
+        Hosts are parsed, printed and passed to the host listeners as nmap
+        reports them; whatever completed before a timeout or Ctrl+C is kept.
+        
+        Returns:
+            NmapRun
+        """
+        run = NmapRun()
+        try:
+            for _ in self.stream_nmap(args, timeout, stage=stage, run=run):
+                pass
+        except KeyboardInterrupt:
+            run.interrupted = True
+        return run
+    
+    def stream_nmap(self, args, timeout, stage=None, run=None):
+        """
+        Run nmap and yield HostRecords as soon as nmap reports each host.
+        
+        nmap writes every finished host to its XML output right away, so a
+        consumer can start working on the first hosts of a large sweep while
+        nmap is still probing the rest. The process is killed if it is still
+        running after `timeout` seconds; hosts yielded before that stand.
+        
+        Args:
+            stage: Stage name passed to host listeners and progress output
+            run: Optional NmapRun that collects hosts and the exit status
+        """
+        run = run if run is not None else NmapRun()
+        cmd = self._nmap_command(args, run)
         
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stderr_chunks = []
+        stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)
+        stderr_reader.start()
+        
+        def expire():
+            run.timed_out = True
+            process.kill()
+        
+        watchdog = threading.Timer(timeout, expire)
+        watchdog.daemon = True
+        watchdog.start()
+        
+        parser = self._xml_parser(stage)
+        raw = _RawCapture() if self.keep_raw_output else None
         try:
-            # Get hostname and local IP
-            hostname = socket.gethostname()
-            local_ip = socket.gethostbyname(hostname)
-            print(f"Hostname: {hostname}")
-            print(f"Local IP: {local_ip}")
+            while True:
+                chunk = process.stdout.read1(65536)
+                if not chunk:
+                    break
+                if raw is not None:
+                    raw.append(chunk)
+                for host in parser.feed(chunk):
+                    run.hosts.append(host)
+                    self._emit_host(stage, host)
+                    yield host
+            process.wait()
+            try:
+                for host in parser.close():
+                    run.hosts.append(host)
+                    self._emit_host(stage, host)
+                    yield host
+            except ET.ParseError:
+                # Output cut short by a timeout or a killed nmap
+                if process.returncode == 0:
+                    raise
+        except KeyboardInterrupt:
+            run.interrupted = True
+            raise
+        finally:
+            watchdog.cancel()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            stderr_reader.join(timeout=5)
+            process.stdout.close()
+            self._finish_run(run, process.returncode, b''.join(stderr_chunks), parser, raw, stage)
+    
+    def _timing_plan(self, target, stages, scan_type='quick'):
+        """
+        Extra nmap timing arguments, Python-side timeout and budget for a run.
+        
+        Without adaptive timing, and for ranges, this is the fixed STAGE_TIMEOUTS
+        and no budget.
+        """
+        fixed = sum(STAGE_TIMEOUTS[stage] for stage in stages)
+        if self.timing is None or not _is_single_target(target):
+            return [], fixed, None
+        budget = self.timing.budget(target, stages, scan_type)
+        return self.timing.nmap_args(target, budget, scan_type), budget + self.timing.grace(budget), budget
+    
+    def _run_timed(self, args, target, stages, stage, scan_type='quick'):
+        """Run nmap against one target with the timing plan for `stages`."""
+        extra, timeout, budget = self._timing_plan(target, stages, scan_type)
+        timeout = self._capped_timeout(timeout)
+        if timeout <= 0:
+            return self._window_closed(target, stages)
+        started = time.monotonic()
+        run = self._run_nmap(args + extra + [target], timeout, stage=stage)
+        if budget is not None:
+            self.timing.record(target, stages, time.monotonic() - started, budget, run)
+        if run.timed_out and self.out_of_time():
+            self._defer(target, stages)
+        return run
+    
+    def _window_closed(self, target, stages):
+        """
+        Defer `stages` instead of starting nmap when the scan window closed
+        after they were scheduled (e.g. while waiting for a stage limit).
+        
+        Returns:
+            NmapRun: A timed-out run with no hosts, so nothing is recorded
+        """
+        self._defer(target, stages)
+        print(f"⏲️  Time budget spent; deferring {', '.join(stages)} on {target}")
+        run = NmapRun()
+        run.timed_out = True
+        return run
+    
+    def nmap_version(self):
+        """First line of `nmap --version`, looked up once."""
+        if self._nmap_version is None:
+            try:
+                result = subprocess.run(['nmap', '--version'], capture_output=True, text=True, timeout=10)
+                self._nmap_version = result.stdout.split('\n')[0]
+            except (subprocess.TimeoutExpired, FileNotFoundError):
+                self._nmap_version = ''
+        return self._nmap_version
+    
+    def _cache_key(self, target, args, open_ports):
+        """ScanCache key for a deep run, or None when the run can't be cached."""
+        if self.cache is None or not _is_single_target(target):
+            return None
+        if open_ports is None:
+            open_ports = self._known_open_ports(target)
+            if open_ports is None:
+                return None
+        return ScanCache.key(target, open_ports, args, self.nmap_version())
+    
+    def _known_open_ports(self, target):
+        """Open ports this scan's port scan found on a target, or None if it has not port-scanned it."""
+        known = self.scan_results.hosts.get(target)
+        if known is None or 'port_scan' not in self.scan_results.host_stages(target):
+            return None
+        return known.open_ports
+    
+    def _separate_stage_args(self, target, stage, args, open_ports=None):
+        """
+        nmap arguments for a deep stage run on its own (--no-merge).
+        
+        Like the merged run, it only probes the open ports: the ones given,
+        or else those this scan's port scan found on the target. When there
+        are none the stage is recorded empty without a run.
+        
+        Returns:
+            tuple: (nmap arguments or None if there is nothing to probe,
+            the open ports probed or None for nmap's defaults)
+        """
+        if open_ports is None:
+            open_ports = self._known_open_ports(target)
+        if open_ports and self.deep_port_filter is not None:
+            open_ports = self.deep_port_filter(target, open_ports)
+        if open_ports is None:
+            return args, None
+        if not open_ports:
+            print(f"ℹ️  Nothing to probe on {target}; skipping {stage}")
+            self._record_result(stage, target, [], ran=False)
+            return None, open_ports
+        return args + port_list_args(open_ports), open_ports
+    
+    def _cached_run(self, key, stage):
+        """An NmapRun rebuilt from the cache, or None on a miss."""
+        hosts = self.cache.get(key) if key is not None else None
+        if hosts is None:
+            return None
+        print("♻️  Using cached results (same open ports, arguments and nmap version)")
+        run = NmapRun()
+        run.returncode = 0
+        for host in hosts:
+            run.hosts.append(host)
+            self._emit_host(stage, host)
+        self.metrics.record_run(stage, run, elapsed=0.0, cached=True)
+        return run
+    
+    def _run_deep(self, args, target, stages, stage, open_ports=None):
+        """_run_timed() for deep stages, served from the ScanCache when possible."""
+        key = self._cache_key(target, args, open_ports)
+        run = self._cached_run(key, stage)
+        if run is None:
+            run = self._run_timed(args, target, stages, stage)
+            if key is not None and run.ok:
+                self.cache.put(key, target, run.hosts)
+        return run
+    
+    def _nmap_command(self, args, run):
+        """Build (and print) the full nmap command line for a run."""
+        cmd = ['nmap'] + args
+        if not self.nmap_dns and '-n' not in args:
+            cmd.insert(1, '-n')
+        if self.nmap_exclude:
+            cmd += ['--exclude', ','.join(self.nmap_exclude)]
+        if self.stats_interval:
+            cmd += ['--stats-every', self.stats_interval]
+        cmd += ['-oX', '-']
+        run.command = cmd
+        run.started = time.monotonic()
+        print(f"Command: {' '.join(cmd)}")
+        return cmd
+    
+    def _xml_parser(self, stage):
+        return NmapXMLParser(on_progress=lambda progress: self._report_progress(stage, progress))
+    
+    def _finish_run(self, run, returncode, stderr, parser, raw, stage=None):
+        run.returncode = returncode
+        run.stderr = stderr.decode('utf-8', 'replace').strip()
+        run.run_info = parser.run_info
+        run.scan_info = parser.scan_info
+        if raw is not None:
+            run.raw_output = raw.getvalue()
+        self.metrics.record_run(stage, run)
+    
+    def _report_progress(self, stage, progress):
+        """Record and print a --stats-every progress update from nmap."""
+        self.metrics.record_progress(stage, progress)
+        label = stage.replace('_', ' ') if stage else 'nmap'
+        remaining = progress.get('remaining')
+        eta = f", ~{remaining}s left" if remaining else ""
+        print(f"   ⏳ {label}: {progress.get('task', 'scan')} {float(progress.get('percent', 0)):.1f}%{eta}")
+    
+    def _emit_host(self, stage, host):
+        """Print a finished host and hand it to the registered host listeners."""
+        self.print_hosts([host])
+        for listener in self.host_listeners:
+            listener(stage, host)
+    
+    def print_hosts(self, hosts):
+        """Print parsed hosts in a compact, nmap-like layout."""
+        for host in hosts:
+            if not host.is_up:
+                continue
+            name = f" ({host.hostname})" if host.hostname else ""
+            print(f"\nHost: {host.address}{name} - {host.status}")
+            if host.mac:
+                vendor = f" ({host.vendor})" if host.vendor else ""
+                print(f"  MAC Address: {host.mac}{vendor}")
             
-            # Try to get more accurate local IP
-            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-                s.connect(("8.8.8.8", 80))
-                actual_local_ip = s.getsockname()[0]
-                if actual_local_ip != local_ip:
-                    print(f"Actual Local IP: {actual_local_ip}")
-                    local_ip = actual_local_ip
+            if host.ports:
+                print(f"  {'PORT':<10} {'STATE':<15} {'SERVICE':<15} VERSION")
+                for port in host.ports:
+                    print(f"  {port.label:<10} {port.state:<15} {port.service or '':<15} {port.version_string}")
+                    for script_id, output in port.scripts.items():
+                        print(f"    | {script_id}: {output.strip()}")
             
-            # Calculate network range
-            try:
-                network = ipaddress.IPv4Network(f"{local_ip}/24", strict=False)
-                print(f"Network Range: {network}")
-                return str(network)
-            except:
-                return f"{'.'.join(local_ip.split('.')[:-1])}.0/24"
-                
-        except Exception as e:
-            print(f"Error getting network info: {e}")
-            return "192.168.1.0/24"  # Default fallback
+            for script_id, output in host.scripts.items():
+                print(f"  Host script {script_id}: {output.strip()}")
+            
+            for match in host.os_matches[:3]:
+                print(f"  OS: {match.name} ({match.accuracy}%)")
+    
+    def _complete_stage(self, stage, label, target, run, script_filter=None, reraise=True, **extra):
+        """
+        Record a stage's results from an NmapRun, keeping partial results.
+        
+        Returns:
+            StageInfo: The stage's entry in scan_results, or None if the run
+            produced nothing.
+        
+        Raises:
+            KeyboardInterrupt: after recording, if the run was interrupted
+                (unless reraise is False)
+        """
+        if run.ok or run.hosts:
+            if run.partial:
+                reason = 'timed out' if run.timed_out else 'interrupted'
+                print(f"\n⚠️  {label} {reason} - keeping {len(run.hosts)} completed hosts")
+            section = self._record_result(stage, target, run.hosts, partial=run.partial, raw=run.raw_output,
+                                          script_filter=script_filter, **extra)
+        else:
+            section = None
+            if run.timed_out:
+                print(f"⏱️ {label} timed out")
+            elif not run.interrupted:
+                print(f"❌ {label} failed: {run.stderr}")
+        
+        if run.interrupted and reraise:
+            raise KeyboardInterrupt
+        return section
     
     def basic_host_discovery(self, target):
         """Perform basic host discovery scan."""
         print(f"\n🔍 BASIC HOST DISCOVERY")
         print("-" * 40)
-        print(f"Target: {target}")
+        print(f"Target: {' '.join(target_args(target))}")
         
         try:
-            cmd = ['nmap', '-sn', target]
-            print(f"Command: {' '.join(cmd)}")
+            run = self._run_nmap(['-sn'] + target_args(target), self._capped_timeout(STAGE_TIMEOUTS['host_discovery']),
+                                 stage='host_discovery')
+            live = [host for host in run.hosts if host.is_up]
+            live_hosts = [host.address for host in live]
+            run.hosts = live
             
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-            
-            if result.returncode == 0:
-                print("\n📋 Results:")
-                print(result.stdout)
-                
-                # Parse results for live hosts
-                lines = result.stdout.split('\n')
-                live_hosts = []
-                for line in lines:
-                    if 'Nmap scan report for' in line:
-                        host = line.split('for ')[1].strip()
-                        if '(' in host:
-                            host = host.split('(')[1].rstrip(')')
-                        live_hosts.append(host)
-                
-                self.scan_results['host_discovery'] = {
-                    'live_hosts': live_hosts,
-                    'host_count': len(live_hosts),
-                    'raw_output': result.stdout
-                }
-                
-                print(f"\n✅ Found {len(live_hosts)} live hosts")
-                return live_hosts
-            else:
-                print(f"❌ Scan failed: {result.stderr}")
+            section = self._complete_stage('host_discovery', 'Host discovery', target, run)
+            if section is None:
                 return []
+            
+            print(f"\n✅ Found {len(live_hosts)} live hosts")
+            return live_hosts
                 
-        except subprocess.TimeoutExpired:
-            print("⏱️ Scan timed out")
-            return []
+        except KeyboardInterrupt:
+            raise
         except Exception as e:
             print(f"❌ Error during host discovery: {e}")
             return []
     
-    def port_scan(self, target, scan_type='quick'):
-        """Perform port scanning on target."""
+    def tcp_sweep(self, target, ports=None, concurrency=1000, timeout=1.0, record_ports=False):
+        """
+        Find live hosts and open ports with a TCPSweep instead of nmap.
+        
+        The live hosts are recorded as the host_discovery section (and, with
+        record_ports, the open ports as the port_scan section), so the
+        targeted nmap stages can be seeded from the returned HostRecords.
+        
+        Returns:
+            list: HostRecords of the responding hosts
+        """
+        sweep = TCPSweep(ports=ports, concurrency=concurrency, timeout=timeout)
+        print(f"\n⚡ TCP CONNECT SWEEP")
+        print("-" * 40)
+        print(f"Target: {' '.join(target_args(target))}")
+        print(f"Ports: {len(sweep.ports)}, concurrent connects: {sweep.concurrency}")
+        
+        async def collect(hosts):
+            async for host in sweep.sweep(target):
+                hosts.append(host)
+                self._emit_host('tcp_sweep', host)
+        
+        hosts = []
+        interrupted = False
+        started = time.monotonic()
+        try:
+            asyncio.run(collect(hosts))
+        except KeyboardInterrupt:
+            interrupted = True
+        except ValueError as e:
+            print(f"❌ Cannot sweep target: {e}")
+            return []
+        
+        run = NmapRun()
+        run.hosts, run.interrupted = hosts, interrupted
+        self.metrics.record_run('tcp_sweep', run, elapsed=time.monotonic() - started,
+                                ports_probed=sweep.stats['probes'])
+        
+        for stage in ('host_discovery', 'port_scan') if record_ports else ('host_discovery',):
+            self._record_result(stage, target, hosts, partial=interrupted,
+                                method='tcp-connect', ports_probed=sweep.ports)
+        
+        stats = sweep.stats
+        print(f"\n✅ Found {len(hosts)} live hosts, {sum(len(host.open_ports) for host in hosts)} open ports "
+              f"({stats['probes']} connects, {stats['timeouts']} timed out)")
+        if stats['backoffs']:
+            print(f"⚠️  Ran out of sockets {stats['backoffs']} times; lowered concurrency to "
+                  f"{sweep.effective_concurrency} (try a smaller --sweep-concurrency)")
+        if interrupted:
+            print("⚠️  Sweep interrupted - keeping the hosts found so far")
+            raise KeyboardInterrupt
+        return hosts
+    
+    def port_scan(self, target, scan_type='quick', detect_services=True):
+        """
+        Perform port scanning on target.
+        
+        Args:
+            detect_services: Also probe versions (and OS as root). Turned off when
+                later stages will do that work on the open ports anyway.
+        
+        Returns:
+            list: HostRecords (empty if no host answered), or None if the scan
+            failed and nothing was recorded
+        """
         print(f"\n🔍 PORT SCANNING")
         print("-" * 40)
         print(f"Target: {target}")
         print(f"Scan Type: {scan_type}")
         
-        # Define scan parameters
-        scan_configs = {
-            'quick': ['-T4', '--top-ports', '1000'],
-            'common': ['-T4', '--top-ports', '2000'],
-            'comprehensive': ['-T4', '-p-'],
-            'stealth': ['-sS', '-T2', '--top-ports', '1000'],
-            'udp': ['-sU', '--top-ports', '100']
-        }
-        
-        if scan_type not in scan_configs:
+        if scan_type not in SCAN_CONFIGS:
             scan_type = 'quick'
             
         try:
+            run = self._run_timed(self._port_scan_args(scan_type, detect_services), target,
+                                  ['port_scan'], 'port_scan', scan_type)
+            section = self._complete_stage('port_scan', 'Port scan', target, run, scan_type=scan_type)
+            if section is None:
+                return None
+            print(f"\n✅ Found {sum(len(host.open_ports) for host in run.hosts)} open ports")
+            return run.hosts
+                
+        except KeyboardInterrupt:
+            raise
+        except Exception as e:
+            print(f"❌ Error during port scan: {e}")
+        return None
+    
+    def _port_scan_failed(self, target, deep_stages):
+        """
+        Leave the deep stages of a host unrecorded after its port scan failed.
+        
+        Running them over an empty port list would record them as finished
+        with nothing found. Instead they are deferred when the scan window has
+        closed and skipped otherwise, so --resume and the state database still
+        treat them as not done.
+        """
+        if not deep_stages:
+            return
+        if self.out_of_time():
+            self._defer(target, deep_stages)
+        else:
+            print(f"⚠️  Port scan of {target} failed; skipping {', '.join(deep_stages)}")
+    
+    def _port_scan_args(self, scan_type, detect_services):
+        args = list(SCAN_CONFIGS.get(scan_type, SCAN_CONFIGS['quick']))
+        if detect_services:
             # Check if running as root for OS detection
-            import os
             if os.geteuid() == 0:
-                cmd = ['nmap'] + scan_configs[scan_type] + ['-sV', '-O', target]
+                args += ['-sV', '-O']
             else:
-                cmd = ['nmap'] + scan_configs[scan_type] + ['-sV', target]
+                args += ['-sV']
                 print("ℹ️  Running without OS detection (requires root privileges)")
-            
-            print(f"Command: {' '.join(cmd)}")
-            
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=600)
-            
-            if result.returncode == 0:
-                print("\n📋 Results:")
-                print(result.stdout)
-                
-                self.scan_results['port_scan'] = {
-                    'target': target,
-                    'scan_type': scan_type,
-                    'raw_output': result.stdout
-                }
-                
-                # Parse open ports
-                open_ports = []
-                lines = result.stdout.split('\n')
-                for line in lines:
-                    if '/tcp' in line and 'open' in line:
-                        port_info = line.strip()
-                        open_ports.append(port_info)
-                
-                self.scan_results['port_scan']['open_ports'] = open_ports
-                print(f"\n✅ Found {len(open_ports)} open ports")
-                
-            else:
-                print(f"❌ Port scan failed: {result.stderr}")
-                
-        except subprocess.TimeoutExpired:
-            print("⏱️ Port scan timed out")
-        except Exception as e:
-            print(f"❌ Error during port scan: {e}")
+        return args
     
-    def service_version_detection(self, target):
+    def service_version_detection(self, target, open_ports=None):
         """Perform service version detection."""
         print(f"\n🔍 SERVICE VERSION DETECTION")
         print("-" * 40)
         
+        args, open_ports = self._separate_stage_args(target, 'service_detection', ['-sV', '-sC', '--version-all'],
+                                                     open_ports)
+        if args is None:
+            return []
         try:
-            cmd = ['nmap', '-sV', '-sC', '--version-all', target]
-            print(f"Command: {' '.join(cmd)}")
-            
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=600)
-            
-            if result.returncode == 0:
-                print("\n📋 Results:")
-                print(result.stdout)
+            run = self._run_deep(args, target, ['service_detection'], 'service_detection', open_ports)
+            self._complete_stage('service_detection', 'Service detection', target, run)
+            return run.hosts
                 
-                self.scan_results['service_detection'] = {
-                    'target': target,
-                    'raw_output': result.stdout
-                }
-                
-            else:
-                print(f"❌ Service detection failed: {result.stderr}")
-                
-        except subprocess.TimeoutExpired:
-            print("⏱️ Service detection timed out")
+        except KeyboardInterrupt:
+            raise
         except Exception as e:
             print(f"❌ Error during service detection: {e}")
+        return []
     
-    def os_detection(self, target):
+    def os_detection(self, target, open_ports=None):
         """Perform OS detection."""
         print(f"\n🔍 OS DETECTION")
         print("-" * 40)
         
+        if not self._skip_unrunnable(target, ['os_detection']):
+            return []
+        args, open_ports = self._separate_stage_args(target, 'os_detection', ['-O', '--osscan-guess'], open_ports)
+        if args is None:
+            return []
         try:
-            cmd = ['nmap', '-O', '--osscan-guess', target]
-            print(f"Command: {' '.join(cmd)}")
-            
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
-            
-            if result.returncode == 0:
-                print("\n📋 Results:")
-                print(result.stdout)
-                
-                self.scan_results['os_detection'] = {
-                    'target': target,
-                    'raw_output': result.stdout
-                }
-                
-            else:
-                print(f"❌ OS detection failed: {result.stderr}")
+            run = self._run_deep(args, target, ['os_detection'], 'os_detection', open_ports)
+            section = self._complete_stage('os_detection', 'OS detection', target, run)
+            if section is None and not run.timed_out:
                 print("Note: OS detection requires root privileges and may not work on all targets")
+            return run.hosts
                 
-        except subprocess.TimeoutExpired:
-            print("⏱️ OS detection timed out")
+        except KeyboardInterrupt:
+            raise
         except Exception as e:
             print(f"❌ Error during OS detection: {e}")
+        return []
     
-    def vulnerability_scan(self, target):
+    def vulnerability_scan(self, target, open_ports=None):
         """Perform basic vulnerability scanning using NSE scripts."""
         print(f"\n🔍 VULNERABILITY SCANNING")
         print("-" * 40)
         
+        args, open_ports = self._separate_stage_args(target, 'vulnerability_scan', ['--script', 'vuln'], open_ports)
+        if args is None:
+            return []
         try:
-            cmd = ['nmap', '--script', 'vuln', target]
-            print(f"Command: {' '.join(cmd)}")
             print("⚠️  This may take several minutes...")
-            
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=900)
-            
-            if result.returncode == 0:
-                print("\n📋 Results:")
-                print(result.stdout)
-                
-                self.scan_results['vulnerability_scan'] = {
-                    'target': target,
-                    'raw_output': result.stdout
-                }
+            run = self._run_deep(args, target, ['vulnerability_scan'], 'vulnerability_scan', open_ports)
+            self._complete_stage('vulnerability_scan', 'Vulnerability scan', target, run)
+            return run.hosts
                 
-            else:
-                print(f"❌ Vulnerability scan failed: {result.stderr}")
-                
-        except subprocess.TimeoutExpired:
-            print("⏱️ Vulnerability scan timed out")
+        except KeyboardInterrupt:
+            raise
         except Exception as e:
             print(f"❌ Error during vulnerability scan: {e}")
+        return []
     
-    def save_results(self, filename=None):
-        """Save scan results to a file."""
-        if not filename:
-            timestamp = self.start_time.strftime("%Y%m%d_%H%M%S")
-            filename = f"nmap_scan_results_{timestamp}.json"
+    def nse_scripts_in_category(self, category):
+        """
+        Return the set of NSE script ids in a category, from `nmap --script-help`.
+        
+        The lookup runs once per category and is cached for the process.
+        Returns None if nmap could not list the scripts.
+        """
+        with self._nse_lock:
+            if category in self._nse_categories:
+                return self._nse_categories[category]
         
+        scripts = None
         try:
-            with open(filename, 'w') as f:
-                json.dump(self.scan_results, f, indent=2, default=str)
-            
-            print(f"\n💾 Results saved to: {filename}")
-            return filename
-            
-        except Exception as e:
-            print(f"❌ Error saving results: {e}")
+            result = subprocess.run(['nmap', '--script-help', category],
+                                    capture_output=True, text=True, timeout=60)
+            if result.returncode == 0:
+                scripts = set()
+                previous = None
+                for line in result.stdout.splitlines():
+                    if line.startswith('Categories:'):
+                        if previous and category in line.split()[1:]:
+                            scripts.add(previous)
+                    elif line and not line[0].isspace():
+                        previous = line.strip()
+        except (subprocess.TimeoutExpired, FileNotFoundError):
+            pass
+        
+        with self._nse_lock:
+            self._nse_categories[category] = scripts
+        return scripts
+    
+    def _is_vuln_script(self, script_id):
+        """Whether an NSE script belongs to the vuln category."""
+        vuln_scripts = self.nse_scripts_in_category('vuln')
+        if vuln_scripts is not None:
+            return script_id in vuln_scripts
+        return 'vuln' in script_id
+    
+    def _skip_unrunnable(self, target, stages):
+        """
+        Drop the deep stages that cannot run here (OS detection without root).
+        
+        They are recorded as partial with a 'skipped' reason rather than as an
+        empty, finished result, so --resume and the state database do not take
+        them for done.
+        
+        Returns:
+            list: the stages that can run
+        """
+        if 'os_detection' not in stages or os.geteuid() == 0:
+            return stages
+        print(f"\nℹ️  Skipping OS detection on {target} (requires root privileges)")
+        self._record_result('os_detection', target, [], partial=True, skipped='requires root')
+        return [stage for stage in stages if stage != 'os_detection']
+    
+    def plan_deep_scan(self, stages, open_ports=None):
+        """
+        Combine the deep stages for one host into a single nmap argument list.
+        
+        service_detection contributes -sV --version-all and the default scripts,
+        os_detection -O --osscan-guess, vulnerability_scan the vuln scripts.
+        When the open ports are already known the run is restricted to them.
+        Callers drop os_detection first when it cannot run here (see
+        _skip_unrunnable()).
+        
+        Args:
+            stages: Deep stages to cover (any of STAGES except port_scan)
+            open_ports: PortRecords from a previous port scan, or None
+        
+        Returns:
+            list: nmap arguments (without the target), or None if nothing to do
+        """
+        stages = [stage for stage in stages if stage != 'port_scan']
+        if not stages:
+            return None
+        if open_ports is not None and not open_ports:
             return None
+        
+        args = []
+        scripts = []
+        if 'service_detection' in stages:
+            args += ['-sV', '--version-all']
+            scripts.append('default')
+        if 'os_detection' in stages:
+            args += ['-O', '--osscan-guess']
+        if 'vulnerability_scan' in stages:
+            scripts.append('vuln')
+        if scripts:
+            args += ['--script', ','.join(scripts)]
+        
+        if open_ports:
+            args += port_list_args(open_ports)
+        return args
     
-    def generate_summary(self):
-        """Generate a summary of scan results."""
-        print(f"\n{'='*60}")
-        print("SCAN SUMMARY")
-        print('='*60)
+    def scan_host(self, target, stages, scan_type='quick', stage_guard=None, open_ports=None):
+        """
+        Run the requested per-host stages with as few nmap invocations as possible.
         
-        end_time = datetime.now()
-        duration = end_time - self.start_time
+        A port scan (if requested) runs first without version probing; all deep
+        stages are then merged into one run over the open ports it found, and the
+        parsed hosts are recorded in scan_results under each of those stages.
         
-        print(f"Scan Duration: {duration}")
-        print(f"Start Time: {self.start_time}")
-        print(f"End Time: {end_time}")
+        Args:
+            stage_guard: Optional callable taking a list of stages and returning a
+                context manager, used by the scheduler to enforce stage limits
+            open_ports: PortRecords already found (e.g. by tcp_sweep()); the nmap
+                port scan is skipped and the deep stages use these ports
         
-        if 'host_discovery' in self.scan_results:
-            host_count = self.scan_results['host_discovery']['host_count']
-            print(f"Live Hosts Found: {host_count}")
-            
-        if 'port_scan' in self.scan_results:
-            open_ports = len(self.scan_results['port_scan'].get('open_ports', []))
-            print(f"Open Ports Found: {open_ports}")
+        Returns:
+            dict: stage -> list of HostRecords
+        """
+        guard = stage_guard or (lambda covered: nullcontext())
+        deep_stages = [stage for stage in self.STAGES if stage in stages and stage != 'port_scan']
+        results = {}
         
-        print(f"\nScans Performed:")
-        for scan_type in self.scan_results.keys():
-            print(f"  ✅ {scan_type.replace('_', ' ').title()}")
+        if open_ports is None and 'port_scan' in stages:
+            if self.out_of_time():
+                self._defer(target, [stage for stage in self.STAGES if stage in stages])
+                return results
+            with guard(['port_scan']):
+                hosts = self.port_scan(target, scan_type, detect_services=not deep_stages)
+            if hosts is None:
+                self._port_scan_failed(target, deep_stages)
+                return results
+            results['port_scan'] = hosts
+            open_ports = [port for host in hosts for port in host.open_ports]
+        
+        if deep_stages:
+            if self.out_of_time():
+                self._defer(target, deep_stages)
+            else:
+                results.update(self.deep_scan(target, deep_stages, open_ports, guard))
+        return results
+    
+    def deep_scan(self, target, stages, open_ports=None, stage_guard=None):
+        """
+        Run the deep stages for a host as one merged nmap invocation.
+        
+        Args:
+            stages: Deep stages to run (service/OS detection, vulnerability scan)
+            open_ports: PortRecords already known to be open, or None to let nmap
+                use its default port set
+            stage_guard: See scan_host()
+        
+        Returns:
+            dict: stage -> list of HostRecords
+        """
+        guard = stage_guard or (lambda covered: nullcontext())
+        results = {}
+        deep_stages, open_ports, args = self._prepare_deep(target, stages, open_ports)
+        if args is None:
+            return {stage: [] for stage in deep_stages}
+        
+        print(f"\n🔍 COMBINED SCAN: {', '.join(stage.replace('_', ' ') for stage in deep_stages)}")
+        print("-" * 40)
+        print(f"Target: {target}")
+        
+        try:
+            with guard(deep_stages):
+                run = self._run_deep(args, target, deep_stages, 'deep_scan', open_ports)
+            
+            results = self._complete_combined(target, deep_stages, run)
+            if run.interrupted:
+                raise KeyboardInterrupt
+                
+        except KeyboardInterrupt:
+            raise
+        except Exception as e:
+            print(f"❌ Error during combined scan: {e}")
+        return results
+    
+    def _prepare_deep(self, target, stages, open_ports):
+        """
+        Shared start of deep_scan() and AsyncNetworkScanner.scan_deep().
+        
+        Drops the stages that cannot run here, applies deep_port_filter and
+        plans the merged run. When there is nothing to probe the stages are
+        recorded as finished with no results and no run is needed.
+        
+        Returns:
+            tuple: (deep stages, open ports, nmap args); args is None when no
+            nmap run is needed
+        """
+        deep_stages = [stage for stage in self.STAGES if stage in stages and stage != 'port_scan']
+        deep_stages = self._skip_unrunnable(target, deep_stages)
+        if not deep_stages:
+            return [], open_ports, None
+        if open_ports and self.deep_port_filter is not None:
+            open_ports = self.deep_port_filter(target, open_ports)
+        args = self.plan_deep_scan(deep_stages, open_ports)
+        if args is None:
+            print(f"\nℹ️  Nothing to probe on {target}; skipping {', '.join(deep_stages)}")
+            for stage in deep_stages:
+                self._record_result(stage, target, [], ran=False)
+        return deep_stages, open_ports, args
+    
+    def _complete_combined(self, target, deep_stages, run):
+        """Split a merged deep-scan run back into its per-stage sections."""
+        results = {}
+        for stage in deep_stages:
+            script_filter = None
+            if stage == 'vulnerability_scan':
+                script_filter = self._is_vuln_script
+            elif stage == 'service_detection' and 'vulnerability_scan' in deep_stages:
+                script_filter = lambda script_id: not self._is_vuln_script(script_id)
+            elif stage == 'os_detection':
+                # OS detection runs no scripts of its own
+                script_filter = lambda script_id: False
+            section = self._complete_stage(stage, f"Combined scan ({stage.replace('_', ' ')})", target, run,
+                                           script_filter=script_filter, reraise=False, combined=True)
+            if section is None:
+                break
+            results[stage] = run.hosts
+        return results
+    
+    def save_results(self, filename=None):
+        """Save scan results to a file."""
+        if not filename:
+            timestamp = self.start_time.strftime("%Y%m%d_%H%M%S")
+            filename = f"nmap_scan_results_{timestamp}.json"
+        
+        try:
+            # A .gz name writes gzip-compressed, unindented JSON
+            if filename.endswith('.gz'):
+                with gzip.open(filename, 'wt', encoding='utf-8') as f:
+                    json.dump(self.scan_results.to_dict(), f, separators=(',', ':'), default=str)
+            else:
+                with open(filename, 'w') as f:
+                    json.dump(self.scan_results.to_dict(), f, indent=2, default=str)
+            
+            print(f"\n💾 Results saved to: {filename}")
+            return filename
+            
+        except Exception as e:
+            print(f"❌ Error saving results: {e}")
+            return None
+    
+    def generate_summary(self):
+        """Generate a summary of scan results."""
+        print(f"\n{'='*60}")
+        print("SCAN SUMMARY")
+        print('='*60)
+        
+        end_time = datetime.now()
+        duration = end_time - self.start_time
+        
+        print(f"Scan Duration: {duration}")
+        print(f"Start Time: {self.start_time}")
+        print(f"End Time: {end_time}")
+        
+        results = self.scan_results
+        if 'host_discovery' in results.stages:
+            print(f"Live Hosts Found: {len(results.live_hosts)}")
+            
+        if 'port_scan' in results.stages:
+            print(f"Open Ports Found: {len(results.open_ports())}")
+        
+        if 'vulnerability_scan' in results.stages:
+            print(f"Vulnerable Findings: {len(results.vulnerable())}")
+        
+        if self.cache is not None:
+            stats = self.cache.stats
+            print(f"Cache: {stats['hits']} hits, {stats['misses']} misses "
+                  f"({stats['evicted']} expired entries evicted)")
+        
+        print(f"\nScans Performed:")
+        for scan_type in ScanResults.STAGES:
+            if scan_type in results.stages:
+                partial = ' (partial)' if results.stages[scan_type].partial else ''
+                print(f"  ✅ {scan_type.replace('_', ' ').title()}{partial}")
+        
+        self.metrics.report()
 
-def main():
+
+def load_inventory(filename):
+    """
+    Read an inventory file: one host, CIDR range or hostname per line,
+    followed by its tags (e.g. '10.0.5.0/24 critical dmz'). '#' starts a comment.
+    
+    Returns:
+        list: (ip_network or hostname, [tags]) in file order
+    """
+    entries = []
+    with open(filename) as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            try:
+                target = ipaddress.ip_network(fields[0], strict=False)
+            except ValueError:
+                target = fields[0]
+            entries.append((target, [tag.lower() for tag in fields[1:]]))
+    return entries
+
+
+class HostPrioritizer:
+    """
+    Orders hosts so the most valuable ones are scanned first.
+    
+    A host's score adds up its inventory tags (TAG_WEIGHTS) and what the
+    ScanStateDB knows about it: open ports seen before, recent changes, and
+    deep scans deferred by an earlier run that ran out of time. Hosts never
+    seen before get a small bonus. Ties keep discovery order.
+    """
+    TAG_WEIGHTS = {'critical': 100, 'high': 50, 'medium': 20, 'low': -20}
+    PORT_WEIGHT, MAX_PORT_SCORE = 5, 30
+    CHANGED_SCORE, DEFERRED_SCORE, NEW_HOST_SCORE = 25, 40, 10
+
+    def __init__(self, inventory=(), state_db=None, changed_within_hours=168):
+        self.inventory = list(inventory)
+        self.state_db = state_db
+        self.changed_within_hours = changed_within_hours
+
+    def _tags(self, address):
+        tags = []
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            ip = None
+        for target, entry_tags in self.inventory:
+            if (target == address) if isinstance(target, str) else (ip is not None and ip in target):
+                tags += [tag for tag in entry_tags if tag not in tags]
+        return tags
+
+    def scores(self, addresses):
+        """
+        Returns:
+            dict: address -> (score, [reasons])
+        """
+        facts = self.state_db.priority_facts(addresses, self.changed_within_hours) if self.state_db else {}
+        scores = {}
+        for address in addresses:
+            score, reasons = 0, []
+            for tag in self._tags(address):
+                score += self.TAG_WEIGHTS.get(tag, 0)
+                reasons.append(tag)
+            known = facts.get(address)
+            if known is not None:
+                if known['open_ports']:
+                    score += min(known['open_ports'] * self.PORT_WEIGHT, self.MAX_PORT_SCORE)
+                    reasons.append(f"{known['open_ports']} known open ports")
+                if known['recent_changes']:
+                    score += self.CHANGED_SCORE
+                    reasons.append('changed recently')
+                if known['deferred']:
+                    score += self.DEFERRED_SCORE
+                    reasons.append('deferred last run')
+            elif self.state_db is not None:
+                score += self.NEW_HOST_SCORE
+                reasons.append('new host')
+            scores[address] = (score, reasons)
+        return scores
+
+    def order(self, addresses):
+        """Addresses sorted by descending score (stable), plus the scores."""
+        scores = self.scores(addresses)
+        return sorted(addresses, key=lambda address: -scores[address][0]), scores
+
+
+def print_priorities(ordered, scores, limit=10):
+    """Print the head of the scan order with the reasons for each host's place."""
+    print(f"\n🎯 Scan order by priority ({len(ordered)} hosts):")
+    for address in ordered[:limit]:
+        score, reasons = scores[address]
+        print(f"  {score:>4}  {address:<18} {', '.join(reasons) or '-'}")
+    if len(ordered) > limit:
+        print(f"  ... {len(ordered) - limit} more")
+
+
+def system_nameservers():
+    """Nameservers from /etc/resolv.conf as (host, 53) tuples; empty if there is none."""
+    servers = []
+    try:
+        with open('/etc/resolv.conf') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    servers.append((fields[1].split('%', 1)[0], 53))
+    except OSError:
+        pass
+    return servers
+
+
+def parse_dns_server(value):
+    """'HOST', 'HOST:PORT' or '[IPv6]:PORT' -> (host, port)."""
+    if value.startswith('['):
+        host, _, port = value[1:].partition(']')
+        port = port.lstrip(':')
+    elif value.count(':') == 1:
+        host, port = value.split(':')
+    else:
+        host, port = value, ''
+    try:
+        ipaddress.ip_address(host)
+        return host, int(port or 53)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid DNS server: {value}")
+
+
+def _ptr_query(address, query_id):
+    """A recursive DNS query for the PTR record of an IP address."""
+    name = ipaddress.ip_address(address).reverse_pointer
+    qname = b''.join(bytes([len(label)]) + label.encode('ascii') for label in name.split('.')) + b'\0'
+    return struct.pack('>HHHHHH', query_id, 0x0100, 1, 0, 0, 0) + qname + struct.pack('>HH', 12, 1)
+
+
+def _read_dns_name(data, offset):
+    """Decode a (possibly compressed) name; returns (name, offset after it)."""
+    labels, end = [], None
+    for _ in range(128):  # bounds compression-pointer loops
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3F) << 8) | data[offset + 1]
+            continue
+        offset += 1
+        if length == 0:
+            break
+        labels.append(data[offset:offset + length].decode('ascii', 'replace'))
+        offset += length
+    return '.'.join(labels), end if end is not None else offset
+
+
+def _parse_ptr_response(data):
+    """
+    Returns:
+        tuple: (query id, rcode, question name or None, PTR name or None, TTL or None)
+    """
+    query_id, flags, questions, answers = struct.unpack('>HHHH', data[:8])
+    offset = 12
+    question = None
+    for _ in range(questions):
+        name, offset = _read_dns_name(data, offset)
+        question = name if question is None else question
+        offset += 4
+    for _ in range(answers):
+        _, offset = _read_dns_name(data, offset)
+        rtype, _, ttl, length = struct.unpack('>HHIH', data[offset:offset + 10])
+        offset += 10
+        if rtype == 12:
+            return query_id, flags & 0xF, question, _read_dns_name(data, offset)[0], ttl
+        offset += length
+    return query_id, flags & 0xF, question, None, None
+
+
+class _DNSClientProtocol(asyncio.DatagramProtocol):
+    """Matches DNS responses to pending queries by query id and question name."""
+
+    def __init__(self):
+        # query id -> (question name, future)
+        self.pending = {}
+
+    def datagram_received(self, data, addr):
+        try:
+            response = _parse_ptr_response(data)
+        except (struct.error, IndexError):
+            return
+        query_id, _, question = response[:3]
+        name, future = self.pending.get(query_id, (None, None))
+        # A response that echoes another question is stale or forged; keep waiting
+        if future is None or (question or '').lower() != name:
+            return
+        del self.pending[query_id]
+        if not future.done():
+            future.set_result(response)
+
+    def error_received(self, exc):
+        pass
+
+
+class PTRResolver:
+    """
+    Bounded, cached asyncio reverse-DNS resolver.
+    
+    Queries go straight to the nameservers over UDP (one socket per server,
+    responses matched by query id and question), at most `concurrency` at a
+    time, with `retries` retransmissions rotating through the servers. Without any
+    nameserver (e.g. no /etc/resolv.conf) it falls back to the system
+    resolver via getnameinfo() in the loop's thread pool.
+    """
+
+    def __init__(self, nameservers=None, concurrency=200, timeout=2.0, retries=2, cache=None):
+        self.nameservers = list(nameservers) if nameservers is not None else system_nameservers()
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.retries = retries
+        self.cache = cache if cache is not None else DNSCache()
+        self.stats = Counter()
+        self._semaphore = None
+        self._endpoints = {}
+
+    async def _endpoint(self, server):
+        if server not in self._endpoints:
+            family = socket.AF_INET6 if ':' in server[0] else socket.AF_INET
+            self._endpoints[server] = await asyncio.get_running_loop().create_datagram_endpoint(
+                _DNSClientProtocol, family=family)
+        return self._endpoints[server]
+
+    async def _query(self, address):
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            server = self.nameservers[attempt % len(self.nameservers)]
+            transport, protocol = await self._endpoint(server)
+            query_id = int.from_bytes(os.urandom(2), 'big')
+            while query_id in protocol.pending:
+                query_id = int.from_bytes(os.urandom(2), 'big')
+            future = loop.create_future()
+            protocol.pending[query_id] = (ipaddress.ip_address(address).reverse_pointer, future)
+            transport.sendto(_ptr_query(address, query_id), server)
+            self.stats['queries'] += 1
+            try:
+                return await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                protocol.pending.pop(query_id, None)
+        return None
+
+    async def _lookup(self, address):
+        """(answered, name, ttl) from the nameservers or the system resolver."""
+        if not self.nameservers:
+            try:
+                name, _ = await asyncio.wait_for(asyncio.get_running_loop().getnameinfo(
+                    (address, 0), socket.NI_NAMEREQD), self.timeout * (self.retries + 1))
+                return True, name, None
+            except socket.gaierror:
+                return True, None, None
+            except asyncio.TimeoutError:
+                return False, None, None
+        response = await self._query(address)
+        if response is None:
+            return False, None, None
+        _, rcode, _, name, ttl = response
+        # NOERROR without a PTR and NXDOMAIN are answers; SERVFAIL etc. are not
+        return rcode in (0, 3), name.rstrip('.') if name else None, ttl
+
+    async def resolve(self, address):
+        """The PTR name of an IP address, or None."""
+        hit, name = self.cache.get(address)
+        if hit:
+            self.stats['cached'] += 1
+            return name
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            answered, name, ttl = await self._lookup(address)
+        if answered:
+            self.cache.put(address, name, ttl)
+            self.stats['resolved' if name else 'no_name'] += 1
+        else:
+            self.stats['failed'] += 1
+        return name
+
+    async def resolve_many(self, addresses):
+        """{address: name or None} for many addresses, resolved concurrently."""
+        addresses = list(dict.fromkeys(addresses))
+        names = await asyncio.gather(*(self.resolve(address) for address in addresses))
+        return dict(zip(addresses, names))
+
+    def close(self):
+        for transport, _ in self._endpoints.values():
+            transport.close()
+        self._endpoints = {}
+
+
+class HostnameEnricher:
+    """
+    Host listener that resolves PTR names off the scan's critical path.
+    
+    Every live IP host reported by any stage is handed to a PTRResolver
+    running on its own event loop thread, while nmap (started with -n) keeps
+    scanning. finish() waits for the lookups and fills in HostRecord.hostname
+    for hosts nmap did not name.
+    """
+
+    def __init__(self, resolver):
+        self.resolver = resolver
+        self.started = time.monotonic()
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def __call__(self, stage, host):
+        if stage != 'rdns':
+            self._submit(host)
+
+    def _submit(self, host):
+        if not host.is_up or host.hostname:
+            return
+        try:
+            ipaddress.ip_address(host.address)
+        except ValueError:
+            return
+        with self._lock:
+            if host.address not in self._futures:
+                self._futures[host.address] = asyncio.run_coroutine_threadsafe(
+                    self.resolver.resolve(host.address), self._loop)
+
+    def finish(self, results, listeners=(), timeout=None):
+        """
+        Wait for the lookups and attach the names to `results`.
+        
+        Args:
+            listeners: Host listeners to pass renamed hosts to (stage 'rdns'),
+                e.g. the ScanStateDB
+        
+        Returns:
+            dict: address -> name for the hosts that got one
+        """
+        # Hosts recorded without the listener (e.g. by shard processes)
+        for host in list(results.hosts.values()):
+            self._submit(host)
+        with self._lock:
+            futures = dict(self._futures)
+        names = {}
+        for address, future in futures.items():
+            try:
+                name = future.result(timeout)
+            except Exception:
+                continue
+            if name:
+                names[address] = name
+        for address, name in names.items():
+            host = results.hosts.get(address)
+            if host is not None and not host.hostname:
+                host.hostname = name
+                for listener in listeners:
+                    listener('rdns', host)
+        stats = self.resolver.stats
+        print(f"\n🔤 Reverse DNS: {len(names)} of {len(futures)} hosts named "
+              f"({stats['cached']} from cache, {stats['failed']} unanswered) "
+              f"in {time.monotonic() - self.started:.1f}s")
+        return names
+
+    def close(self):
+        async def shutdown():
+            self.resolver.close()
+        if self._loop.is_running():
+            asyncio.run_coroutine_threadsafe(shutdown(), self._loop).result(5)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(5)
+        self.resolver.cache.close()
+
+
+def print_changes(changes, title="CHANGES SINCE LAST SCAN"):
+    """Print the changes recorded by ScanStateDB or found by diff_results(), grouped by kind."""
+    print(f"\n{'='*60}")
+    print(title)
+    print('='*60)
+    if not changes:
+        print("No changes.")
+        return
+    labels = {'host_new': '🆕 New hosts', 'host_up': '🔼 Back up', 'host_down': '🔽 Gone down',
+              'mac_changed': '🔀 MAC changed', 'port_opened': '🔓 Ports opened', 'port_closed': '🔒 Ports closed',
+              'service_changed': '🔄 Services changed', 'os_changed': '💻 OS changed',
+              'vuln_new': '🚨 New vulnerable findings', 'vuln_resolved': '✅ Resolved findings'}
+    for kind, label in labels.items():
+        entries = [change for change in changes if change['kind'] == kind]
+        if entries:
+            print(f"{label}: {len(entries)}")
+            for change in entries:
+                detail = f" {change['detail']}" if change['detail'] else ''
+                print(f"  {change['address']}{detail}")
+
+
+DIFF_FORMAT = 'nmap-scan-diff/1'
+
+
+def _host_view(results, host):
+    """
+    The parts of a host that a diff compares, in canonical form.
+    
+    Volatile data (RTTs, raw output, script text other than vulnerable
+    findings) is left out. Ports are only included when the host was
+    port-scanned, OS and findings only when those stages ran, so a stage
+    that did not run is never mistaken for a change.
+    """
+    stages = results.host_stages(host.address)
+    view = {'up': host.is_up, 'mac': host.mac}
+    if 'port_scan' in stages:
+        view['ports'] = {port.label: port.version_string or port.service or '' for port in host.open_ports}
+    if 'os_detection' in stages:
+        view['os'] = host.os_matches[0].name if host.os_matches else None
+    if 'vulnerability_scan' in stages:
+        view['vulns'] = sorted(f"{finding['port'] or 'host'} {finding['script']}"
+                               for finding in results.host_findings(host) if 'VULNERABLE' in finding['output'])
+    return view
+
+
+def index_results(results):
+    """
+    Index results by address for diffing.
+    
+    Returns:
+        dict: address -> (digest, view); hosts with equal digests are
+        identical for diff purposes and are skipped without a closer look
+    """
+    index = {}
+    for address, host in results.hosts.items():
+        view = _host_view(results, host)
+        digest = hashlib.blake2b(json.dumps(view, sort_keys=True).encode(), digest_size=16).digest()
+        index[address] = (digest, view)
+    return index
+
+
+def _scanned_networks(results):
+    """The networks a scan covered, for telling 'gone' from 'not scanned'."""
+    networks, names = [], set()
+    for info in results.stages.values():
+        for target in info.targets:
+            try:
+                network = ipaddress.ip_network(target, strict=False)
+            except ValueError:
+                names.add(target)
+                continue
+            if network.num_addresses == 1:
+                # Per-host stage targets: a set lookup instead of a range check
+                names.add(str(network.network_address))
+            else:
+                networks.append(network)
+    return networks, names
+
+
+def _diff_host(address, old, new):
+    changes = []
+
+    def change(kind, detail=''):
+        changes.append({'address': address, 'kind': kind, 'detail': detail})
+
+    if old['up'] and not new['up']:
+        change('host_down')
+    elif new['up'] and not old['up']:
+        change('host_up')
+    if old['mac'] and new['mac'] and old['mac'] != new['mac']:
+        change('mac_changed', f"{old['mac']} -> {new['mac']}")
+    if 'ports' in old and 'ports' in new:
+        before, after = old['ports'], new['ports']
+        for label in after.keys() - before.keys():
+            change('port_opened', f"{label} {after[label]}".strip())
+        for label in before.keys() - after.keys():
+            change('port_closed', label)
+        for label in before.keys() & after.keys():
+            if before[label] and after[label] and before[label] != after[label]:
+                change('service_changed', f"{label}: {before[label]} -> {after[label]}")
+    if old.get('os') and new.get('os') and old['os'] != new['os']:
+        change('os_changed', f"{old['os']} -> {new['os']}")
+    if 'vulns' in new:
+        known = set(old.get('vulns', ()))
+        for finding in new['vulns']:
+            if finding not in known:
+                change('vuln_new', finding)
+        if 'vulns' in old:
+            for finding in sorted(known - set(new['vulns'])):
+                change('vuln_resolved', finding)
+    return changes
+
+
+def diff_results(old, new):
+    """
+    Compare two ScanResults host by host.
+    
+    Both scans are indexed by address with a digest of each host's
+    comparable view (see index_results()); only hosts whose digests differ
+    are compared in detail, so two large scans that mostly agree diff in
+    roughly the time it takes to hash them. Hosts missing from the new scan
+    count as down only if the new scan covered their address.
+    
+    Returns:
+        list: change dicts ({'address', 'kind', 'detail'}), as produced by
+        ScanStateDB and printed by print_changes()
+    """
+    old_index, new_index = index_results(old), index_results(new)
+    changes = []
+    for address, (digest, view) in new_index.items():
+        before = old_index.get(address)
+        if before is None:
+            if view['up']:
+                changes.append({'address': address, 'kind': 'host_new', 'detail': ''})
+        elif before[0] != digest:
+            changes += _diff_host(address, before[1], view)
+
+    networks, names = _scanned_networks(new)
+    for address, (_, view) in old_index.items():
+        if address in new_index or not view['up']:
+            continue
+        covered = address in names
+        if not covered and networks:
+            try:
+                ip = ipaddress.ip_address(address)
+                covered = any(ip in network for network in networks)
+            except ValueError:
+                pass
+        if covered:
+            changes.append({'address': address, 'kind': 'host_down', 'detail': 'not seen'})
+    return changes
+
+
+def diff_report(changes, old_name=None, new_name=None, old=None, new=None):
+    """Compact, JSON-ready change report for diff_results() output."""
+    report = {'format': DIFF_FORMAT, 'summary': dict(Counter(change['kind'] for change in changes))}
+    for key, name, results in (('old', old_name, old), ('new', new_name, new)):
+        if name is not None or results is not None:
+            report[key] = {'source': name, 'hosts': len(results.hosts) if results is not None else None}
+    report['changes'] = changes
+    return report
+
+
+class _ThreadOutput(io.TextIOBase):
+    """
+    sys.stdout replacement that collects each worker thread's output
+    separately, so concurrent host scans print as whole blocks instead of
+    interleaved lines. Threads without a buffer write straight through.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def begin(self):
+        self.local.buffer = io.StringIO()
+
+    def end(self):
+        buffer = getattr(self.local, 'buffer', None)
+        self.local.buffer = None
+        if buffer is not None:
+            with self.lock:
+                self.stream.write(buffer.getvalue())
+                self.stream.flush()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is not None:
+            return buffer.write(text)
+        with self.lock:
+            return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+class ScanScheduler:
+    """
+    Runs the per-host scan stages for many hosts concurrently.
+    
+    Up to `max_workers` hosts are scanned at a time; each host runs its stages
+    in order. `stage_limits` caps how many hosts may be inside a given stage
+    at once (e.g. only two vulnerability scans in parallel), independent of
+    the overall worker count.
+    """
+    DEFAULT_STAGE_LIMITS = {'vulnerability_scan': 2}
+
+    def __init__(self, scanner, max_workers=1, stage_limits=None, merge=True):
+        self.scanner = scanner
+        self.merge = merge
+        self.max_workers = max(1, max_workers)
+        limits = dict(self.DEFAULT_STAGE_LIMITS)
+        limits.update(stage_limits or {})
+        self.stage_limits = {stage: min(limit, self.max_workers) for stage, limit in limits.items()}
+        self._semaphores = {stage: threading.BoundedSemaphore(limit)
+                            for stage, limit in self.stage_limits.items()}
+        self._total = 0
+        self._started = time.monotonic()
+        # (host, stage) pairs finished by an earlier, interrupted run (--resume)
+        self.completed = set()
+
+    def _stage_guard(self, stages):
+        """Hold the semaphores of every stage an nmap run covers (in a fixed order)."""
+        metrics = self.scanner.metrics
+        stack = ExitStack()
+        for stage in NetworkScanner.STAGES:
+            if stage in stages and stage in self._semaphores:
+                metrics.adjust_gauge('stage_waiting', stage, 1)
+                try:
+                    stack.enter_context(self._semaphores[stage])
+                finally:
+                    metrics.adjust_gauge('stage_waiting', stage, -1)
+        for stage in stages:
+            metrics.adjust_gauge('stage_active', stage, 1)
+            stack.callback(metrics.adjust_gauge, 'stage_active', stage, -1)
+        return stack
+
+    def _host_done(self):
+        """Update the host gauges and print overall progress with an ETA."""
+        metrics = self.scanner.metrics
+        metrics.adjust_gauge('scheduler_hosts', 'active', -1)
+        done = metrics.adjust_gauge('scheduler_hosts', 'done', 1)
+        if self._total < 2:
+            return
+        rate = done / max(time.monotonic() - self._started, 1e-6)
+        eta = (self._total - done) / rate
+        metrics.set_gauge('scheduler_eta_seconds', None, round(eta, 1))
+        print(f"   📈 {done}/{self._total} hosts done ({rate:.2f} hosts/s"
+              + (f", ~{eta:.0f}s left)" if done < self._total else ")"))
+
+    def _scan_host(self, host, stages, scan_type, output, open_ports=None):
+        self.scanner.metrics.adjust_gauge('scheduler_hosts', 'pending', -1)
+        stages = [stage for stage in stages if (host, stage) not in self.completed]
+        if self.scanner.out_of_time():
+            # The scan window closed before this host's turn
+            self.scanner._defer(host, stages)
+            return {}
+        self.scanner.metrics.adjust_gauge('scheduler_hosts', 'active', 1)
+        if output:
+            output.begin()
+        results = {}
+        try:
+            if self.merge:
+                results = self.scanner.scan_host(host, stages, scan_type, stage_guard=self._stage_guard,
+                                                 open_ports=open_ports)
+            else:
+                for index, stage in enumerate(stages):
+                    if self.scanner.out_of_time():
+                        self.scanner._defer(host, stages[index:])
+                        break
+                    with self._stage_guard([stage]):
+                        hosts = self.scanner.run_stage(stage, host, scan_type, open_ports=open_ports)
+                    if hosts is None:
+                        # Failed port scan: the deep stages have no ports to probe
+                        self.scanner._port_scan_failed(host, stages[index + 1:])
+                        break
+                    results[stage] = hosts
+        finally:
+            if output:
+                output.end()
+            self._host_done()
+        return results
+
+    def run(self, hosts, stages, scan_type='quick', open_ports=None):
+        """
+        Scan every host with the given stages.
+        
+        Args:
+            open_ports: Optional {host: PortRecords} found by a sweep; those
+                hosts skip the nmap port scan and the deep stages probe
+                these ports
+        
+        Returns:
+            dict: host -> {stage: list of HostRecords}
+        """
+        if not hosts or not stages:
+            return {}
+        if self.completed:
+            remaining = [host for host in hosts if any((host, stage) not in self.completed for stage in stages)]
+            if len(remaining) < len(hosts):
+                print(f"\n♻️  Resuming: {len(hosts) - len(remaining)} of {len(hosts)} hosts already done")
+            hosts = remaining
+            if not hosts:
+                return {}
+        open_ports = open_ports or {}
+        self._total, self._started = len(hosts), time.monotonic()
+        self.scanner.metrics.set_gauge('scheduler_hosts', 'pending', len(hosts))
+        self.scanner.metrics.set_gauge('scheduler_hosts', 'done', 0)
+
+        if self.max_workers == 1 or len(hosts) == 1:
+            return {host: self._scan_host(host, stages, scan_type, None, open_ports.get(host)) for host in hosts}
+
+        print(f"\n⚙️  Scanning {len(hosts)} hosts with {self.max_workers} parallel workers")
+        output = _ThreadOutput(sys.stdout)
+        original_stdout, sys.stdout = sys.stdout, output
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        results = {}
+        try:
+            futures = {executor.submit(self._scan_host, host, stages, scan_type, output, open_ports.get(host)): host
+                       for host in hosts}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            sys.stdout = original_stdout
+        return results
+
+
+class ScanPipeline:
+    """
+    Producer/consumer scan pipeline for network ranges.
+    
+    Host discovery streams live hosts into a pool of fast port-discovery
+    workers; hosts with open ports are handed to a pool of deep-scan workers
+    that run version detection, NSE scripts and OS detection against only
+    those ports. All three stages run at the same time, so the deep scan of
+    the first host overlaps discovery of the rest of the range.
+    """
+    _DONE = object()
+
+    def __init__(self, scanner, port_workers=4, deep_workers=4, stage_limits=None, queue_size=256):
+        self.scanner = scanner
+        self.port_workers = max(1, port_workers)
+        self.deep_workers = max(1, deep_workers)
+        self.scheduler = ScanScheduler(scanner, max_workers=self.deep_workers, stage_limits=stage_limits)
+        # Bounded queues give backpressure: discovery stalls instead of
+        # buffering an entire /16 of hosts ahead of slow deep scans
+        self.port_queue = queue.Queue(maxsize=queue_size)
+        self.deep_queue = queue.Queue(maxsize=queue_size)
+        self.counts = Counter()
+        self._deep_stages = []
+        # Port workers started by run(); none when nothing needs a port scan
+        self._port_threads = 0
+        self._counts_lock = threading.Lock()
+
+    def _count(self, key):
+        with self._counts_lock:
+            self.counts[key] += 1
+
+    def _discover(self, target):
+        run = NmapRun()
+        live = []
+        try:
+            for host in self.scanner.stream_nmap(['-sn'] + target_args(target),
+                                                     self.scanner._capped_timeout(STAGE_TIMEOUTS['host_discovery']),
+                                                     stage='host_discovery', run=run):
+                if host.is_up:
+                    live.append(host)
+                    self._count('discovered')
+                    if self._port_threads:
+                        self.port_queue.put(host.address)
+                        self.scanner.metrics.adjust_gauge('queue_depth', 'port_scan', 1)
+        finally:
+            self.scanner._record_result('host_discovery', target, live, partial=run.partial, pipeline=True)
+            for _ in range(self._port_threads):
+                self.port_queue.put(self._DONE)
+
+    def _port_worker(self, scan_type, output):
+        while True:
+            address = self.port_queue.get()
+            if address is self._DONE:
+                return
+            self.scanner.metrics.adjust_gauge('queue_depth', 'port_scan', -1)
+            output.begin()
+            try:
+                hosts = self.scanner.port_scan(address, scan_type, detect_services=False)
+            finally:
+                output.end()
+            self._count('port_scanned')
+            if hosts is None:
+                self.scanner._port_scan_failed(address, self._deep_stages)
+                continue
+            open_ports = [port for host in hosts for port in host.open_ports]
+            if open_ports and self._deep_stages:
+                self.deep_queue.put((address, open_ports))
+                self.scanner.metrics.adjust_gauge('queue_depth', 'deep_scan', 1)
+
+    def _deep_worker(self, stages, output):
+        while True:
+            item = self.deep_queue.get()
+            if item is self._DONE:
+                return
+            self.scanner.metrics.adjust_gauge('queue_depth', 'deep_scan', -1)
+            address, open_ports = item
+            output.begin()
+            try:
+                self.scanner.deep_scan(address, stages, open_ports, stage_guard=self.scheduler._stage_guard)
+            finally:
+                output.end()
+            self._count('deep_scanned')
+
+    def run(self, target, stages, scan_type='quick'):
+        """
+        Discover, port-scan and deep-scan a target range.
+        
+        Args:
+            stages: Stages to run on the live hosts. Hosts are port-scanned
+                when port_scan is among them or the deep stages need the
+                open ports; with neither, only discovery runs.
+        
+        Returns:
+            Counter: hosts discovered, port-scanned and deep-scanned
+        """
+        deep_stages = [stage for stage in NetworkScanner.STAGES if stage in stages and stage != 'port_scan']
+        self._deep_stages = deep_stages
+        self._port_threads = self.port_workers if 'port_scan' in stages or deep_stages else 0
+        print(f"\n⚙️  Pipeline: discovery"
+              + (f" -> port scan ({self.port_workers} workers)" if self._port_threads else "")
+              + (f" -> {', '.join(deep_stages)} ({self.deep_workers} workers)" if deep_stages else ""))
+
+        output = _ThreadOutput(sys.stdout)
+        original_stdout, sys.stdout = sys.stdout, output
+        try:
+            port_threads = [threading.Thread(target=self._port_worker, args=(scan_type, output), daemon=True)
+                            for _ in range(self._port_threads)]
+            deep_threads = [threading.Thread(target=self._deep_worker, args=(deep_stages, output), daemon=True)
+                            for _ in range(self.deep_workers if deep_stages else 0)]
+            for thread in port_threads + deep_threads:
+                thread.start()
+
+            self._discover(target)
+            for thread in port_threads:
+                thread.join()
+            for _ in deep_threads:
+                self.deep_queue.put(self._DONE)
+            for thread in deep_threads:
+                thread.join()
+        finally:
+            sys.stdout = original_stdout
+
+        print(f"\n✅ Pipeline complete: {self.counts['discovered']} hosts discovered, "
+              f"{self.counts['port_scanned']} port-scanned, {self.counts['deep_scanned']} deep-scanned")
+        return self.counts
+
+
+class AsyncNetworkScanner(NetworkScanner):
+    """
+    asyncio variant of NetworkScanner for embedding in async services.
+    
+    Every nmap run is an asyncio subprocess and every stage a coroutine, so a
+    single event loop can drive hundreds of concurrent nmap workers. Results
+    land in the same scan_results sections as the threaded scanner.
+    
+    Example:
+        scanner = AsyncNetworkScanner(concurrency=200)
+        await scanner.scan_targets(hosts, ['port_scan', 'service_detection'])
+    """
+
+    def __init__(self, concurrency=64, stage_limits=None, task_timeout=None, queue_size=None):
+        """
+        Args:
+            concurrency: Maximum number of hosts scanned at once
+            stage_limits: Optional {stage: N} caps, as for ScanScheduler
+            task_timeout: Optional overall time limit (seconds) per host
+            queue_size: Bound on hosts waiting for a worker (default 2x concurrency)
+        """
+        super().__init__()
+        self.concurrency = max(1, concurrency)
+        self.task_timeout = task_timeout
+        self.queue_size = queue_size or self.concurrency * 2
+        limits = dict(ScanScheduler.DEFAULT_STAGE_LIMITS)
+        limits.update(stage_limits or {})
+        self.stage_limits = {stage: min(limit, self.concurrency) for stage, limit in limits.items()}
+        self._stage_semaphores = None
+
+    def _semaphores(self):
+        # asyncio primitives must be created inside the running loop
+        if self._stage_semaphores is None:
+            self._stage_semaphores = {stage: asyncio.Semaphore(limit)
+                                      for stage, limit in self.stage_limits.items()}
+        return self._stage_semaphores
+
+    async def _acquire_stages(self, stages, stack):
+        for stage in self.STAGES:
+            if stage in stages and stage in self._semaphores():
+                await stack.enter_async_context(self._semaphores()[stage])
+
+    async def astream_nmap(self, args, timeout, stage=None, run=None):
+        """Async counterpart of stream_nmap(): yield HostRecords as nmap reports them."""
+        run = run if run is not None else NmapRun()
+        cmd = self._nmap_command(args, run)
+
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        stderr_task = asyncio.ensure_future(process.stderr.read())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        parser = self._xml_parser(stage)
+        raw = _RawCapture() if self.keep_raw_output else None
+        try:
+            while True:
+                remaining = deadline - loop.time()
+                try:
+                    if remaining <= 0:
+                        raise asyncio.TimeoutError
+                    chunk = await asyncio.wait_for(process.stdout.read(65536), remaining)
+                except asyncio.TimeoutError:
+                    run.timed_out = True
+                    break
+                if not chunk:
+                    break
+                if raw is not None:
+                    raw.append(chunk)
+                for host in parser.feed(chunk):
+                    run.hosts.append(host)
+                    self._emit_host(stage, host)
+                    yield host
+
+            if not run.timed_out:
+                await process.wait()
+                try:
+                    for host in parser.close():
+                        run.hosts.append(host)
+                        self._emit_host(stage, host)
+                        yield host
+                except ET.ParseError:
+                    if process.returncode == 0:
+                        raise
+        except asyncio.CancelledError:
+            run.interrupted = True
+            raise
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            stderr = await stderr_task
+            self._finish_run(run, process.returncode, stderr, parser, raw, stage)
+
+    async def arun_nmap(self, args, timeout, stage=None):
+        """Async counterpart of _run_nmap()."""
+        run = NmapRun()
+        async for _ in self.astream_nmap(args, timeout, stage=stage, run=run):
+            pass
+        return run
+
+    async def _arun_timed(self, args, target, stages, stage, scan_type='quick'):
+        """Async counterpart of _run_timed()."""
+        extra, timeout, budget = self._timing_plan(target, stages, scan_type)
+        timeout = self._capped_timeout(timeout)
+        if timeout <= 0:
+            return self._window_closed(target, stages)
+        started = time.monotonic()
+        run = await self.arun_nmap(args + extra + [target], timeout, stage=stage)
+        if budget is not None:
+            self.timing.record(target, stages, time.monotonic() - started, budget, run)
+        if run.timed_out and self.out_of_time():
+            self._defer(target, stages)
+        return run
+
+    async def discover(self, target):
+        """Host discovery stage; returns the live host addresses."""
+        run = await self.arun_nmap(['-sn'] + target_args(target), self._capped_timeout(STAGE_TIMEOUTS['host_discovery']),
+                                   stage='host_discovery')
+        run.hosts = [host for host in run.hosts if host.is_up]
+        self._complete_stage('host_discovery', 'Host discovery', target, run, reraise=False)
+        return [host.address for host in run.hosts]
+
+    async def scan_ports(self, target, scan_type='quick', detect_services=True):
+        """Port scan stage; returns the HostRecords, or None if the scan failed (as port_scan())."""
+        async with AsyncExitStack() as stack:
+            await self._acquire_stages(['port_scan'], stack)
+            run = await self._arun_timed(self._port_scan_args(scan_type, detect_services), target,
+                                         ['port_scan'], 'port_scan', scan_type)
+        section = self._complete_stage('port_scan', 'Port scan', target, run, reraise=False, scan_type=scan_type)
+        return run.hosts if section is not None else None
+
+    async def scan_deep(self, target, stages, open_ports=None):
+        """Merged deep stages for one host; returns {stage: HostRecords}."""
+        deep_stages, open_ports, args = self._prepare_deep(target, stages, open_ports)
+        if args is None:
+            return {stage: [] for stage in deep_stages}
+
+        async with AsyncExitStack() as stack:
+            await self._acquire_stages(deep_stages, stack)
+            key = self._cache_key(target, args, open_ports)
+            run = self._cached_run(key, 'deep_scan')
+            if run is None:
+                run = await self._arun_timed(args, target, deep_stages, 'deep_scan')
+                if key is not None and run.ok:
+                    self.cache.put(key, target, run.hosts)
+        return self._complete_combined(target, deep_stages, run)
+
+    async def scan_host_async(self, target, stages, scan_type='quick'):
+        """All requested per-host stages for one target, as in scan_host()."""
+        deep_stages = [stage for stage in self.STAGES if stage in stages and stage != 'port_scan']
+        results = {}
+        open_ports = None
+        if 'port_scan' in stages:
+            if self.out_of_time():
+                self._defer(target, [stage for stage in self.STAGES if stage in stages])
+                return results
+            hosts = await self.scan_ports(target, scan_type, detect_services=not deep_stages)
+            if hosts is None:
+                self._port_scan_failed(target, deep_stages)
+                return results
+            results['port_scan'] = hosts
+            open_ports = [port for host in hosts for port in host.open_ports]
+        if deep_stages:
+            if self.out_of_time():
+                self._defer(target, deep_stages)
+            else:
+                results.update(await self.scan_deep(target, deep_stages, open_ports))
+        return results
+
+    async def _worker(self, work, stages, scan_type, results):
+        while True:
+            target = await work.get()
+            try:
+                if target is None:
+                    return
+                self.metrics.adjust_gauge('queue_depth', 'async_work', -1)
+                self.metrics.adjust_gauge('scheduler_hosts', 'active', 1)
+                coro = self.scan_host_async(target, stages, scan_type)
+                if self.task_timeout:
+                    results[target] = await asyncio.wait_for(coro, self.task_timeout)
+                else:
+                    results[target] = await coro
+            except asyncio.TimeoutError:
+                print(f"⏱️ {target}: gave up after {self.task_timeout}s")
+                results[target] = None
+            except Exception as e:
+                print(f"❌ {target}: {e}")
+                results[target] = None
+            finally:
+                if target is not None:
+                    self.metrics.adjust_gauge('scheduler_hosts', 'active', -1)
+                    self.metrics.adjust_gauge('scheduler_hosts', 'done', 1)
+                work.task_done()
+
+    async def _run_workers(self, targets, stages, scan_type):
+        """
+        Feed targets (an iterable or async iterable) through `concurrency` workers.
+        
+        The work queue is bounded, so a fast producer (such as streaming host
+        discovery) waits for workers instead of queueing unbounded work.
+        Cancelling the calling task cancels every worker and kills their nmap
+        processes.
+        """
+        # Warm the NSE category cache off the loop; deep scans consult it
+        if any(stage in stages for stage in ('service_detection', 'vulnerability_scan')):
+            await asyncio.get_running_loop().run_in_executor(None, self.nse_scripts_in_category, 'vuln')
+
+        work = asyncio.Queue(maxsize=self.queue_size)
+        results = {}
+        workers = [asyncio.ensure_future(self._worker(work, stages, scan_type, results))
+                   for _ in range(self.concurrency)]
+        try:
+            if hasattr(targets, '__aiter__'):
+                async for target in targets:
+                    await work.put(target)
+                    self.metrics.adjust_gauge('queue_depth', 'async_work', 1)
+            else:
+                for target in targets:
+                    await work.put(target)
+                    self.metrics.adjust_gauge('queue_depth', 'async_work', 1)
+            for _ in workers:
+                await work.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        return results
+
+    async def scan_targets(self, targets, stages, scan_type='quick'):
+        """
+        Scan many targets concurrently.
+        
+        Returns:
+            dict: target -> {stage: HostRecords}, or None for failed targets
+        """
+        return await self._run_workers(targets, stages, scan_type)
+
+    async def run_pipeline(self, target, stages, scan_type='quick'):
+        """
+        Discover live hosts in a range and scan each as soon as it is found.
+        
+        As in ScanPipeline, hosts are port-scanned when port_scan is requested
+        or the deep stages need the open ports; with no stages only discovery
+        runs.
+        
+        Returns:
+            dict: host -> {stage: HostRecords}, or None for failed hosts
+        """
+        stages = list(stages)
+        if 'port_scan' not in stages and any(stage in self.STAGES for stage in stages):
+            # The deep stages are aimed at the open ports a port scan finds
+            stages.insert(0, 'port_scan')
+        live_hosts = []
+
+        async def live():
+            run = NmapRun()
+            try:
+                async for host in self.astream_nmap(['-sn'] + target_args(target),
+                                                    self._capped_timeout(STAGE_TIMEOUTS['host_discovery']),
+                                                    stage='host_discovery', run=run):
+                    if host.is_up:
+                        live_hosts.append(host)
+                        yield host.address
+            finally:
+                run.hosts = live_hosts
+                self._complete_stage('host_discovery', 'Host discovery', target, run, reraise=False)
+
+        return await self._run_workers(live(), stages, scan_type)
+
+
+def choose_hosts(live_hosts, spec):
+    """
+    Pick hosts for the detailed scans from a --hosts value.
+    
+    spec is 'all', 'first', or a comma list of 1-based indexes and addresses.
+    """
+    if spec == 'all':
+        return list(live_hosts)
+    if spec == 'first':
+        return list(live_hosts[:1])
+    chosen = []
+    for item in spec.split(','):
+        item = item.strip()
+        if item.isdigit() and 1 <= int(item) <= len(live_hosts):
+            host = live_hosts[int(item) - 1]
+        elif item in live_hosts:
+            host = item
+        else:
+            print(f"⚠️  Ignoring --hosts entry not among the live hosts: {item}")
+            continue
+        if host not in chosen:
+            chosen.append(host)
+    return chosen
+
+
+def parse_port_list(value):
+    """Parse a port list such as '22,80,8000-8100' (argparse type)."""
+    ports = set()
+    for part in value.split(','):
+        low, _, high = part.strip().partition('-')
+        if not low.isdigit() or (high and not high.isdigit()):
+            raise argparse.ArgumentTypeError(f"Invalid port list: {value}")
+        low, high = int(low), int(high or low)
+        if not 0 < low <= high <= 65535:
+            raise argparse.ArgumentTypeError(f"Invalid port range: {part}")
+        ports.update(range(low, high + 1))
+    return sorted(ports)
+
+
+def parse_stage_limits(values):
+    """Parse repeated STAGE=N command line values into a dict."""
+    limits = {}
+    for value in values or []:
+        stage, _, limit = value.partition('=')
+        if stage not in NetworkScanner.STAGES or not limit.isdigit() or int(limit) < 1:
+            raise argparse.ArgumentTypeError(f"Invalid stage limit: {value}")
+        limits[stage] = int(limit)
+    return limits
+
+
+def _build_parser():
+    """The command-line interface."""
     parser = argparse.ArgumentParser(description='Comprehensive Network Scanner using Nmap')
-    parser.add_argument('target', nargs='?', help='Target IP, hostname, or network range')
+    parser.add_argument('target', nargs='*', help='Target IPs, hostnames or network ranges')
+    parser.add_argument('-iL', '--target-file', action='append', default=[], metavar='FILE',
+                        help='Read targets from FILE, one or more per line (repeatable)')
+    parser.add_argument('--exclude', action='append', default=[], metavar='TARGETS',
+                        help='Comma-separated hosts or ranges to leave out (repeatable)')
+    parser.add_argument('--exclude-file', action='append', default=[], metavar='FILE',
+                        help='Read exclusions from FILE (repeatable)')
+    parser.add_argument('-y', '--yes', action='store_true',
+                        help='Never prompt: scan the local network without asking and all live hosts')
+    parser.add_argument('--hosts', metavar='SELECTION',
+                        help="Hosts to scan after discovery: 'all', 'first' or a list like '1,3,10.0.0.7'")
     parser.add_argument('--scan-type', choices=['quick', 'common', 'comprehensive', 'stealth', 'udp'], 
                         default='quick', help='Type of port scan to perform')
     parser.add_argument('--host-discovery', action='store_true', help='Perform host discovery only')
@@ -326,42 +2742,244 @@ def main():
     parser.add_argument('--vulnerability-scan', action='store_true', help='Perform vulnerability scanning')
     parser.add_argument('--all', action='store_true', help='Perform all scan types')
     parser.add_argument('--output', help='Output file for results')
+    parser.add_argument('--parallel', type=int, default=1, metavar='N',
+                        help='Number of hosts to scan concurrently (default: 1)')
+    parser.add_argument('--stage-limit', action='append', metavar='STAGE=N',
+                        help='Max hosts in a stage at once, e.g. vulnerability_scan=2 (repeatable)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Stream discovered hosts through port discovery into targeted deep scans')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='Run the pipeline on the asyncio scanner (--parallel sets concurrency)')
+    parser.add_argument('--stats-every', metavar='INTERVAL',
+                        help="Show nmap progress every INTERVAL (e.g. '10s') while a scan runs")
+    parser.add_argument('--live-output', metavar='FILE',
+                        help='Append each host to FILE (JSON lines) as soon as it completes')
+    parser.add_argument('--stream', metavar='FILE',
+                        help='Append every stage result to FILE as NDJSON while scanning (.gz or .zst to compress)')
+    parser.add_argument('--fsync-every', type=int, default=256, metavar='N',
+                        help='Flush and fsync --stream after N records (default: 256)')
+    parser.add_argument('--fsync-interval', type=float, default=2.0, metavar='SECONDS',
+                        help='Flush and fsync --stream at least every SECONDS (default: 2)')
+    parser.add_argument('--read-stream', metavar='FILE',
+                        help='Rebuild results from a --stream file, print the summary and save them (no scan)')
+    parser.add_argument('--resume', metavar='FILE',
+                        help='Checkpoint to the result stream FILE and, if it holds an interrupted scan, '
+                             'continue it, skipping finished hosts and stages')
+    parser.add_argument('--inventory', metavar='FILE',
+                        help="Host tags such as '10.0.5.0/24 critical' used to scan valuable hosts first")
+    parser.add_argument('--time-budget', type=float, metavar='MINUTES',
+                        help='Stop starting new work after MINUTES and cut running scans off; the rest is deferred')
+    parser.add_argument('--diff', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Compare two saved results (JSON, .gz or streams), print the changes and exit; '
+                             '--output saves the change report')
+    parser.add_argument('--index', nargs='+', metavar='RESULTS',
+                        help='Load saved results or streams into the query index (see --index-db)')
+    parser.add_argument('--index-db', metavar='FILE',
+                        help='SQLite file holding the query index (default: in memory)')
+    parser.add_argument('--query', type=parse_query, metavar='EXPR',
+                        help="Query the index, e.g. 'port=3389' or 'product=openssh version<8.0', and exit")
+    parser.add_argument('--metrics-file', metavar='FILE',
+                        help='Write per-stage scan metrics to FILE in Prometheus text format while scanning')
+    parser.add_argument('--metrics-interval', type=float, default=15.0, metavar='SECONDS',
+                        help='How often --metrics-file is rewritten (default: 15)')
+    parser.add_argument('--keep-raw', action='store_true',
+                        help="Keep nmap's raw XML output in the saved results")
+    parser.add_argument('--no-merge', action='store_true',
+                        help='Run every stage as its own nmap invocation instead of merging them per host')
+    parser.add_argument('--sweep', action='store_true',
+                        help='Find live hosts and open ports with a fast asyncio TCP connect sweep instead of nmap')
+    parser.add_argument('--sweep-ports', type=parse_port_list, metavar='PORTS',
+                        help="Ports for --sweep, e.g. '22,80,443,8000-8100' (default: 20 common ports)")
+    parser.add_argument('--sweep-concurrency', type=int, default=1000, metavar='N',
+                        help='Maximum concurrent connects for --sweep (default: 1000)')
+    parser.add_argument('--sweep-timeout', type=float, default=1.0, metavar='SECONDS',
+                        help='Initial connect timeout for --sweep; adapts to measured RTTs (default: 1.0)')
+    parser.add_argument('--adaptive-timing', action='store_true',
+                        help='Fit nmap timing and per-host time budgets to the RTTs measured during discovery')
+    parser.add_argument('--budget-scale', type=float, metavar='X',
+                        help='Multiply the adaptive per-host time budgets by X (default: 1.0, '
+                             'requires --adaptive-timing)')
+    parser.add_argument('--rdns', action='store_true',
+                        help='Resolve hostnames concurrently next to the scan instead of in nmap (which runs with -n)')
+    parser.add_argument('--rdns-cache', metavar='FILE',
+                        help='SQLite file caching reverse-DNS answers across runs (implies --rdns)')
+    parser.add_argument('--rdns-ttl', type=float, default=24.0, metavar='HOURS',
+                        help='Longest time a reverse-DNS answer is cached (default: 24)')
+    parser.add_argument('--dns-server', action='append', type=parse_dns_server, metavar='SERVER[:PORT]',
+                        help='Nameserver for reverse-DNS lookups (repeatable; default: /etc/resolv.conf)')
+    parser.add_argument('--rdns-concurrency', type=int, default=200, metavar='N',
+                        help='Maximum reverse-DNS queries in flight (default: 200)')
+    parser.add_argument('--rdns-timeout', type=float, default=2.0, metavar='SECONDS',
+                        help='Reverse-DNS query timeout per attempt (default: 2.0)')
+    parser.add_argument('--cache', metavar='FILE',
+                        help='Reuse deep-scan results from FILE when a host shows the same open ports')
+    parser.add_argument('--cache-ttl', type=float, default=12.0, metavar='HOURS',
+                        help='How long cached deep-scan results stay valid (default: 12)')
+    parser.add_argument('--state-db', metavar='FILE',
+                        help='SQLite database that keeps host/port/service/OS state across runs')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only rescan new, changed or stale hosts, and deep-scan only new open ports (needs --state-db)')
+    parser.add_argument('--max-age', type=float, default=24.0, metavar='HOURS',
+                        help='With --incremental, rescan hosts not scanned for HOURS (default: 24)')
+    parser.add_argument('--deep-max-age', type=float, default=168.0, metavar='HOURS',
+                        help='With --incremental, repeat deep stages on known open ports after HOURS (default: 168)')
+    parser.add_argument('--shards', type=int, metavar='N',
+                        help='Split CIDR targets into N balanced shards scanned by separate processes')
+    parser.add_argument('--processes', type=int, metavar='N',
+                        help='Worker processes for --shards (default: one per CPU)')
+    parser.add_argument('--queue-dir', metavar='DIR',
+                        help='Shared directory used as a work queue between scanner nodes')
+    queue_mode = parser.add_mutually_exclusive_group()
+    queue_mode.add_argument('--enqueue', action='store_true',
+                            help='Write --shards jobs for the target into --queue-dir and exit')
+    queue_mode.add_argument('--worker', action='store_true',
+                            help='Scan jobs from --queue-dir until it is empty')
+    queue_mode.add_argument('--collect', action='store_true',
+                            help='Merge all finished jobs in --queue-dir into one results file')
+    return parser
+
+
+def _run_diff(args):
+    """--diff: compare two saved results and print (and optionally save) the changes."""
+    try:
+        old, new = (ScanResults.load(filename) for filename in args.diff)
+    except (OSError, ValueError, RuntimeError) as e:
+        print(f"❌ Cannot load results: {e}")
+        sys.exit(1)
+    changes = diff_results(old, new)
+    print_changes(changes, title=f"CHANGES: {args.diff[0]} -> {args.diff[1]}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(diff_report(changes, args.diff[0], args.diff[1], old, new), f, separators=(',', ':'))
+        print(f"\n💾 Change report saved to: {args.output}")
+
+
+def _run_index(args):
+    """--index / --query: load results into the query index and run a query against it."""
+    if args.query is not None and not args.index and not args.index_db:
+        print("❌ --query needs --index RESULTS and/or --index-db FILE")
+        sys.exit(1)
+    index = ResultIndex(args.index_db or ':memory:')
+    try:
+        for filename in args.index or []:
+            started = time.perf_counter()
+            try:
+                count = index.add_file(filename)
+            except (OSError, ValueError, RuntimeError) as e:
+                print(f"❌ Cannot index {filename}: {e}")
+                sys.exit(1)
+            print(f"🗂️  Indexed {count} hosts from {filename} in {time.perf_counter() - started:.1f}s")
+        if args.query is not None:
+            started = time.perf_counter()
+            try:
+                matches = index.query(**args.query)
+            except ValueError as e:
+                print(f"❌ {e}")
+                sys.exit(1)
+            elapsed = (time.perf_counter() - started) * 1000
+            hosts = len({match['address'] for match in matches})
+            print(f"\n🔎 {len(matches)} matches on {hosts} hosts ({elapsed:.1f} ms)")
+            print_matches(matches)
+            if args.output:
+                with open(args.output, 'w') as f:
+                    json.dump(matches, f, indent=2)
+                print(f"\n💾 Matches saved to: {args.output}")
+        else:
+            stats = index.stats()
+            print(f"\n🗂️  Index holds {stats['hosts']} hosts and {stats['ports']} ports "
+                  f"from {stats['sources']} result files")
+    finally:
+        index.close()
+
+
+def _run_read_stream(scanner, args):
+    """--read-stream: rebuild results from a result stream, summarize and save them."""
+    try:
+        scanner.scan_results = ScanResults.load(args.read_stream)
+    except (OSError, RuntimeError) as e:
+        print(f"❌ Cannot read result stream: {e}")
+        sys.exit(1)
+    if not scanner.scan_results.complete:
+        print("⚠️  Stream ends early (scan still running or interrupted); results cover what was written")
+    scanner.generate_summary()
+    scanner.save_results(args.output)
+
+
+def _run_collect(scanner, args):
+    """--collect: merge the finished jobs of a shard queue into one results file."""
+    work_queue = ShardQueue(args.queue_dir)
+    print(f"\n📥 Queue status: {work_queue.status()}")
+    scanner.scan_results = work_queue.collect()
+    scanner.generate_summary()
+    scanner.save_results(args.output)
+
+
+def _run_worker(args):
+    """--worker: scan shard jobs from the queue until it is empty."""
+    work_queue = ShardQueue(args.queue_dir)
+    print(f"\n👷 Worker {socket.gethostname()} processing {args.queue_dir}")
+    processed = work_queue.work()
+    print(f"✅ Processed {processed} jobs; queue status: {work_queue.status()}")
+
+
+def _resolve_targets(scanner, args):
+    """
+    Load the targets and exclusions, falling back to the local network
+    (after confirmation) when none are given.
     
-    args = parser.parse_args()
-    
-    # Display banner and warnings
-    print(f"\n{'='*60}")
-    print("🛡️  COMPREHENSIVE NETWORK SCANNER")
-    print('='*60)
-    print("⚠️  IMPORTANT LEGAL NOTICE:")
-    print("   Only use this tool on networks you own or have explicit permission to scan.")
-    print("   Unauthorized scanning may be illegal and violate terms of service.")
-    print('='*60)
-    
-    scanner = NetworkScanner()
-    
-    # Check if Nmap is installed
-    if not scanner.check_nmap_installation():
-        scanner.install_nmap_instructions()
+    Returns:
+        list: The targets to scan; exits when there is nothing to scan
+    """
+    try:
+        targets, address_count, nmap_exclude = load_targets(args.target, args.target_file,
+                                                            args.exclude, args.exclude_file)
+    except OSError as e:
+        print(f"❌ Cannot read target file: {e}")
         sys.exit(1)
+    if nmap_exclude:
+        # Only nmap itself can apply these; the sweep and shard workers cannot
+        if args.sweep or args.shards or args.enqueue:
+            print(f"❌ --sweep, --shards and --enqueue only take IP addresses and CIDR ranges as exclusions, "
+                  f"not: {', '.join(nmap_exclude)}")
+            sys.exit(1)
+        scanner.nmap_exclude = nmap_exclude
     
-    # Get target
-    if not args.target:
+    if not targets and (args.target or args.target_file):
+        print("❌ Every target was excluded; nothing to scan.")
+        sys.exit(1)
+    if not targets:
         network_range = scanner.get_local_network_info()
         print(f"\n🎯 No target specified. Using local network: {network_range}")
-        target = network_range
+        targets = [network_range]
         
         # Ask for confirmation
-        response = input("\nProceed with local network scan? (y/N): ").lower()
-        if response != 'y':
-            print("Scan cancelled.")
-            sys.exit(0)
-    else:
-        target = args.target
+        if not args.yes:
+            if not sys.stdin.isatty():
+                print("Scan cancelled: confirm the local network scan with --yes when not running interactively.")
+                sys.exit(0)
+            response = input("\nProceed with local network scan? (y/N): ").lower()
+            if response != 'y':
+                print("Scan cancelled.")
+                sys.exit(0)
     
-    print(f"\n🎯 Target: {target}")
+    if len(targets) == 1:
+        print(f"\n🎯 Target: {targets[0]}")
+    else:
+        shown = ', '.join(targets[:5]) + (f", ... ({len(targets) - 5} more)" if len(targets) > 5 else '')
+        print(f"\n🎯 Targets: {shown}")
+        if address_count:
+            print(f"   {address_count:,} addresses in {sum('/' in t for t in targets)} ranges after merging"
+                  f"{' and exclusions' if args.exclude or args.exclude_file else ''}")
+    return targets
+
+
+def _requested_stages(args):
+    """
+    Which stages the options ask for.
     
-    # Determine which scans to perform
+    Returns:
+        tuple: (run host discovery, run the port scan, per-host stages in order)
+    """
     if args.all:
         perform_host_discovery = True
         perform_port_scan = True
@@ -381,43 +2999,324 @@ def main():
             perform_host_discovery = True
             perform_port_scan = True
     
+    # Incremental scans decide what to rescan from the discovered hosts
+    if args.incremental:
+        perform_host_discovery = True
+    
+    stages = [stage for stage, enabled in (
+        ('port_scan', perform_port_scan),
+        ('service_detection', perform_service_detection),
+        ('os_detection', perform_os_detection),
+        ('vulnerability_scan', perform_vulnerability_scan),
+    ) if enabled]
+    return perform_host_discovery, perform_port_scan, stages
+
+
+def _sweep_hosts(scanner, args, target, state_db, record_ports):
+    """
+    --sweep: find live hosts and open ports with the TCP sweep.
+    
+    Returns:
+        tuple: (hosts for the deep stages, address -> open PortRecords)
+    """
+    # The sweep records every host it finds as just scanned, so look up what is fresh first
+    fresh = state_db.fresh_hosts(args.max_age) if args.incremental else set()
+    swept = scanner.tcp_sweep(target, ports=args.sweep_ports, concurrency=args.sweep_concurrency,
+                              timeout=args.sweep_timeout, record_ports=record_ports)
+    # The sweep already found the open ports; nmap only runs the deep stages on them
+    open_ports = {host.address: host.open_ports for host in swept}
+    candidates = [host.address for host in swept if host.open_ports]
+    selected_hosts = [address for address in candidates if address not in fresh]
+    if args.incremental:
+        state_db.mark_missing(target, [host.address for host in swept])
+        print(f"\n♻️  Incremental: rescanning {len(selected_hosts)} of {len(candidates)} hosts with open ports "
+              f"(new, changed or not scanned for {args.max_age:g}h)")
+    return selected_hosts, open_ports
+
+
+def _discover_hosts(scanner, args, target, targets, stages, completed, state_db, interactive):
+    """
+    Run (or, when resuming, reuse) host discovery and pick the hosts for the per-host stages.
+    
+    Returns:
+        list: The selected host addresses
+    """
+    if all((t, 'host_discovery') in completed for t in target_args(target)):
+        live_hosts = scanner.scan_results.live_hosts
+        print(f"\n♻️  Host discovery already done: {len(live_hosts)} live hosts")
+    else:
+        live_hosts = scanner.basic_host_discovery(target)
+    
+    if args.incremental:
+        discovery = scanner.scan_results.stages.get('host_discovery')
+        if discovery is not None and not discovery.partial:
+            state_db.mark_missing(target, live_hosts)
+        selected_hosts = state_db.hosts_to_rescan(live_hosts, args.max_age)
+        print(f"\n♻️  Incremental: rescanning {len(selected_hosts)} of {len(live_hosts)} live hosts "
+              f"(new, changed or not scanned for {args.max_age:g}h)")
+        return selected_hosts
+    if not any(_is_range(t) for t in targets):
+        return targets
+    # If scanning network ranges, choose which hosts to scan further
+    if len(live_hosts) <= 1 or not stages:
+        return live_hosts
+    if args.hosts:
+        return choose_hosts(live_hosts, args.hosts)
+    if not interactive:
+        return live_hosts
+    
+    print(f"\nFound {len(live_hosts)} live hosts:")
+    for i, host in enumerate(live_hosts):
+        print(f"  {i+1}. {host}")
+    
+    choice = input("\nEnter host number for detailed scan (or 'all' for all hosts): ").lower()
+    if choice == 'all':
+        return live_hosts
+    if choice.isdigit() and 1 <= int(choice) <= len(live_hosts):
+        return [live_hosts[int(choice)-1]]
+    print("Invalid choice. Scanning first host only.")
+    return [live_hosts[0]] if live_hosts else []
+
+
+def _report_deferred(deferred):
+    """Print the work a --time-budget left for the next run."""
+    print(f"\n⏸️  Time budget used up: deferred work on {len(deferred)} hosts to the next run")
+    for address, pending in list(deferred.items())[:10]:
+        print(f"  {address}: {', '.join(pending)}")
+    if len(deferred) > 10:
+        print(f"  ... {len(deferred) - 10} more")
+
+
+def _check_args(parser, args):
+    """Reject option combinations that cannot work; returns the parsed --stage-limit values."""
+    if (args.enqueue or args.worker or args.collect) and not args.queue_dir:
+        parser.error('--enqueue, --worker and --collect require --queue-dir')
+    if args.incremental and not args.state_db:
+        parser.error('--incremental requires --state-db')
+    if args.incremental and (args.pipeline or args.use_async or args.shards):
+        parser.error('--incremental cannot be combined with --pipeline, --async or --shards')
+    if args.budget_scale is not None and not args.adaptive_timing:
+        parser.error('--budget-scale requires --adaptive-timing')
+    if args.budget_scale is not None and args.budget_scale <= 0:
+        parser.error('--budget-scale must be greater than 0')
+    if args.resume and (args.pipeline or args.use_async or args.shards or args.sweep):
+        parser.error('--resume cannot be combined with --pipeline, --async, --shards or --sweep')
+    if args.resume and args.stream and args.stream != args.resume:
+        parser.error('--resume FILE already streams results to FILE; drop --stream or give it the same file')
+    try:
+        return parse_stage_limits(args.stage_limit)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+
+def main():
+    parser = _build_parser()
+    args = parser.parse_args()
+    stage_limits = _check_args(parser, args)
+    
+    # Display banner and warnings
+    print(f"\n{'='*60}")
+    print("🛡️  COMPREHENSIVE NETWORK SCANNER")
+    print('='*60)
+    print("⚠️  IMPORTANT LEGAL NOTICE:")
+    print("   Only use this tool on networks you own or have explicit permission to scan.")
+    print("   Unauthorized scanning may be illegal and violate terms of service.")
+    print('='*60)
+    
+    if args.use_async:
+        scanner = AsyncNetworkScanner(concurrency=max(args.parallel, 4), stage_limits=stage_limits)
+    else:
+        scanner = NetworkScanner()
+    scanner.stats_interval = args.stats_every
+    scanner.keep_raw_output = args.keep_raw
+    live_writer = None
+    if args.live_output:
+        live_writer = LiveHostWriter(args.live_output)
+        scanner.host_listeners.append(live_writer)
+    
+    if args.diff:
+        _run_diff(args)
+        return
+    if args.index or args.query is not None:
+        _run_index(args)
+        return
+    if args.read_stream:
+        _run_read_stream(scanner, args)
+        return
+    if args.collect:
+        _run_collect(scanner, args)
+        return
+    
+    # A sweep on its own never starts nmap
+    sweep_only = args.sweep and not (args.all or args.service_detection or args.os_detection
+                                     or args.vulnerability_scan)
+    
+    # Check if Nmap is installed
+    if not sweep_only and not scanner.check_nmap_installation():
+        scanner.install_nmap_instructions()
+        sys.exit(1)
+    
+    if args.worker:
+        _run_worker(args)
+        return
+    
+    # Prompts only make sense for a person at a terminal
+    interactive = sys.stdin.isatty() and not args.yes
+    
+    targets = _resolve_targets(scanner, args)
+    # One target stays a plain string; several are passed to nmap together
+    target = targets[0] if len(targets) == 1 else targets
+    perform_host_discovery, perform_port_scan, stages = _requested_stages(args)
+    
+    # Split the target for multi-process / multi-node scans
+    shards = None
+    if args.shards or args.enqueue:
+        try:
+            shards = shard_targets(targets, args.shards or os.cpu_count() or 1)
+        except ValueError as e:
+            print(f"❌ Sharding needs IP addresses or CIDR ranges: {e}")
+            sys.exit(1)
+        
+        if args.enqueue:
+            names = ShardQueue(args.queue_dir).enqueue(shards, stages, args.scan_type,
+                                                       parallel=args.parallel, merge=not args.no_merge)
+            print(f"\n📤 Queued {len(names)} shard jobs in {args.queue_dir}")
+            return
+    
+    if args.cache:
+        scanner.cache = ScanCache(args.cache, ttl_hours=args.cache_ttl)
+    
+    timing = None
+    if args.adaptive_timing:
+        timing = TimingController(budget_scale=args.budget_scale or 1.0)
+        scanner.timing = timing
+        scanner.host_listeners.append(timing)
+    
+    completed = set()
+    if args.resume and os.path.exists(args.resume) and os.path.getsize(args.resume):
+        try:
+            scanner.scan_results, completed = load_checkpoint(args.resume)
+        except (OSError, RuntimeError) as e:
+            print(f"❌ Cannot read checkpoint: {e}")
+            sys.exit(1)
+        print(f"\n♻️  Resuming from {args.resume}: {len(scanner.scan_results.hosts)} hosts recorded, "
+              f"{len(completed)} finished host stages")
+    
+    stream = None
+    if args.stream or args.resume:
+        try:
+            stream = ResultStreamWriter(args.stream or args.resume, fsync_every=args.fsync_every,
+                                        fsync_interval=args.fsync_interval)
+        except (OSError, RuntimeError) as e:
+            print(f"❌ Cannot open result stream: {e}")
+            sys.exit(1)
+        scanner.result_listeners.append(stream)
+        # Raw output goes to the stream only instead of piling up in memory
+        scanner.retain_raw = False
+    
+    enricher = None
+    if args.rdns or args.rdns_cache:
+        try:
+            cache = DNSCache(args.rdns_cache or ':memory:', max_ttl_hours=args.rdns_ttl)
+        except Exception as e:
+            print(f"❌ Cannot open reverse-DNS cache: {e}")
+            sys.exit(1)
+        resolver = PTRResolver(args.dns_server, concurrency=args.rdns_concurrency,
+                               timeout=args.rdns_timeout, cache=cache)
+        enricher = HostnameEnricher(resolver)
+        scanner.host_listeners.append(enricher)
+        scanner.nmap_dns = False
+    
+    exporter = None
+    if args.metrics_file:
+        exporter = PrometheusExporter(scanner.metrics, args.metrics_file, args.metrics_interval).start()
+    
+    state_db = None
+    if args.state_db:
+        state_db = ScanStateDB(args.state_db)
+        state_db.begin_run(target, stages)
+        scanner.host_listeners.append(state_db)
+        if args.incremental:
+            scanner.deep_port_filter = lambda host, ports: state_db.ports_needing_deep_scan(host, ports, args.deep_max_age)
+    
+    prioritizer = None
+    if args.inventory or state_db:
+        try:
+            inventory = load_inventory(args.inventory) if args.inventory else []
+        except OSError as e:
+            print(f"❌ Cannot read inventory: {e}")
+            sys.exit(1)
+        prioritizer = HostPrioritizer(inventory, state_db)
+    
+    if args.time_budget:
+        scanner.deadline = time.monotonic() + args.time_budget * 60
+        print(f"\n⏲️  Time budget: {args.time_budget:g} minutes")
+    
     # Perform scans
+    open_ports = None
+    finished = False
+    failed_shards = []
     try:
-        if perform_host_discovery:
-            live_hosts = scanner.basic_host_discovery(target)
-            
-            # If scanning a network range, ask which hosts to scan further
-            if '/' in target and len(live_hosts) > 1 and (perform_port_scan or perform_service_detection):
-                print(f"\nFound {len(live_hosts)} live hosts:")
-                for i, host in enumerate(live_hosts):
-                    print(f"  {i+1}. {host}")
-                
-                choice = input("\nEnter host number for detailed scan (or 'all' for all hosts): ").lower()
-                if choice == 'all':
-                    selected_hosts = live_hosts
-                elif choice.isdigit() and 1 <= int(choice) <= len(live_hosts):
-                    selected_hosts = [live_hosts[int(choice)-1]]
-                else:
-                    print("Invalid choice. Scanning first host only.")
-                    selected_hosts = [live_hosts[0]] if live_hosts else []
-            else:
-                selected_hosts = [target]
+        if shards:
+            scanner.scan_results = run_sharded_scan(shards, stages, args.scan_type, processes=args.processes,
+                                                    parallel=args.parallel, merge=not args.no_merge)
+            failed_shards = scanner.scan_results.stages['host_discovery'].extra.get('failed_shards', [])
+            if stream:
+                stream.dump(scanner.scan_results)
+            selected_hosts = []
+        elif args.sweep:
+            selected_hosts, open_ports = _sweep_hosts(scanner, args, target, state_db, perform_port_scan)
+            stages = [stage for stage in stages if stage != 'port_scan']
+        elif args.use_async:
+            asyncio.run(scanner.run_pipeline(target, stages, args.scan_type))
+            selected_hosts = []
+        elif args.pipeline:
+            workers = max(args.parallel, 4)
+            pipeline = ScanPipeline(scanner, port_workers=workers, deep_workers=workers,
+                                    stage_limits=stage_limits)
+            pipeline.run(target, stages, args.scan_type)
+            selected_hosts = []
+        elif perform_host_discovery:
+            selected_hosts = _discover_hosts(scanner, args, target, targets, stages, completed, state_db, interactive)
         else:
-            selected_hosts = [target]
+            selected_hosts = targets
+        
+        # Most valuable hosts first, so a time budget cuts off the least valuable work
+        if prioritizer and len(selected_hosts) > 1 and stages:
+            selected_hosts, scores = prioritizer.order(selected_hosts)
+            print_priorities(selected_hosts, scores)
         
         # Perform detailed scans on selected hosts
-        for host in selected_hosts:
-            if perform_port_scan:
-                scanner.port_scan(host, args.scan_type)
-            
-            if perform_service_detection:
-                scanner.service_version_detection(host)
-            
-            if perform_os_detection:
-                scanner.os_detection(host)
-            
-            if perform_vulnerability_scan:
-                scanner.vulnerability_scan(host)
+        scheduler = ScanScheduler(scanner, max_workers=args.parallel, stage_limits=stage_limits,
+                                  merge=not args.no_merge)
+        if completed:
+            scheduler.completed = completed
+            # Hosts whose port scan finished go straight to the deep stages on the ports it found
+            known = scanner.scan_results.hosts
+            open_ports = {host: known[host].open_ports for host in selected_hosts
+                          if (host, 'port_scan') in completed and host in known}
+        scheduler.run(selected_hosts, stages, args.scan_type, open_ports=open_ports)
+        
+        if scanner.deferred:
+            scanner.scan_results.deferred = scanner.deferred
+            _report_deferred(scanner.deferred)
+        if state_db and stages:
+            state_db.update_deferred(selected_hosts, scanner.deferred)
+        
+        if enricher:
+            names = enricher.finish(scanner.scan_results, [state_db] if state_db else [])
+            if stream:
+                stream.hostnames(names)
+        
+        if state_db:
+            scanner.scan_results.changes = state_db.changes()
+            print_changes(scanner.scan_results.changes)
+        
+        if timing:
+            timing.report()
+            scanner.scan_results.timings = timing.timings
+        
+        scanner.scan_results.metrics.update(scanner.metrics.to_dict())
         
         # Generate summary and save results
         scanner.generate_summary()
@@ -426,11 +3325,35 @@ def main():
             scanner.save_results(args.output)
         else:
             scanner.save_results()
+        finished = True
             
     except KeyboardInterrupt:
         print("\n\n⚡ Scan interrupted by user")
+        if scanner.scan_results:
+            print("💾 Saving partial results...")
+            scanner.save_results(args.output)
+        if stream:
+            print(f"▶️  Continue later with the same options and --resume {stream.filename}")
     except Exception as e:
         print(f"\n❌ Unexpected error: {e}")
+    finally:
+        if live_writer:
+            live_writer.close()
+        if enricher:
+            enricher.close()
+        if exporter:
+            exporter.close()
+        if stream:
+            stream.close(scanner.scan_results, complete=finished)
+        if state_db:
+            state_db.finish_run()
+            state_db.close()
+        if scanner.cache:
+            scanner.cache.close()
+    
+    if failed_shards:
+        print(f"\n❌ Shard scans failed for {' '.join(failed_shards)}; those hosts are missing from the results")
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""
+Network Scanner Benchmark
+Measures nmap_network_scanner.py performance without touching a real network:
+a stub `nmap` replays recorded or generated XML with configurable delays, and
+real TCP listeners on 127.0.0.0/8 exercise the native sweep.
+
+Measures:
+    - XML parse throughput (hosts/sec, MB/sec)
+    - Memory per host held in ScanResults
+    - Orchestration overhead per nmap invocation (vs. running the stub bare)
+    - End-to-end wall time at several --parallel levels
+    - TCP connect sweep throughput against local listeners
+
+Usage:
+    python nmap_scanner_bench.py [--quick] [--json] [--output FILE]
+                                 [--baseline FILE] [--tolerance 0.25]
+                                 [--replay scan.xml]
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+
+import nmap_network_scanner as scanner_module  # noqa: E402
+
+# One recorded host with the parts the parser cares about; {addr} and {last}
+# are filled in per host
+HOST_TEMPLATE = (
+    '<host starttime="1700000000" endtime="1700000010"><status state="up" reason="syn-ack" reason_ttl="64"/>\n'
+    '<address addr="{addr}" addrtype="ipv4"/>\n'
+    '<address addr="AA:BB:CC:DD:{last:02X}:01" addrtype="mac" vendor="Acme"/>\n'
+    '<hostnames><hostname name="host-{last}.lan" type="PTR"/></hostnames>\n'
+    '<ports><extraports state="closed" count="996"/>\n'
+    '<port protocol="tcp" portid="22"><state state="open" reason="syn-ack" reason_ttl="64"/>'
+    '<service name="ssh" product="OpenSSH" version="8.9p1" extrainfo="Ubuntu" method="probed" conf="10">'
+    '<cpe>cpe:/a:openbsd:openssh:8.9p1</cpe></service>'
+    '<script id="ssh-hostkey" output="256 aa:bb:cc (ECDSA)"/></port>\n'
+    '<port protocol="tcp" portid="80"><state state="open" reason="syn-ack" reason_ttl="64"/>'
+    '<service name="http" product="nginx" version="1.18.0" method="probed" conf="10"/>'
+    '<script id="http-title" output="Welcome"/></port>\n'
+    '<port protocol="tcp" portid="443"><state state="filtered" reason="no-response" reason_ttl="0"/>'
+    '<service name="https" method="table" conf="3"/></port>\n'
+    '<port protocol="udp" portid="53"><state state="open" reason="udp-response" reason_ttl="64"/>'
+    '<service name="domain" product="dnsmasq" version="2.80"/>'
+    '<script id="vulners" output="CVE-2020-25681 VULNERABLE"/></port>\n'
+    '</ports>\n'
+    '<os><osmatch name="Linux 5.0 - 5.14" accuracy="96" line="1"><osclass type="general purpose" vendor="Linux" '
+    'osfamily="Linux" osgen="5.X" accuracy="96"><cpe>cpe:/o:linux:linux_kernel:5</cpe></osclass></osmatch></os>\n'
+    '<times srtt="812" rttvar="244" to="100000"/>\n'
+    '</host>\n'
+)
+
+XML_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n<!DOCTYPE nmaprun>\n'
+    '<nmaprun scanner="nmap" args="nmap {args}" start="1700000000" version="7.94" xmloutputversion="1.05">\n'
+    '<scaninfo type="syn" protocol="tcp" numservices="1000" services="1-1000"/>\n'
+)
+XML_FOOTER = ('<runstats><finished time="1700000010" elapsed="10.00" exit="success"/>'
+              '<hosts up="{count}" down="0" total="{count}"/></runstats>\n</nmaprun>\n')
+
+# Stub nmap: answers --version / --script-help, then streams one host per
+# target address (or replays BENCH_NMAP_REPLAY), sleeping BENCH_NMAP_DELAY
+# seconds per host
+STUB_NMAP = r'''#!{python}
+import ipaddress, os, sys, time
+HOST_TEMPLATE = {host_template!r}
+XML_HEADER = {xml_header!r}
+XML_FOOTER = {xml_footer!r}
+args = sys.argv[1:]
+if args[:1] == ['--version']:
+    print("Nmap version 7.94 ( https://nmap.org )")
+    sys.exit(0)
+if args[:1] == ['--script-help']:
+    print("\nvulners\nCategories: vuln safe external\n")
+    sys.exit(0)
+delay = float(os.environ.get('BENCH_NMAP_DELAY', '0'))
+out = sys.stdout
+replay = os.environ.get('BENCH_NMAP_REPLAY')
+if replay:
+    with open(replay) as f:
+        for line in f:
+            if line.startswith('<host'):
+                time.sleep(delay)
+            out.write(line)
+    sys.exit(0)
+with_value = {{'-p', '--top-ports', '--script', '-oX', '--stats-every', '--min-rate', '--max-retries',
+              '--host-timeout', '--max-parallelism', '--initial-rtt-timeout', '--max-rtt-timeout'}}
+targets, skip = [], False
+for arg in args:
+    if skip:
+        skip = False
+    elif arg in with_value:
+        skip = True
+    elif not arg.startswith('-'):
+        targets.append(arg)
+out.write(XML_HEADER.format(args=' '.join(args)))
+count = 0
+for target in targets:
+    try:
+        addresses = [str(a) for a in ipaddress.ip_network(target, strict=False)]
+    except ValueError:
+        addresses = [target]
+    for address in addresses:
+        time.sleep(delay)
+        if '-sn' in args:
+            out.write('<host><status state="up" reason="arp-response"/><address addr="%s" addrtype="ipv4"/>'
+                      '<times srtt="812" rttvar="244" to="100000"/></host>\n' % address)
+        else:
+            out.write(HOST_TEMPLATE.format(addr=address, last=count % 256))
+        out.flush()
+        count += 1
+out.write(XML_FOOTER.format(count=count))
+'''
+
+# Metrics where a larger value is better; everything else is lower-is-better
+HIGHER_IS_BETTER = {'hosts_per_sec', 'mb_per_sec', 'speedup', 'connects_per_sec'}
+# Absolute changes below these are timer noise, whatever the percentage
+NOISE_FLOOR = {'_ms': 5.0, 'seconds': 0.05, 'bytes_per_host': 64}
+
+
+def synthetic_xml(host_count):
+    """nmap XML with `host_count` copies of HOST_TEMPLATE."""
+    parts = [XML_HEADER.format(args='-sV -O bench')]
+    for index in range(host_count):
+        parts.append(HOST_TEMPLATE.format(addr=f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}",
+                                          last=index & 255))
+    parts.append(XML_FOOTER.format(count=host_count))
+    return ''.join(parts).encode('utf-8')
+
+
+def install_stub(directory):
+    """Write the stub nmap into `directory` and put it first on PATH."""
+    path = os.path.join(directory, 'nmap')
+    with open(path, 'w') as f:
+        f.write(STUB_NMAP.format(python=sys.executable, host_template=HOST_TEMPLATE,
+                                 xml_header=XML_HEADER, xml_footer=XML_FOOTER))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    os.environ['PATH'] = directory + os.pathsep + os.environ.get('PATH', '')
+    return path
+
+
+def quiet():
+    """Context manager that discards the scanner's console output."""
+    return redirect_stdout(open(os.devnull, 'w'))
+
+
+def bench_parse(host_count, runs):
+    """Parse throughput of the incremental XML parser."""
+    data = synthetic_xml(host_count)
+    best = None
+    for _ in range(runs):
+        parser = scanner_module.NmapXMLParser()
+        start = time.perf_counter()
+        parsed = 0
+        for offset in range(0, len(data), 65536):
+            parsed += len(parser.feed(data[offset:offset + 65536]))
+        parsed += len(parser.close())
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    assert parsed == host_count, f"parsed {parsed} of {host_count} hosts"
+    return {
+        'hosts': host_count,
+        'seconds': round(best, 4),
+        'hosts_per_sec': round(host_count / best),
+        'mb_per_sec': round(len(data) / best / 1e6, 2),
+    }
+
+
+def bench_memory(host_count):
+    """Bytes of Python heap per host kept in ScanResults after parsing."""
+    data = synthetic_xml(host_count)
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    results = scanner_module.ScanResults()
+    parser = scanner_module.NmapXMLParser()
+    for offset in range(0, len(data), 65536):
+        results.add('port_scan', 'bench', parser.feed(data[offset:offset + 65536]))
+    results.add('port_scan', 'bench', parser.close())
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    serialized = len(json.dumps(results.to_dict(), separators=(',', ':')))
+    return {
+        'hosts': len(results.hosts),
+        'bytes_per_host': round((current - baseline) / host_count),
+        'peak_bytes_per_host': round((peak - baseline) / host_count),
+        'json_bytes_per_host': round(serialized / host_count),
+    }
+
+
+def bench_overhead(runs):
+    """Time per port_scan() call compared with running the stub directly."""
+    command = ['nmap', '-T4', '--top-ports', '1000', '10.0.0.1', '-oX', '-']
+    start = time.perf_counter()
+    for _ in range(runs):
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    bare = (time.perf_counter() - start) / runs
+
+    scanner = scanner_module.NetworkScanner()
+    start = time.perf_counter()
+    with quiet():
+        for _ in range(runs):
+            scanner.port_scan('10.0.0.1', 'quick', detect_services=False)
+    wrapped = (time.perf_counter() - start) / runs
+    return {
+        'runs': runs,
+        'bare_ms': round(bare * 1000, 2),
+        'scanner_ms': round(wrapped * 1000, 2),
+        'overhead_ms': round((wrapped - bare) * 1000, 2),
+    }
+
+
+def bench_end_to_end(host_count, delay, levels):
+    """Discovery plus merged per-host stages over a range, at each parallelism level."""
+    network = f"10.1.0.0/{32 - (host_count - 1).bit_length()}"
+    stages = ['port_scan', 'service_detection', 'vulnerability_scan']
+    os.environ['BENCH_NMAP_DELAY'] = str(delay)
+    results = {}
+    try:
+        for level in levels:
+            scanner = scanner_module.NetworkScanner()
+            start = time.perf_counter()
+            with quiet():
+                hosts = scanner.basic_host_discovery(network)[:host_count]
+                scheduler = scanner_module.ScanScheduler(scanner, max_workers=level,
+                                                         stage_limits={'vulnerability_scan': level})
+                scheduler.run(hosts, stages)
+            elapsed = time.perf_counter() - start
+            results[f"parallel_{level}"] = {
+                'hosts': len(scanner.scan_results.hosts_in('port_scan')),
+                'seconds': round(elapsed, 3),
+            }
+    finally:
+        os.environ.pop('BENCH_NMAP_DELAY', None)
+    first = results[f"parallel_{levels[0]}"]['seconds']
+    for entry in results.values():
+        entry['speedup'] = round(first / entry['seconds'], 2)
+    return results
+
+
+def start_listeners(ports):
+    """Listening sockets on 127.0.0.1; returns them so they stay open."""
+    sockets = []
+    for port in ports:
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(('127.0.0.1', port))
+        sock.listen(128)
+        sockets.append(sock)
+    return sockets
+
+
+def bench_sweep(port_count, concurrency):
+    """TCP connect sweep of 127.0.0.1 against real local listeners."""
+    listeners = start_listeners([0, 0, 0])
+    open_ports = sorted(sock.getsockname()[1] for sock in listeners)
+    try:
+        low = max(1024, min(open_ports) - port_count // 2)
+        ports = sorted(set(range(low, low + port_count)) | set(open_ports))
+        sweep = scanner_module.TCPSweep(ports=ports, concurrency=concurrency)
+        start = time.perf_counter()
+        hosts = asyncio.run(sweep.run('127.0.0.1'))
+        elapsed = time.perf_counter() - start
+    finally:
+        for sock in listeners:
+            sock.close()
+    found = sorted(port.port for host in hosts for port in host.open_ports)
+    return {
+        'ports': len(ports),
+        'concurrency': sweep.concurrency,
+        'seconds': round(elapsed, 3),
+        'connects_per_sec': round(sweep.stats['probes'] / elapsed),
+        'listeners_found': all(port in found for port in open_ports),
+    }
+
+
+def flatten(results, prefix=''):
+    """{'a': {'b': 1}} -> {'a.b': 1} for numeric leaves."""
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(results, baseline, tolerance):
+    """List metrics that got worse than the baseline by more than `tolerance`."""
+    current = flatten(results['benchmarks'])
+    regressions = []
+    for name, old in flatten(baseline.get('benchmarks', {})).items():
+        new = current.get(name)
+        metric = name.rsplit('.', 1)[-1]
+        if new is None or not old or metric in ('hosts', 'runs', 'ports', 'concurrency'):
+            continue
+        if metric not in HIGHER_IS_BETTER and not metric.endswith(('seconds', '_ms', 'bytes_per_host')):
+            continue
+        floor = next((value for suffix, value in NOISE_FLOOR.items() if metric.endswith(suffix)), 0)
+        if abs(new - old) < floor:
+            continue
+        change = (new - old) / old
+        worse = change < -tolerance if metric in HIGHER_IS_BETTER else change > tolerance
+        if worse:
+            regressions.append({'metric': name, 'baseline': old, 'current': new, 'change': round(change, 3)})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark nmap_network_scanner.py with a stub nmap')
+    parser.add_argument('--quick', action='store_true', help='Smaller workloads, for a fast smoke run')
+    parser.add_argument('--json', action='store_true', help='Print machine-readable results')
+    parser.add_argument('--output', metavar='FILE', help='Also write the JSON results to FILE')
+    parser.add_argument('--baseline', metavar='FILE', help='Fail on regressions against a previous --output')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed relative slowdown before a metric counts as a regression (default: 0.25)')
+    parser.add_argument('--replay', metavar='XML',
+                        help='Recorded nmap XML the stub replays for every scan (default: generated hosts)')
+    parser.add_argument('--delay', type=float, default=0.02,
+                        help='Stub nmap delay per host in seconds for the end-to-end runs (default: 0.02)')
+    args = parser.parse_args()
+
+    sizes = {'parse_hosts': 2000 if args.quick else 20000, 'memory_hosts': 1000 if args.quick else 10000,
+             'overhead_runs': 5 if args.quick else 20, 'e2e_hosts': 16 if args.quick else 64,
+             'sweep_ports': 500 if args.quick else 5000}
+    levels = [1, 4, 16]
+
+    with tempfile.TemporaryDirectory(prefix='nmap_bench_') as stub_dir:
+        install_stub(stub_dir)
+        if args.replay:
+            os.environ['BENCH_NMAP_REPLAY'] = os.path.abspath(args.replay)
+        benchmarks = {
+            'parse': bench_parse(sizes['parse_hosts'], runs=3),
+            'memory': bench_memory(sizes['memory_hosts']),
+            'overhead': bench_overhead(sizes['overhead_runs']),
+            'end_to_end': bench_end_to_end(sizes['e2e_hosts'], args.delay, levels),
+            'sweep': bench_sweep(sizes['sweep_ports'], concurrency=500),
+        }
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'quick': args.quick,
+        'benchmarks': benchmarks,
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            results['regressions'] = compare(results, json.load(f), args.tolerance)
+    failed = bool(results.get('regressions')) or not benchmarks['sweep']['listeners_found']
+    results['ok'] = not failed
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        parse, memory, overhead = benchmarks['parse'], benchmarks['memory'], benchmarks['overhead']
+        print("⏱️  Network Scanner Benchmark")
+        print("=" * 60)
+        print(f"XML parse:        {parse['hosts_per_sec']:,} hosts/sec ({parse['mb_per_sec']} MB/sec, "
+              f"{parse['hosts']:,} hosts)")
+        print(f"Memory:           {memory['bytes_per_host']:,} bytes/host held, "
+              f"{memory['json_bytes_per_host']:,} bytes/host as JSON")
+        print(f"Per nmap run:     {overhead['scanner_ms']:.1f} ms (stub alone {overhead['bare_ms']:.1f} ms, "
+              f"overhead {overhead['overhead_ms']:.1f} ms)")
+        for name, entry in benchmarks['end_to_end'].items():
+            print(f"End-to-end {name.replace('parallel_', '--parallel '):<14} {entry['seconds']:.2f}s "
+                  f"for {entry['hosts']} hosts ({entry['speedup']}x)")
+        sweep = benchmarks['sweep']
+        status = '✅' if sweep['listeners_found'] else '❌ missed listeners'
+        print(f"TCP sweep:        {sweep['connects_per_sec']:,} connects/sec "
+              f"({sweep['ports']} ports, {sweep['concurrency']} concurrent) {status}")
+        if args.baseline:
+            if results['regressions']:
+                for regression in results['regressions']:
+                    print(f"❌ Regression: {regression['metric']} {regression['baseline']} -> "
+                          f"{regression['current']} ({regression['change']:+.0%})")
+            else:
+                print(f"✅ No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,706 @@
+"""
+Scan results for nmap_network_scanner: host/port records, the streaming
+nmap XML parser, ScanResults and reading saved results and result streams.
+"""
+
+import base64
+import gzip
+import io
+import json
+import os
+import threading
+import xml.etree.ElementTree as ET
+import zlib
+
+
+class PortRecord:
+    """A single port from nmap XML output, with its service and script results."""
+    __slots__ = ('port', 'protocol', 'state', 'reason', 'service', 'product',
+                 'version', 'extrainfo', 'tunnel', 'cpe', 'scripts')
+
+    def __init__(self, port, protocol, state, reason=None):
+        self.port = port
+        self.protocol = protocol
+        self.state = state
+        self.reason = reason
+        self.service = None
+        self.product = None
+        self.version = None
+        self.extrainfo = None
+        self.tunnel = None
+        self.cpe = []
+        self.scripts = {}
+
+    @property
+    def label(self):
+        return f"{self.port}/{self.protocol}"
+
+    @property
+    def version_string(self):
+        return ' '.join(part for part in (self.product, self.version, self.extrainfo) if part)
+
+    def to_dict(self, compact=False):
+        return _slots_dict(self, compact)
+
+    @classmethod
+    def from_dict(cls, data):
+        port = cls(data['port'], data['protocol'], data['state'], data.get('reason'))
+        _load_slots(port, data, ('service', 'product', 'version', 'extrainfo', 'tunnel', 'cpe', 'scripts'))
+        return port
+
+
+class OSMatch:
+    """An OS guess from nmap's -O fingerprinting."""
+    __slots__ = ('name', 'accuracy', 'vendor', 'family', 'generation', 'device_type', 'cpe')
+
+    def __init__(self, name, accuracy):
+        self.name = name
+        self.accuracy = accuracy
+        self.vendor = None
+        self.family = None
+        self.generation = None
+        self.device_type = None
+        self.cpe = []
+
+    def to_dict(self, compact=False):
+        return _slots_dict(self, compact)
+
+    @classmethod
+    def from_dict(cls, data):
+        match = cls(data['name'], data['accuracy'])
+        _load_slots(match, data, ('vendor', 'family', 'generation', 'device_type', 'cpe'))
+        return match
+
+
+class HostRecord:
+    """
+    A host from nmap XML output: addresses, ports, OS guesses and host scripts.
+    
+    `probed` maps protocol -> (low, high) port ranges the scan covered, as
+    listed in nmap's <scaninfo>; it is None when unknown and not saved.
+    """
+    __slots__ = ('address', 'address_type', 'mac', 'vendor', 'hostname', 'status',
+                 'reason', 'ports', 'os_matches', 'scripts', 'times', 'probed')
+
+    def __init__(self, address, address_type='ipv4'):
+        self.address = address
+        self.address_type = address_type
+        self.mac = None
+        self.vendor = None
+        self.hostname = None
+        self.status = 'unknown'
+        self.reason = None
+        self.ports = []
+        self.os_matches = []
+        self.scripts = {}
+        self.times = {}
+        self.probed = None
+
+    @property
+    def is_up(self):
+        return self.status == 'up'
+
+    def ports_in_state(self, state):
+        return [port for port in self.ports if port.state == state]
+
+    @property
+    def open_ports(self):
+        return self.ports_in_state('open')
+
+    def was_probed(self, protocol, port):
+        """Whether the scan that produced this record covered a port (False when unknown)."""
+        return any(low <= port <= high for low, high in (self.probed or {}).get(protocol, ()))
+
+    def to_dict(self, compact=False):
+        data = _slots_dict(self, compact)
+        data.pop('probed', None)
+        if self.ports or not compact:
+            data['ports'] = [port.to_dict(compact) for port in self.ports]
+        if self.os_matches or not compact:
+            data['os_matches'] = [match.to_dict(compact) for match in self.os_matches]
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        host = cls(data['address'], data.get('address_type', 'ipv4'))
+        _load_slots(host, data, ('mac', 'vendor', 'hostname', 'status', 'reason', 'scripts', 'times'))
+        host.ports = [PortRecord.from_dict(port) for port in data.get('ports', [])]
+        host.os_matches = [OSMatch.from_dict(match) for match in data.get('os_matches', [])]
+        return host
+
+    def merge(self, other):
+        """Fold a newer record of the same host (e.g. from a later stage) into this one."""
+        if other is self:
+            return
+        if other.status != 'unknown':
+            self.status, self.reason = other.status, other.reason
+        self.hostname = other.hostname or self.hostname
+        self.mac = other.mac or self.mac
+        self.vendor = other.vendor or self.vendor
+        ports = {(port.protocol, port.port): port for port in self.ports}
+        for port in other.ports:
+            known = ports.get((port.protocol, port.port))
+            if known is None:
+                self.ports.append(port)
+                continue
+            known.state, known.reason = port.state, port.reason
+            for slot in ('service', 'product', 'version', 'extrainfo', 'tunnel'):
+                value = getattr(port, slot)
+                if value is not None:
+                    setattr(known, slot, value)
+            known.cpe = port.cpe or known.cpe
+            known.scripts.update(port.scripts)
+        if other.os_matches:
+            self.os_matches = other.os_matches
+        self.scripts.update(other.scripts)
+        self.times.update(other.times)
+
+
+def _slots_dict(record, compact):
+    """A record's slots as a dict; compact drops None and empty values."""
+    data = {slot: getattr(record, slot) for slot in record.__slots__}
+    if compact:
+        data = {key: value for key, value in data.items() if value is not None and value != [] and value != {}}
+    return data
+
+
+def _load_slots(record, data, slots):
+    for slot in slots:
+        if slot in data:
+            setattr(record, slot, data[slot])
+
+
+def _port_ranges(services):
+    """Parse a <scaninfo services="1-1000,1025"> list into (low, high) ranges."""
+    ranges = []
+    for part in services.split(','):
+        low, _, high = part.partition('-')
+        if low.isdigit() and (not high or high.isdigit()):
+            ranges.append((int(low), int(high or low)))
+    return tuple(ranges)
+
+
+def _scripts_from(element):
+    """Collect NSE <script id=... output=...> children of an element."""
+    return {script.get('id'): script.get('output', '') for script in element.findall('script')}
+
+
+def _host_from_element(elem):
+    """Build a HostRecord from a completed <host> element."""
+    address, address_type, mac, vendor = None, None, None, None
+    for addr in elem.findall('address'):
+        addrtype = addr.get('addrtype')
+        if addrtype == 'mac':
+            mac, vendor = addr.get('addr'), addr.get('vendor')
+        elif address is None:
+            address, address_type = addr.get('addr'), addrtype
+
+    host = HostRecord(address or mac, address_type or 'mac')
+    host.mac = mac
+    host.vendor = vendor
+
+    status = elem.find('status')
+    if status is not None:
+        host.status = status.get('state', 'unknown')
+        host.reason = status.get('reason')
+
+    hostname = elem.find('hostnames/hostname')
+    if hostname is not None:
+        host.hostname = hostname.get('name')
+
+    for port_elem in elem.findall('ports/port'):
+        state = port_elem.find('state')
+        port = PortRecord(int(port_elem.get('portid')), port_elem.get('protocol'),
+                          state.get('state') if state is not None else 'unknown',
+                          state.get('reason') if state is not None else None)
+        service = port_elem.find('service')
+        if service is not None:
+            port.service = service.get('name')
+            port.product = service.get('product')
+            port.version = service.get('version')
+            port.extrainfo = service.get('extrainfo')
+            port.tunnel = service.get('tunnel')
+            port.cpe = [cpe.text for cpe in service.findall('cpe')]
+        port.scripts = _scripts_from(port_elem)
+        host.ports.append(port)
+
+    for osmatch in elem.findall('os/osmatch'):
+        match = OSMatch(osmatch.get('name'), int(osmatch.get('accuracy', 0)))
+        osclass = osmatch.find('osclass')
+        if osclass is not None:
+            match.vendor = osclass.get('vendor')
+            match.family = osclass.get('osfamily')
+            match.generation = osclass.get('osgen')
+            match.device_type = osclass.get('type')
+            match.cpe = [cpe.text for cpe in osclass.findall('cpe')]
+        host.os_matches.append(match)
+
+    hostscript = elem.find('hostscript')
+    if hostscript is not None:
+        host.scripts = _scripts_from(hostscript)
+
+    times = elem.find('times')
+    if times is not None:
+        host.times = {key: int(value) for key, value in times.attrib.items() if value.isdigit()}
+
+    return host
+
+
+class NmapXMLParser:
+    """
+    Incremental parser for nmap's XML output (-oX).
+    
+    Data is pushed in with feed() as it arrives; every completed <host> is
+    turned into a HostRecord and its element is dropped from the tree, so
+    memory stays flat no matter how many hosts the scan covers.
+    """
+
+    def __init__(self, on_progress=None):
+        self._parser = ET.XMLPullParser(events=('start', 'end'))
+        self._depth = 0
+        self._root = None
+        self.on_progress = on_progress
+        self.run_info = {}
+        self.scan_info = []
+        self.probed = {}
+        self.finished = {}
+        self.progress = {}
+
+    def feed(self, data):
+        """Feed a chunk of XML and return the HostRecords it completed."""
+        self._parser.feed(data)
+        return self._drain()
+
+    def close(self):
+        """Finish parsing and return any remaining HostRecords."""
+        self._parser.close()
+        return self._drain()
+
+    def _drain(self):
+        hosts = []
+        for event, elem in self._parser.read_events():
+            if event == 'start':
+                self._depth += 1
+                if self._depth == 1:
+                    self._root = elem
+                    self.run_info = dict(elem.attrib)
+                continue
+
+            self._depth -= 1
+            if elem.tag == 'host':
+                host = _host_from_element(elem)
+                host.probed = self.probed
+                hosts.append(host)
+            elif elem.tag == 'finished':
+                self.finished = dict(elem.attrib)
+            elif elem.tag == 'scaninfo':
+                # One per scanned protocol; 'services' can be a long port list
+                self.scan_info.append({key: value for key, value in elem.attrib.items() if key != 'services'})
+                self.probed[elem.get('protocol')] = _port_ranges(elem.get('services', ''))
+            elif elem.tag == 'taskprogress':
+                # Written by nmap's --stats-every while a task is running
+                self.progress = dict(elem.attrib)
+                if self.on_progress:
+                    self.on_progress(self.progress)
+
+            # Direct children of <nmaprun> are complete once they end
+            if self._depth == 1:
+                self._root.remove(elem)
+        return hosts
+
+
+class NmapRun:
+    """Outcome of one nmap invocation: parsed hosts plus how the process ended."""
+    __slots__ = ('command', 'hosts', 'returncode', 'stderr', 'timed_out',
+                 'interrupted', 'raw_output', 'run_info', 'scan_info', 'started')
+
+    def __init__(self):
+        self.command = None
+        self.hosts = []
+        self.returncode = None
+        self.stderr = ''
+        self.timed_out = False
+        self.interrupted = False
+        self.raw_output = None
+        self.run_info = {}
+        self.scan_info = []
+        self.started = None
+
+    @property
+    def partial(self):
+        return self.timed_out or self.interrupted
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.partial
+
+
+def iter_nmap_xml(source, chunk_size=65536):
+    """
+    Yield HostRecords from nmap XML.
+    
+    Args:
+        source: A file path, a file-like object or an XML string
+        chunk_size: Bytes/characters read per feed
+    """
+    if isinstance(source, str) and source.lstrip().startswith('<'):
+        source = io.StringIO(source)
+    close_after = isinstance(source, (str, os.PathLike))
+    stream = open(source, 'rb') if close_after else source
+
+    parser = NmapXMLParser()
+    try:
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            yield from parser.feed(chunk)
+        yield from parser.close()
+    finally:
+        if close_after:
+            stream.close()
+
+
+class StageInfo:
+    """What is known about one stage of a scan, apart from the hosts themselves."""
+    __slots__ = ('name', 'targets', 'partial', 'extra', 'scripts', 'raw')
+
+    def __init__(self, name):
+        self.name = name
+        self.targets = {}  # ordered set
+        self.partial = False
+        self.extra = {}
+        # NSE script ids this stage contributed (separates default from vuln scripts)
+        self.scripts = set()
+        # zlib-compressed raw nmap XML, one entry per run, when kept
+        self.raw = []
+
+
+class ScanResults:
+    """
+    All results of a scan, keyed by host.
+    
+    Every stage merges its HostRecords into one record per address, so ports,
+    services, OS guesses and script output accumulate across hosts and stages
+    instead of each stage keeping its own copy. Which stages saw a host is a
+    small bitmask per host. The per-stage views (open ports, services,
+    findings) are computed from the host records on demand.
+    """
+    STAGES = ('host_discovery', 'port_scan', 'service_detection', 'os_detection', 'vulnerability_scan')
+    FORMAT = 'nmap-scan-results/1'
+
+    def __init__(self):
+        self.hosts = {}
+        self.stages = {}
+        self.changes = []
+        # Per-host timing report from TimingController, when used
+        self.timings = {}
+        # ScanMetrics.to_dict() snapshot of the run (one per shard when merged)
+        self.metrics = {}
+        # address -> stages deferred when a --time-budget ran out
+        self.deferred = {}
+        # False for results rebuilt from a stream that never reached its end
+        self.complete = True
+        self._host_stages = {}
+        # Reentrant: the readers below take it and call each other
+        self._lock = threading.RLock()
+
+    def __bool__(self):
+        return bool(self.hosts or self.stages)
+
+    def add(self, stage, target, hosts, partial=False, raw=None, script_filter=None, **extra):
+        """
+        Merge a stage's HostRecords into the results.
+        
+        Args:
+            target: What the stage was run against
+            partial: The run timed out or was interrupted
+            raw: zlib-compressed raw nmap output to keep, or None
+            script_filter: Optional predicate selecting the script ids that
+                belong to this stage when one nmap run served several stages
+            **extra: Stage metadata such as scan_type
+        """
+        bit = 1 << self.STAGES.index(stage)
+        with self._lock:
+            info = self.stages.get(stage)
+            if info is None:
+                info = self.stages[stage] = StageInfo(stage)
+            info.targets.update(dict.fromkeys(target_args(target)))
+            info.partial = info.partial or partial
+            info.extra.update(extra)
+            if raw is not None:
+                info.raw.append(raw)
+            for host in hosts:
+                known = self.hosts.get(host.address)
+                if known is None:
+                    self.hosts[host.address] = host
+                else:
+                    known.merge(host)
+                self._host_stages[host.address] = self._host_stages.get(host.address, 0) | bit
+                script_ids = list(host.scripts) + [script_id for port in host.ports for script_id in port.scripts]
+                info.scripts.update(script_id for script_id in script_ids
+                                    if script_filter is None or script_filter(script_id))
+        return info
+
+    def stage_snapshot(self, stage):
+        """A stage's metadata (not its hosts) as a plain, consistent dict."""
+        with self._lock:
+            info = self.stages[stage]
+            return {'partial': info.partial, 'extra': dict(info.extra), 'scripts': sorted(info.scripts)}
+
+    def hosts_in(self, stage):
+        """HostRecords that the given stage reported."""
+        if stage not in self.STAGES:
+            return []
+        bit = 1 << self.STAGES.index(stage)
+        with self._lock:
+            return [self.hosts[address] for address, mask in self._host_stages.items() if mask & bit]
+
+    def host_stages(self, address):
+        with self._lock:
+            mask = self._host_stages.get(address, 0)
+        return [stage for index, stage in enumerate(self.STAGES) if mask & (1 << index)]
+
+    @property
+    def live_hosts(self):
+        with self._lock:
+            return [host.address for host in self.hosts_in('host_discovery') if host.is_up]
+
+    def open_ports(self):
+        with self._lock:
+            return [dict(port.to_dict(compact=True), host=host.address)
+                    for host in self.hosts_in('port_scan') for port in host.open_ports]
+
+    def _stage_scripts(self, stage, script_map):
+        scripts = self.stages[stage].scripts if stage in self.stages else set()
+        return {script_id: output for script_id, output in script_map.items() if script_id in scripts}
+
+    def services(self):
+        with self._lock:
+            return [dict(port.to_dict(compact=True), host=host.address,
+                         scripts=self._stage_scripts('service_detection', port.scripts))
+                    for host in self.hosts_in('service_detection') for port in host.open_ports]
+
+    def findings(self):
+        """NSE output from the vulnerability stage, one entry per script run."""
+        with self._lock:
+            return [finding for host in self.hosts_in('vulnerability_scan') for finding in self.host_findings(host)]
+
+    def host_findings(self, host):
+        """Vulnerability-stage NSE output for one HostRecord."""
+        findings = []
+        with self._lock:
+            for script_id, output in self._stage_scripts('vulnerability_scan', host.scripts).items():
+                findings.append({'host': host.address, 'port': None, 'script': script_id, 'output': output})
+            for port in host.ports:
+                for script_id, output in self._stage_scripts('vulnerability_scan', port.scripts).items():
+                    findings.append({'host': host.address, 'port': port.label, 'script': script_id,
+                                     'output': output})
+        return findings
+
+    def vulnerable(self):
+        return [finding for finding in self.findings() if 'VULNERABLE' in finding['output']]
+
+    def to_dict(self):
+        """Compact, JSON-ready form: each host appears once, empty fields are left out."""
+        with self._lock:
+            stages = {}
+            for name in self.STAGES:
+                info = self.stages.get(name)
+                if info is None:
+                    continue
+                entry = {'targets': list(info.targets), 'host_count': len(self.hosts_in(name))}
+                entry.update(info.extra)
+                if info.partial:
+                    entry['partial'] = True
+                if info.scripts:
+                    entry['scripts'] = sorted(info.scripts)
+                if info.raw:
+                    entry['raw_output'] = [base64.b64encode(raw).decode('ascii') for raw in info.raw]
+                stages[name] = entry
+            hosts = {}
+            for address, host in self.hosts.items():
+                data = host.to_dict(compact=True)
+                del data['address']
+                data['stages'] = self.host_stages(address)
+                hosts[address] = data
+            summary = {
+                'live_hosts': len(self.live_hosts),
+                'open_ports': len(self.open_ports()),
+                'vulnerable': len(self.vulnerable()),
+            }
+        data = {
+            'format': self.FORMAT,
+            'summary': summary,
+            'stages': stages,
+            'hosts': hosts,
+        }
+        if self.changes:
+            data['changes'] = self.changes
+        if self.timings:
+            data['timings'] = self.timings
+        if self.deferred:
+            data['deferred'] = self.deferred
+        if self.metrics:
+            data['metrics'] = self.metrics
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        """Rebuild results saved with to_dict()."""
+        results = cls()
+        for name, entry in data.get('stages', {}).items():
+            info = results.stages[name] = StageInfo(name)
+            info.targets = dict.fromkeys(entry.get('targets', []))
+            info.partial = entry.get('partial', False)
+            info.scripts = set(entry.get('scripts', []))
+            info.raw = [base64.b64decode(raw) for raw in entry.get('raw_output', [])]
+            info.extra = {key: value for key, value in entry.items()
+                          if key not in ('targets', 'host_count', 'partial', 'scripts', 'raw_output')}
+        for address, host_data in data.get('hosts', {}).items():
+            host = HostRecord.from_dict(dict(host_data, address=address))
+            results.hosts[address] = host
+            results._host_stages[address] = sum(1 << cls.STAGES.index(stage)
+                                                for stage in host_data.get('stages', []) if stage in cls.STAGES)
+        results.changes = list(data.get('changes', []))
+        results.timings = dict(data.get('timings', {}))
+        results.deferred = dict(data.get('deferred', {}))
+        results.metrics = dict(data.get('metrics', {}))
+        return results
+
+    @classmethod
+    def from_stream(cls, records):
+        """
+        Rebuild results from ResultStreamWriter records (see read_result_stream()).
+        
+        Returns:
+            ScanResults: with `complete` set to whether the last run written to
+            the stream reached its end record
+        """
+        results = cls()
+        results.complete = False
+        for record in records:
+            kind = record.get('type')
+            if kind == 'header':
+                # A run appended by --resume has to finish again
+                results.complete = False
+            elif kind == 'host':
+                # Script ownership comes from the stage record that follows
+                results.add(record['stage'], [], [HostRecord.from_dict(record['host'])],
+                            script_filter=lambda script_id: False)
+            elif kind == 'stage':
+                raw = base64.b64decode(record['raw_output']) if 'raw_output' in record else None
+                info = results.add(record['stage'], record.get('target', []), [], partial=record.get('partial', False),
+                                   raw=raw, **record.get('extra', {}))
+                info.scripts.update(record.get('scripts', []))
+            elif kind == 'hostnames':
+                for address, name in record['names'].items():
+                    if address in results.hosts:
+                        results.hosts[address].hostname = name
+            elif kind in ('end', 'stopped'):
+                results.complete = kind == 'end'
+                results.changes = list(record.get('changes', []))
+                results.timings = dict(record.get('timings', {}))
+                results.deferred = dict(record.get('deferred', {}))
+                results.metrics = dict(record.get('metrics', {}))
+        return results
+
+    @classmethod
+    def load(cls, filename):
+        """Load results written by save_results() (plain or .gz) or a result stream (.ndjson[.gz|.zst])."""
+        if '.ndjson' in filename or '.jsonl' in filename:
+            return cls.from_stream(read_result_stream(filename))
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(filename, 'rt', encoding='utf-8') as f:
+            return cls.from_dict(json.load(f))
+
+    def update(self, other):
+        """Merge another ScanResults (e.g. from a shard) into this one."""
+        for name, info in other.stages.items():
+            with self._lock:
+                mine = self.stages.get(name)
+                if mine is None:
+                    mine = self.stages[name] = StageInfo(name)
+                mine.targets.update(info.targets)
+                mine.partial = mine.partial or info.partial
+                mine.extra.update(info.extra)
+                mine.scripts |= info.scripts
+                mine.raw += info.raw
+        with self._lock:
+            for address, host in other.hosts.items():
+                known = self.hosts.get(address)
+                if known is None:
+                    self.hosts[address] = host
+                else:
+                    known.merge(host)
+                self._host_stages[address] = self._host_stages.get(address, 0) | other._host_stages.get(address, 0)
+        self.changes += other.changes
+        self.timings.update(other.timings)
+        self.deferred.update(other.deferred)
+        if other.metrics:
+            self.metrics.setdefault('shards', []).append(other.metrics)
+
+
+def target_args(target):
+    """nmap target arguments for a single target string or a list of targets."""
+    if isinstance(target, (list, tuple)):
+        return [str(item) for item in target]
+    return [target]
+
+
+def _open_stream(filename, mode):
+    """
+    Open a result stream for text append ('a') or read ('r').
+    
+    The compression follows the extension: .gz (gzip) or .zst (zstd, needs
+    the optional 'zstandard' package); anything else is plain text.
+    
+    Returns:
+        tuple: (text file, underlying binary file)
+    """
+    raw = open(filename, 'ab' if mode == 'a' else 'rb')
+    try:
+        if filename.endswith('.gz'):
+            # Appending starts a new gzip member; readers see one stream
+            stream = gzip.GzipFile(fileobj=raw, mode='ab' if mode == 'a' else 'rb')
+        elif filename.endswith('.zst'):
+            try:
+                import zstandard
+            except ImportError:
+                raise RuntimeError("zstd streams need the 'zstandard' package: pip install zstandard")
+            if mode == 'a':
+                stream = zstandard.ZstdCompressor().stream_writer(raw)
+            else:
+                stream = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+        else:
+            return io.TextIOWrapper(raw, encoding='utf-8'), raw
+    except Exception:
+        raw.close()
+        raise
+    return io.TextIOWrapper(stream, encoding='utf-8'), raw
+
+
+def read_result_stream(filename):
+    """
+    Yield the records of a result stream written by ResultStreamWriter.
+    
+    A stream cut short by a crash ends at the last complete line; a final
+    {'type': 'truncated'} record says so.
+    """
+    text, raw = _open_stream(filename, 'r')
+    truncated = False
+    try:
+        try:
+            for line in text:
+                if not line.endswith('\n'):
+                    truncated = True
+                    break
+                yield json.loads(line)
+        except (EOFError, OSError, ValueError, zlib.error):
+            # Compressed data or a line cut off mid-write
+            truncated = True
+        if truncated:
+            yield {'type': 'truncated'}
+    finally:
+        text.close()
+        raw.close()
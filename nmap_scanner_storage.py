@@ -0,0 +1,622 @@
+"""
+SQLite-backed storage for nmap_network_scanner: the persistent scan state,
+the deep-scan and reverse-DNS caches, and the query index over saved results.
+"""
+
+import argparse
+import hashlib
+import ipaddress
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+from nmap_scanner_results import HostRecord, ScanResults, target_args
+
+
+class ScanStateDB:
+    """
+    Persistent scan state in SQLite: hosts, ports, services and OS guesses
+    with first-seen / last-seen times, plus a log of changes per run.
+    
+    Registered as a host listener it records every host as it completes, so
+    it works with the threaded, pipeline and asyncio scanners alike. It also
+    drives incremental scans: which hosts are due for a rescan and which
+    open ports still need the deep stages.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY, started TEXT, finished TEXT, target TEXT, stages TEXT);
+        CREATE TABLE IF NOT EXISTS hosts (
+            address TEXT PRIMARY KEY, hostname TEXT, mac TEXT, vendor TEXT, status TEXT,
+            first_seen TEXT, last_seen TEXT, last_scanned TEXT, changed_at TEXT);
+        CREATE TABLE IF NOT EXISTS ports (
+            address TEXT, protocol TEXT, port INTEGER, state TEXT, service TEXT, product TEXT,
+            version TEXT, extrainfo TEXT, first_seen TEXT, last_seen TEXT, deep_scanned TEXT,
+            PRIMARY KEY (address, protocol, port));
+        CREATE TABLE IF NOT EXISTS os_matches (
+            address TEXT, name TEXT, accuracy INTEGER, first_seen TEXT, last_seen TEXT,
+            PRIMARY KEY (address, name));
+        CREATE TABLE IF NOT EXISTS changes (
+            id INTEGER PRIMARY KEY, run_id INTEGER, time TEXT, address TEXT, kind TEXT, detail TEXT);
+        CREATE TABLE IF NOT EXISTS deferred (
+            address TEXT PRIMARY KEY, stages TEXT, since TEXT);
+        CREATE INDEX IF NOT EXISTS hosts_last_seen ON hosts (last_seen);
+        CREATE INDEX IF NOT EXISTS ports_state ON ports (state, port);
+        CREATE INDEX IF NOT EXISTS changes_run ON changes (run_id);
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(self.SCHEMA)
+        self._lock = threading.Lock()
+        self.run_id = None
+        self.run_started = self._now()
+
+    @staticmethod
+    def _now():
+        return datetime.now().isoformat(timespec='seconds')
+
+    @staticmethod
+    def _ago(hours):
+        return (datetime.now() - timedelta(hours=hours)).isoformat(timespec='seconds')
+
+    def begin_run(self, target, stages):
+        self.run_started = self._now()
+        with self._lock, self._db:
+            cursor = self._db.execute('INSERT INTO runs (started, target, stages) VALUES (?, ?, ?)',
+                                      (self._now(), ' '.join(target_args(target)), ','.join(stages)))
+        self.run_id = cursor.lastrowid
+        return self.run_id
+
+    def finish_run(self):
+        if self.run_id is not None:
+            with self._lock, self._db:
+                self._db.execute('UPDATE runs SET finished = ? WHERE id = ?', (self._now(), self.run_id))
+
+    def _change(self, now, address, kind, detail=''):
+        self._db.execute('INSERT INTO changes (run_id, time, address, kind, detail) VALUES (?, ?, ?, ?, ?)',
+                         (self.run_id, now, address, kind, detail))
+
+    def __call__(self, stage, host):
+        """Host listener: merge a completed HostRecord into the database."""
+        if not host.is_up:
+            return
+        now = self._now()
+        with self._lock, self._db:
+            self._record_host(now, host)
+            if stage in ('port_scan', 'tcp_sweep', 'deep_scan'):
+                self._record_ports(now, host, stage)
+            if stage in ('port_scan', 'tcp_sweep'):
+                self._db.execute('UPDATE hosts SET last_scanned = ? WHERE address = ?', (now, host.address))
+            if host.os_matches:
+                self._record_os(now, host)
+
+    def _record_host(self, now, host):
+        row = self._db.execute('SELECT * FROM hosts WHERE address = ?', (host.address,)).fetchone()
+        if row is None:
+            self._db.execute('INSERT INTO hosts VALUES (?, ?, ?, ?, ?, ?, ?, NULL, ?)',
+                             (host.address, host.hostname, host.mac, host.vendor, 'up', now, now, now))
+            self._change(now, host.address, 'host_new')
+            return
+        changed = False
+        if row['status'] != 'up':
+            self._change(now, host.address, 'host_up')
+            changed = True
+        if host.mac and row['mac'] and host.mac != row['mac']:
+            self._change(now, host.address, 'mac_changed', f"{row['mac']} -> {host.mac}")
+            changed = True
+        self._db.execute(
+            'UPDATE hosts SET hostname = COALESCE(?, hostname), mac = COALESCE(?, mac), '
+            'vendor = COALESCE(?, vendor), status = ?, last_seen = ?, changed_at = ? WHERE address = ?',
+            (host.hostname, host.mac, host.vendor, 'up', now, now if changed else row['changed_at'], host.address))
+
+    def _record_ports(self, now, host, stage):
+        known = {(row['protocol'], row['port']): row for row in
+                 self._db.execute('SELECT * FROM ports WHERE address = ?', (host.address,))}
+        seen = set()
+        for port in host.ports:
+            key = (port.protocol, port.port)
+            seen.add(key)
+            row = known.get(key)
+            was_open = row is not None and row['state'] == 'open'
+            if port.state == 'open' and not was_open:
+                self._change(now, host.address, 'port_opened', port.label)
+            elif was_open and port.state != 'open':
+                self._change(now, host.address, 'port_closed', f"{port.label} ({port.state})")
+            if row is not None and port.product and row['product'] and \
+                    (port.product, port.version) != (row['product'], row['version']):
+                old = ' '.join(filter(None, (row['product'], row['version'])))
+                self._change(now, host.address, 'service_changed', f"{port.label}: {old} -> {port.version_string}")
+            deep_scanned = now if stage == 'deep_scan' else None
+            if row is None:
+                self._db.execute('INSERT INTO ports VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                 (host.address, port.protocol, port.port, port.state, port.service, port.product,
+                                  port.version, port.extrainfo, now, now, deep_scanned))
+            else:
+                self._db.execute(
+                    'UPDATE ports SET state = ?, service = COALESCE(?, service), product = COALESCE(?, product), '
+                    'version = COALESCE(?, version), extrainfo = COALESCE(?, extrainfo), last_seen = ?, '
+                    'deep_scanned = COALESCE(?, deep_scanned) WHERE address = ? AND protocol = ? AND port = ?',
+                    (port.state, port.service, port.product, port.version, port.extrainfo, now,
+                     deep_scanned, host.address, port.protocol, port.port))
+
+        if stage == 'port_scan':
+            # A port scan that covered a port but no longer lists it means it is no longer open
+            for key, row in known.items():
+                if key not in seen and row['state'] == 'open' and host.was_probed(*key):
+                    self._change(now, host.address, 'port_closed', f"{row['port']}/{row['protocol']}")
+                    self._db.execute('UPDATE ports SET state = ? WHERE address = ? AND protocol = ? AND port = ?',
+                                     ('closed', host.address, row['protocol'], row['port']))
+
+    def _record_os(self, now, host):
+        previous = self._db.execute('SELECT name FROM os_matches WHERE address = ? ORDER BY last_seen DESC, '
+                                    'accuracy DESC LIMIT 1', (host.address,)).fetchone()
+        best = host.os_matches[0]
+        if previous is not None and previous['name'] != best.name:
+            self._change(now, host.address, 'os_changed', f"{previous['name']} -> {best.name}")
+        for match in host.os_matches:
+            self._db.execute('INSERT INTO os_matches VALUES (?, ?, ?, ?, ?) ON CONFLICT (address, name) '
+                             'DO UPDATE SET accuracy = excluded.accuracy, last_seen = excluded.last_seen',
+                             (host.address, match.name, match.accuracy, now, now))
+
+    def mark_missing(self, target, live_hosts):
+        """Mark hosts inside `target` that were up but were not found this time as down."""
+        networks = []
+        for item in target_args(target) if isinstance(target, (list, tuple)) else target.replace(',', ' ').split():
+            try:
+                networks.append(ipaddress.ip_network(item, strict=False))
+            except ValueError:
+                continue
+        live = set(live_hosts)
+        now = self._now()
+        missing = []
+        with self._lock, self._db:
+            for row in self._db.execute("SELECT address FROM hosts WHERE status = 'up'").fetchall():
+                address = row['address']
+                try:
+                    ip = ipaddress.ip_address(address)
+                except ValueError:
+                    continue
+                if address not in live and any(ip in network for network in networks):
+                    self._db.execute("UPDATE hosts SET status = 'down', changed_at = ? WHERE address = ?",
+                                     (now, address))
+                    self._change(now, address, 'host_down')
+                    missing.append(address)
+        return missing
+
+    def hosts_to_rescan(self, addresses, max_age_hours):
+        """Hosts that are new, changed since their last scan, deferred, or not scanned for `max_age_hours`."""
+        cutoff = self._ago(max_age_hours)
+        due = []
+        with self._lock:
+            deferred = {row['address'] for row in self._db.execute('SELECT address FROM deferred')}
+            for address in addresses:
+                row = self._db.execute('SELECT last_scanned, changed_at FROM hosts WHERE address = ?',
+                                       (address,)).fetchone()
+                if row is None or row['last_scanned'] is None or row['last_scanned'] < cutoff \
+                        or (row['changed_at'] or '') > row['last_scanned'] or address in deferred:
+                    due.append(address)
+        return due
+
+    def fresh_hosts(self, max_age_hours):
+        """Known hosts that hosts_to_rescan() would skip right now."""
+        with self._lock:
+            known = [row['address'] for row in self._db.execute('SELECT address FROM hosts')]
+        return set(known) - set(self.hosts_to_rescan(known, max_age_hours))
+
+    def priority_facts(self, addresses, changed_within_hours=168):
+        """
+        What HostPrioritizer needs to know about previously seen hosts.
+        
+        Returns:
+            dict: address -> {'open_ports', 'recent_changes', 'deferred'}
+            for the addresses that are in the database
+        """
+        wanted = set(addresses)
+        cutoff = self._ago(changed_within_hours)
+        with self._lock:
+            # What the current run recorded so far (e.g. discovery) is not history
+            facts = {row['address']: {'open_ports': 0, 'recent_changes': 0, 'deferred': False}
+                     for row in self._db.execute('SELECT address FROM hosts WHERE first_seen < ?', (self.run_started,))
+                     if row['address'] in wanted}
+            for row in self._db.execute("SELECT address, COUNT(*) AS n FROM ports WHERE state = 'open' "
+                                        "GROUP BY address"):
+                if row['address'] in facts:
+                    facts[row['address']]['open_ports'] = row['n']
+            for row in self._db.execute('SELECT address, COUNT(*) AS n FROM changes WHERE time >= ? AND run_id IS NOT ? '
+                                        'GROUP BY address', (cutoff, self.run_id)):
+                if row['address'] in facts:
+                    facts[row['address']]['recent_changes'] = row['n']
+            for row in self._db.execute('SELECT address FROM deferred'):
+                if row['address'] in facts:
+                    facts[row['address']]['deferred'] = True
+        return facts
+
+    def update_deferred(self, scanned, deferred):
+        """
+        Remember which hosts' stages were deferred by a time budget.
+        
+        Args:
+            scanned: Addresses this run finished; their old entries are cleared
+            deferred: {address: [stages]} left for the next run
+        """
+        now = self._now()
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM deferred WHERE address = ?',
+                                 [(address,) for address in scanned if address not in deferred])
+            self._db.executemany('INSERT OR REPLACE INTO deferred VALUES (?, ?, COALESCE('
+                                 '(SELECT since FROM deferred WHERE address = ?), ?))',
+                                 [(address, ','.join(stages), address, now) for address, stages in deferred.items()])
+
+    def ports_needing_deep_scan(self, address, ports, max_age_hours):
+        """Filter PortRecords down to those never deep-scanned, or not for `max_age_hours`."""
+        cutoff = self._ago(max_age_hours)
+        with self._lock:
+            scanned = {(row['protocol'], row['port']) for row in self._db.execute(
+                'SELECT protocol, port FROM ports WHERE address = ? AND deep_scanned >= ?', (address, cutoff))}
+        return [port for port in ports if (port.protocol, port.port) not in scanned]
+
+    def changes(self, run_id=None):
+        """Changes recorded in a run (default: the current run)."""
+        with self._lock:
+            rows = self._db.execute('SELECT time, address, kind, detail FROM changes WHERE run_id = ? ORDER BY id',
+                                    (self.run_id if run_id is None else run_id,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class ScanCache:
+    """
+    TTL cache of deep-scan results, stored in SQLite.
+    
+    Entries are keyed on the host, its open-port fingerprint, the nmap
+    arguments and the nmap version, so a rescan whose quick port scan shows
+    the same open ports reuses the previous version detection, OS detection
+    and NSE output instead of repeating minutes of probing.
+    """
+
+    def __init__(self, filename, ttl_hours=12.0):
+        self.filename = filename
+        self.ttl = ttl_hours * 3600
+        self.stats = Counter()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, host TEXT, created REAL, hosts TEXT)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS cache_created ON cache (created)')
+        self._lock = threading.Lock()
+        self.evict()
+
+    @staticmethod
+    def key(target, open_ports, args, nmap_version):
+        fingerprint = sorted(port.label for port in open_ports)
+        payload = json.dumps([target, fingerprint, list(args), nmap_version])
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Cached HostRecords for a key, or None if missing or expired."""
+        with self._lock:
+            row = self._db.execute('SELECT created, hosts FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is None or row[0] < time.time() - self.ttl:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+        return [HostRecord.from_dict(host) for host in json.loads(row[1])]
+
+    def put(self, key, target, hosts):
+        data = json.dumps([host.to_dict(compact=True) for host in hosts], separators=(',', ':'))
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)', (key, target, time.time(), data))
+        self.stats['stored'] += 1
+
+    def evict(self):
+        """Drop expired entries; returns how many were removed."""
+        with self._lock, self._db:
+            removed = self._db.execute('DELETE FROM cache WHERE created < ?', (time.time() - self.ttl,)).rowcount
+        self.stats['evicted'] += removed
+        return removed
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class DNSCache:
+    """
+    TTL cache of reverse-DNS answers, stored in SQLite so it is shared
+    across runs. Failed lookups (NXDOMAIN, no PTR record) are cached too,
+    for `negative_ttl` seconds.
+    """
+
+    def __init__(self, filename=':memory:', max_ttl_hours=24.0, negative_ttl=3600):
+        self.filename = filename
+        self.max_ttl = max_ttl_hours * 3600
+        self.negative_ttl = negative_ttl
+        self.stats = Counter()
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS ptr (address TEXT PRIMARY KEY, name TEXT, expires REAL)')
+        self._lock = threading.Lock()
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM ptr WHERE expires < ?', (time.time(),))
+
+    def get(self, address):
+        """(True, name or None) for a cached answer, (False, None) on a miss."""
+        with self._lock:
+            row = self._db.execute('SELECT name, expires FROM ptr WHERE address = ?', (address,)).fetchone()
+        if row is None or row[1] < time.time():
+            self.stats['misses'] += 1
+            return False, None
+        self.stats['hits'] += 1
+        return True, row[0]
+
+    def put(self, address, name, ttl=None):
+        """Cache an answer for its record TTL (capped at max_ttl_hours)."""
+        ttl = self.negative_ttl if name is None else min(ttl if ttl is not None else self.max_ttl, self.max_ttl)
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO ptr VALUES (?, ?, ?)', (address, name, time.time() + ttl))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+@lru_cache(maxsize=4096)
+def version_key(version):
+    """
+    Sortable form of a version string's leading numeric part, or None.
+    
+    '7.4p1 Debian' -> '00000007.00000004.00000000.00000000', so string order
+    in the index is version order.
+    """
+    match = re.match(r'\s*v?(\d+(?:\.\d+)*)', version or '')
+    if match is None:
+        return None
+    parts = (match.group(1).split('.') + ['0'] * 4)[:4]
+    return '.'.join(part.zfill(8)[-8:] for part in parts)
+
+
+QUERY_FIELDS = ('address', 'net', 'hostname', 'os', 'port', 'protocol', 'state', 'service', 'product', 'version')
+
+
+def parse_query(text):
+    """
+    Parse a query like 'port=3389' or 'product=openssh version<8.0'.
+    
+    Terms are FIELD OP VALUE separated by spaces or commas; `version` also
+    takes <, <=, >, >= and !=, `port` takes a comma-free list like 80/443,
+    and * is a wildcard in text fields.
+    
+    Returns:
+        dict: keyword arguments for ResultIndex.query()
+    """
+    filters = {}
+    for term in re.split(r'[\s,]+', text.strip()):
+        if not term:
+            continue
+        match = re.fullmatch(r'(\w+)(<=|>=|!=|=|<|>)(.+)', term)
+        if match is None or match.group(1) not in QUERY_FIELDS:
+            raise argparse.ArgumentTypeError(f"invalid query term: {term} (fields: {', '.join(QUERY_FIELDS)})")
+        field, op, value = match.groups()
+        if field == 'version':
+            filters['version'] = (op, value)
+        elif op != '=':
+            raise argparse.ArgumentTypeError(f"only 'version' can be compared with {op}: {term}")
+        elif field == 'port':
+            try:
+                filters['port'] = [int(port) for port in value.split('/')]
+            except ValueError:
+                raise argparse.ArgumentTypeError(f"invalid port: {value}")
+        elif field == 'os':
+            filters['os_family'] = value
+        elif field == 'net':
+            try:
+                filters['net'] = ipaddress.ip_network(value, strict=False)
+            except ValueError:
+                raise argparse.ArgumentTypeError(f"invalid network: {value}")
+        else:
+            filters[field] = value
+    return filters
+
+
+class ResultIndex:
+    """
+    Indexed store of scan results for ad-hoc queries.
+    
+    Saved results (or streams) are flattened into SQLite tables of hosts
+    and ports, with indexes on port, service, product/version and OS
+    family, so questions like "which hosts run OpenSSH < 8.0" are index
+    lookups instead of a pass over every saved file. The store lives in
+    memory or, given a filename, on disk where it can be built once and
+    queried many times. A host indexed again (from a newer scan) replaces
+    its earlier record.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sources (
+            id INTEGER PRIMARY KEY, filename TEXT, loaded TEXT, hosts INTEGER);
+        CREATE TABLE IF NOT EXISTS hosts (
+            id INTEGER PRIMARY KEY, address TEXT UNIQUE, packed BLOB, source INTEGER,
+            hostname TEXT COLLATE NOCASE, status TEXT, mac TEXT, os_name TEXT, os_family TEXT COLLATE NOCASE,
+            os_accuracy INTEGER);
+        CREATE TABLE IF NOT EXISTS ports (
+            host INTEGER, port INTEGER, protocol TEXT, state TEXT, service TEXT COLLATE NOCASE,
+            product TEXT COLLATE NOCASE, version TEXT, version_key TEXT);
+        CREATE INDEX IF NOT EXISTS hosts_packed ON hosts (packed);
+        CREATE INDEX IF NOT EXISTS hosts_os_family ON hosts (os_family);
+        CREATE INDEX IF NOT EXISTS ports_host ON ports (host);
+        CREATE INDEX IF NOT EXISTS ports_port ON ports (port, state);
+        CREATE INDEX IF NOT EXISTS ports_service ON ports (service);
+        CREATE INDEX IF NOT EXISTS ports_product ON ports (product, version_key);
+    """
+
+    def __init__(self, filename=':memory:'):
+        self.filename = filename
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        # LIKE on the NOCASE columns can then use their indexes
+        self._db.execute('PRAGMA case_sensitive_like=OFF')
+        self._db.executescript(self.SCHEMA)
+        self._lock = threading.Lock()
+
+    def add(self, results, source=None):
+        """
+        Index a ScanResults.
+        
+        Returns:
+            int: number of hosts indexed
+        """
+        with self._lock, self._db:
+            source_id = self._db.execute('INSERT INTO sources (filename, loaded, hosts) VALUES (?, ?, ?)',
+                                         (source, datetime.now().isoformat(timespec='seconds'),
+                                          len(results.hosts))).lastrowid
+            known = dict(self._db.execute('SELECT address, id FROM hosts'))
+            next_id = self._db.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM hosts').fetchone()[0]
+            host_rows, port_rows, replaced = [], [], []
+            for host in results.hosts.values():
+                host_id = known.get(host.address)
+                if host_id is None:
+                    host_id = known[host.address] = next_id
+                    next_id += 1
+                else:
+                    replaced.append((host_id,))
+                best = max(host.os_matches, key=lambda match: match.accuracy or 0, default=None)
+                try:
+                    packed = ipaddress.ip_address(host.address).packed
+                except ValueError:
+                    packed = None
+                host_rows.append((host_id, host.address, packed, source_id, host.hostname, host.status, host.mac,
+                                  best and best.name, best and best.family, best and best.accuracy))
+                port_rows += [(host_id, port.port, port.protocol, port.state, port.service, port.product,
+                               port.version, version_key(port.version)) for port in host.ports]
+            self._db.executemany('DELETE FROM ports WHERE host = ?', replaced)
+            self._db.executemany('INSERT OR REPLACE INTO hosts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', host_rows)
+            self._db.executemany('INSERT INTO ports VALUES (?, ?, ?, ?, ?, ?, ?, ?)', port_rows)
+            # Statistics let the planner pick the most selective index (e.g. net over port)
+            self._db.execute('ANALYZE')
+        return len(results.hosts)
+
+    def add_file(self, filename):
+        """Index results saved by save_results() or written as a result stream."""
+        return self.add(ScanResults.load(filename), filename)
+
+    def query(self, address=None, net=None, hostname=None, os_family=None, port=None, protocol=None,
+              state=None, service=None, product=None, version=None, limit=None):
+        """
+        Find hosts (or their ports, when a port filter is given).
+        
+        Args:
+            port: Port number or list of port numbers
+            state: Port state; defaults to 'open' when any port filter is given
+            version: Version string, or (operator, version) with one of
+                =, !=, <, <=, >, >= compared numerically
+            net: ip_network the address must be in
+            hostname, os_family, service, product: Case-insensitive, * as wildcard
+        
+        Returns:
+            list: dicts with address, hostname, os and, for port queries,
+            port, protocol, state, service, product and version
+        """
+        host_terms, port_terms, params = [], [], []
+
+        def text(column, value, terms):
+            if '*' in value:
+                terms.append(f'{column} LIKE ?')
+                params.append(value.replace('*', '%'))
+            else:
+                terms.append(f'{column} = ?')
+                params.append(value)
+
+        if address is not None:
+            host_terms.append('h.address = ?')
+            params.append(address)
+        if net is not None:
+            # Packed addresses of one family sort like the addresses themselves
+            host_terms.append('h.packed BETWEEN ? AND ? AND length(h.packed) = ?')
+            params += [net.network_address.packed, net.broadcast_address.packed, len(net.network_address.packed)]
+        if hostname is not None:
+            text('h.hostname', hostname, host_terms)
+        if os_family is not None:
+            text('h.os_family', os_family, host_terms)
+        if port is not None:
+            ports = [port] if isinstance(port, int) else list(port)
+            port_terms.append(f"p.port IN ({', '.join('?' * len(ports))})")
+            params += ports
+        if protocol is not None:
+            port_terms.append('p.protocol = ?')
+            params.append(protocol)
+        if service is not None:
+            text('p.service', service, port_terms)
+        if product is not None:
+            text('p.product', product, port_terms)
+        if version is not None:
+            op, value = version if isinstance(version, tuple) else ('=', version)
+            if op not in ('=', '!=', '<', '<=', '>', '>='):
+                raise ValueError(f"invalid version operator: {op}")
+            key = version_key(value)
+            if key is None:
+                raise ValueError(f"invalid version: {value}")
+            port_terms.append(f'p.version_key {op} ?')
+            params.append(key)
+        if port_terms and state is None:
+            state = 'open'
+        if state is not None:
+            port_terms.append('p.state = ?')
+            params.append(state)
+
+        if port_terms:
+            sql = ('SELECT h.address, h.hostname, h.os_name, p.port, p.protocol, p.state, p.service, p.product, '
+                   'p.version FROM ports p JOIN hosts h ON h.id = p.host')
+        else:
+            sql = 'SELECT h.address, h.hostname, h.os_name FROM hosts h'
+        terms = host_terms + port_terms
+        if terms:
+            sql += ' WHERE ' + ' AND '.join(terms)
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        with self._lock:
+            rows = self._db.execute(sql, params).fetchall()
+
+        matches = []
+        for row in rows:
+            match = dict(row)
+            match['os'] = match.pop('os_name')
+            matches.append(match)
+        return matches
+
+    def stats(self):
+        with self._lock:
+            return {table: self._db.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                    for table in ('sources', 'hosts', 'ports')}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def print_matches(matches, limit=50):
+    """Print query results as an aligned table."""
+    for match in matches[:limit]:
+        line = f"  {match['address']:<16} {(match['hostname'] or '-')[:30]:<30}"
+        if 'port' in match:
+            product = ' '.join(part for part in (match['product'], match['version']) if part)
+            line += f" {match['port']}/{match['protocol']:<4} {match['service'] or '-':<12} {product}"
+        else:
+            line += f" {match['os'] or '-'}"
+        print(line.rstrip())
+    if len(matches) > limit:
+        print(f"  ... {len(matches) - limit} more")
@@ -0,0 +1,144 @@
+"""
+Result streaming and resume for nmap_network_scanner: live host and NDJSON
+result-stream writers, and loading an interrupted stream for --resume.
+"""
+
+import base64
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+from nmap_scanner_results import ScanResults, _open_stream, read_result_stream, target_args
+
+
+class LiveHostWriter:
+    """Host listener that appends every completed host to a JSON-lines file."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def __call__(self, stage, host):
+        line = json.dumps({'stage': stage, 'time': datetime.now().isoformat(), 'host': host.to_dict()})
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+STREAM_FORMAT = 'nmap-scan-stream/1'
+
+
+class ResultStreamWriter:
+    """
+    Result listener that appends every recorded stage result to an NDJSON stream.
+    
+    Each _record_result() becomes one 'host' line per host and a closing
+    'stage' line (targets, partial flag, NSE script ids, metadata and, with
+    --keep-raw, the raw output), so the file holds everything needed to
+    rebuild ScanResults and nothing has to wait for the end of the scan.
+    Writes are flushed and fsync()ed every `fsync_every` records or
+    `fsync_interval` seconds, whichever comes first; a crash loses at most
+    that batch. gzip and zstd streams are sync-flushed at the same points, so
+    a truncated file still decodes up to the last batch.
+    """
+
+    def __init__(self, filename, fsync_every=256, fsync_interval=2.0):
+        self.filename = filename
+        self.fsync_every = max(1, fsync_every)
+        self.fsync_interval = fsync_interval
+        self._file, self._raw = _open_stream(filename, 'a')
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._synced = time.monotonic()
+        self.records = 0
+        self._write({'type': 'header', 'format': STREAM_FORMAT, 'time': datetime.now().isoformat()})
+
+    def _write(self, *records):
+        with self._lock:
+            for record in records:
+                self._file.write(json.dumps(record, separators=(',', ':'), default=str) + '\n')
+            self.records += len(records)
+            self._pending += len(records)
+            if self._pending >= self.fsync_every or time.monotonic() - self._synced >= self.fsync_interval:
+                self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._pending = 0
+        self._synced = time.monotonic()
+
+    def __call__(self, stage, target, hosts, section, raw=None, partial=False, complete=None):
+        records = [{'type': 'host', 'stage': stage, 'host': host.to_dict(compact=True)} for host in hosts]
+        # 'partial' covers the whole stage so far; 'complete' says whether this
+        # run actually ran and finished, which is what --resume needs to know
+        if complete is None:
+            complete = not partial
+        record = dict(section, type='stage', stage=stage, target=target_args(target),
+                      complete=complete, time=datetime.now().isoformat())
+        if raw is not None:
+            record['raw_output'] = base64.b64encode(raw).decode('ascii')
+        self._write(*records, record)
+
+    def dump(self, results):
+        """Write results that were recorded elsewhere (e.g. merged shards) to the stream."""
+        for stage in ScanResults.STAGES:
+            if stage in results.stages:
+                self(stage, list(results.stages[stage].targets), results.hosts_in(stage),
+                     results.stage_snapshot(stage), partial=results.stages[stage].partial)
+
+    def hostnames(self, names):
+        """Record hostnames found after their hosts were written (reverse-DNS enrichment)."""
+        if names:
+            self._write({'type': 'hostnames', 'names': names})
+
+    def close(self, results=None, complete=True):
+        """
+        Write the closing record (changes, timings and metrics from `results`) and close.
+        
+        Args:
+            complete: Whether the scan finished. Only a finished scan gets the
+                'end' record; an interrupted or failed one gets a 'stopped'
+                record, so readers do not take the stream for a complete scan.
+        """
+        record = {'type': 'end' if complete else 'stopped', 'time': datetime.now().isoformat()}
+        if results is not None:
+            for key in ('changes', 'timings', 'deferred', 'metrics'):
+                if getattr(results, key):
+                    record[key] = getattr(results, key)
+        self._write(record)
+        with self._lock:
+            self._sync()
+            self._file.close()
+            self._raw.close()
+
+
+def load_checkpoint(filename):
+    """
+    Read a result stream left by an interrupted scan, for --resume.
+    
+    Returns:
+        tuple: (ScanResults recorded so far, set of (target, stage) pairs
+        whose nmap runs finished; targets are as recorded, e.g. host addresses
+        for the per-host stages)
+    """
+    completed = set()
+
+    def records():
+        for record in read_result_stream(filename):
+            if record.get('type') == 'stage' and record.get('complete'):
+                completed.update((target, record['stage']) for target in record.get('target', []))
+            yield record
+
+    results = ScanResults.from_stream(records())
+    # Deferred work is worked out again by this run
+    results.deferred = {}
+    return results, completed
@@ -0,0 +1,695 @@
+"""
+Targets, the TCP connect sweep and sharding for nmap_network_scanner:
+target files and exclusions, the asyncio sweep, and splitting large ranges
+across worker processes or scanner nodes.
+"""
+
+import asyncio
+import errno
+import ipaddress
+import json
+import os
+import socket
+import struct
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout
+from datetime import datetime
+
+from nmap_scanner_results import HostRecord, PortRecord, ScanResults
+
+
+# Ports probed by the TCP sweep when no list is given
+SWEEP_PORTS = (21, 22, 23, 25, 53, 80, 110, 111, 135, 139, 143, 443, 445, 993, 995,
+               1723, 3306, 3389, 5900, 8080)
+
+
+def expand_targets(target):
+    """
+    Yield individual addresses from a target string or list.
+    
+    Accepts IP addresses, CIDR ranges and hostnames, separated by commas or
+    spaces. nmap-only syntax such as 10.0.0.1-20 raises ValueError. The
+    network and broadcast addresses of a range are skipped, except in an
+    AddressBlock (see load_targets()).
+    """
+    items = target if isinstance(target, (list, tuple)) else target.replace(',', ' ').split()
+    for item in items:
+        if isinstance(item, AddressBlock):
+            yield from item.addresses()
+            continue
+        item = str(item)
+        try:
+            network = ipaddress.ip_network(item, strict=False)
+        except ValueError:
+            if '-' in item or '*' in item or '/' in item:
+                raise ValueError(f"unsupported target syntax: {item}")
+            yield item  # hostname, resolved by the sweep
+            continue
+        if network.num_addresses == 1:
+            yield str(network.network_address)
+        else:
+            yield from (str(address) for address in network.hosts())
+
+
+def _raise_fd_limit(wanted):
+    """Raise the soft open-file limit towards `wanted`; returns the usable limit."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return wanted
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < wanted and soft != resource.RLIM_INFINITY:
+        target = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        except (ValueError, OSError):
+            pass
+    return wanted if soft == resource.RLIM_INFINITY else soft
+
+
+class _RTTEstimator:
+    """Smoothed round-trip time and connect timeout, as in TCP (RFC 6298)."""
+    __slots__ = ('srtt', 'rttvar', 'initial', 'min_timeout', 'max_timeout')
+
+    def __init__(self, initial, min_timeout, max_timeout):
+        self.srtt = None
+        self.rttvar = None
+        self.initial = initial
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+
+    def update(self, rtt):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    @property
+    def timeout(self):
+        if self.srtt is None:
+            return self.initial
+        return min(self.max_timeout, max(self.min_timeout, self.srtt + 4 * self.rttvar))
+
+
+class TCPSweep:
+    """
+    Pure-asyncio TCP connect sweep for finding live hosts and open ports.
+    
+    Thousands of connects run concurrently from a single event loop, without
+    starting nmap per target. A host counts as up when any port accepts or
+    refuses the connection. Connect timeouts adapt to the measured round-trip
+    times: globally until a host has answered, then per host.
+    
+    The results are HostRecords with the open ports, so they can seed the
+    targeted nmap stages (see NetworkScanner.tcp_sweep()).
+    
+    Running out of local resources (file descriptors, buffers, ephemeral
+    ports) is back-pressure, not a result: the probe waits and retries, and
+    the sweep gives up a tenth of its connect slots each time, down to
+    `min_concurrency`.
+    
+    Example:
+        sweep = TCPSweep(ports=[22, 80, 443], concurrency=2000)
+        async for host in sweep.sweep('10.0.0.0/24'):
+            print(host.address, [port.port for port in host.open_ports])
+    """
+
+    def __init__(self, ports=None, concurrency=1000, timeout=1.0, min_timeout=0.1, max_timeout=3.0):
+        """
+        Args:
+            ports: TCP ports to probe (default SWEEP_PORTS)
+            concurrency: Maximum connects in flight; capped by the open-file limit
+            timeout: Connect timeout until round-trip times have been measured
+            min_timeout, max_timeout: Bounds for the adaptive timeout
+        """
+        self.ports = sorted(set(ports or SWEEP_PORTS))
+        self.concurrency = max(1, min(concurrency, _raise_fd_limit(concurrency + 64) - 64))
+        self.timeout = timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max(max_timeout, timeout)
+        self.min_concurrency = min(self.concurrency, 16)
+        self.stats = Counter()
+        self._global_rtt = None
+        self._slots = None
+        self._limit = self.concurrency
+        self._withheld = []
+        self._throttled_at = None
+
+    # Local resource shortages that say nothing about the target
+    RESOURCE_ERRORS = frozenset((errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM, errno.EADDRNOTAVAIL))
+    BACKOFF_DELAY = 0.05
+    MAX_BACKOFFS = 20
+
+    @property
+    def effective_concurrency(self):
+        """Connect slots still in use after throttling."""
+        return self._limit
+
+    def _throttle(self):
+        """Give up a tenth of the connect slots (at most once per back-off delay)."""
+        now = time.monotonic()
+        if self._throttled_at is not None and now - self._throttled_at < self.BACKOFF_DELAY:
+            return
+        self._throttled_at = now
+        cut = min(max(1, self._limit // 10), self._limit - self.min_concurrency)
+        if cut > 0:
+            self._limit -= cut
+            # Each task takes a slot as soon as one frees up and keeps it for the rest of the sweep
+            self._withheld += [asyncio.ensure_future(self._slots.acquire()) for _ in range(cut)]
+
+    def _estimator(self):
+        return _RTTEstimator(self.timeout, self.min_timeout, self.max_timeout)
+
+    async def _probe(self, address, port, host_rtt, retry=False):
+        """Connect once; returns 'open', 'closed', 'filtered' (timed out) or None (unreachable)."""
+        async with self._slots:
+            for _ in range(self.MAX_BACKOFFS):
+                state = await self._connect(address, port, host_rtt, retry)
+                if state != 'backoff':
+                    return state
+                self._throttle()
+                await asyncio.sleep(self.BACKOFF_DELAY)
+            self.stats['resource_failures'] += 1
+            return None
+
+    async def _connect(self, address, port, host_rtt, retry):
+        """One connect attempt; 'backoff' when the local system ran out of resources."""
+        estimator = host_rtt if host_rtt.srtt is not None else self._global_rtt
+        timeout = self.max_timeout if retry else estimator.timeout
+        loop = asyncio.get_running_loop()
+        family = socket.AF_INET6 if ':' in address else socket.AF_INET
+        sock = None
+        start = loop.time()
+        try:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            # Reset instead of FIN on close, so big sweeps don't pile up TIME_WAIT sockets
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            self.stats['probes'] += 1
+            await asyncio.wait_for(loop.sock_connect(sock, (address, port)), timeout)
+            state = 'open'
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            return 'filtered'
+        except ConnectionRefusedError:
+            state = 'closed'
+        except OSError as e:
+            if e.errno in self.RESOURCE_ERRORS:
+                self.stats['backoffs'] += 1
+                return 'backoff'
+            self.stats['unreachable'] += 1
+            return None
+        finally:
+            if sock is not None:
+                sock.close()
+        rtt = loop.time() - start
+        host_rtt.update(rtt)
+        self._global_rtt.update(rtt)
+        self.stats[state] += 1
+        return state
+
+    async def probe_host(self, address):
+        """Probe every port on one host; returns a HostRecord, or None if nothing answered."""
+        hostname = None
+        try:
+            ipaddress.ip_address(address)
+        except ValueError:
+            hostname = address
+            try:
+                infos = await asyncio.get_running_loop().getaddrinfo(hostname, None, type=socket.SOCK_STREAM)
+            except socket.gaierror:
+                self.stats['unresolved'] += 1
+                return None
+            address = infos[0][4][0]
+
+        host_rtt = self._estimator()
+        states = await asyncio.gather(*(self._probe(address, port, host_rtt) for port in self.ports))
+        if 'open' not in states and 'closed' not in states:
+            return None
+        # The host is up: give ports that timed out one more try with the longest timeout
+        retry = [index for index, state in enumerate(states) if state == 'filtered']
+        if retry:
+            self.stats['retries'] += len(retry)
+            retried = await asyncio.gather(*(self._probe(address, self.ports[index], host_rtt, retry=True)
+                                             for index in retry))
+            for index, state in zip(retry, retried):
+                states[index] = state
+        # Probes that only answered on the retry were lost the first time
+        lost = sum(1 for state in retried if state in ('open', 'closed')) if retry else 0
+
+        host = HostRecord(address, 'ipv6' if ':' in address else 'ipv4')
+        host.hostname = hostname
+        host.status = 'up'
+        host.reason = 'syn-ack' if 'open' in states else 'conn-refused'
+        for port, state in zip(self.ports, states):
+            if state == 'open':
+                host.ports.append(PortRecord(port, 'tcp', 'open', 'syn-ack'))
+        # Microseconds, like nmap's <times srtt rttvar>, plus probe loss for TimingController
+        host.times = {'srtt': int(host_rtt.srtt * 1e6), 'rttvar': int(host_rtt.rttvar * 1e6),
+                      'probes': len(self.ports) + len(retry), 'lost': lost}
+        return host
+
+    async def sweep(self, target):
+        """Yield a HostRecord for every responding host as soon as it finishes."""
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._limit, self._withheld, self._throttled_at = self.concurrency, [], None
+        self._global_rtt = self._estimator()
+        addresses = expand_targets(target)
+        found = asyncio.Queue()
+        # Enough hosts in flight to keep every connect slot busy
+        host_workers = max(1, self.concurrency // len(self.ports)) + 1
+
+        async def worker():
+            try:
+                for address in addresses:
+                    await found.put(await self.probe_host(address))
+            finally:
+                found.put_nowait(StopAsyncIteration)
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(host_workers)]
+        try:
+            running = len(workers)
+            while running:
+                item = await found.get()
+                if item is StopAsyncIteration:
+                    running -= 1
+                elif item is not None:
+                    yield item
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers + self._withheld:
+                task.cancel()
+            await asyncio.gather(*workers, *self._withheld, return_exceptions=True)
+
+    async def run(self, target):
+        """Sweep a target and return the list of responding HostRecords."""
+        return [host async for host in self.sweep(target)]
+
+
+def shard_targets(targets, shard_count):
+    """
+    Split CIDR targets into `shard_count` shards of roughly equal size.
+    
+    Overlapping ranges are merged first. Networks are cut into power-of-two
+    blocks at most an eighth of a fair share, and the blocks are dealt out
+    largest-first to the least loaded shard, so shards differ by at most one
+    small block.
+    
+    Args:
+        targets: Iterable of IP addresses / CIDR ranges (IPv4 or IPv6)
+        shard_count: Number of shards wanted
+    
+    Returns:
+        list: Shards, each a list of CIDR strings
+    
+    Raises:
+        ValueError: if a target is not an IP address or network
+    """
+    networks = [ipaddress.ip_network(str(target).strip(), strict=False) for target in targets]
+    collapsed = []
+    for version in (4, 6):
+        collapsed += ipaddress.collapse_addresses(net for net in networks if net.version == version)
+    if not collapsed:
+        return []
+    
+    shard_count = max(1, min(shard_count, sum(net.num_addresses for net in collapsed)))
+    total = sum(net.num_addresses for net in collapsed)
+    block_size = max(1, -(-total // shard_count) // 8)
+    
+    blocks = []
+    for net in collapsed:
+        new_prefix = max(net.prefixlen, net.max_prefixlen - (block_size.bit_length() - 1))
+        blocks.extend(net.subnets(new_prefix=new_prefix))
+    
+    shards = [[] for _ in range(shard_count)]
+    loads = [0] * shard_count
+    for block in sorted(blocks, key=lambda block: block.num_addresses, reverse=True):
+        index = loads.index(min(loads))
+        shards[index].append(block)
+        loads[index] += block.num_addresses
+    
+    result = []
+    for shard in shards:
+        if shard:
+            merged = []
+            for version in (4, 6):
+                merged += ipaddress.collapse_addresses(block for block in shard if block.version == version)
+            result.append([str(block) for block in merged])
+    return result
+
+
+def merge_scan_results(results_list):
+    """
+    Merge several scan results (e.g. one per shard) into one ScanResults.
+    
+    Accepts ScanResults objects or their to_dict() form.
+    """
+    merged = ScanResults()
+    for results in results_list:
+        merged.update(results if isinstance(results, ScanResults) else ScanResults.from_dict(results))
+    return merged
+
+
+def scan_shard(job):
+    """
+    Scan one shard: discover live hosts, then run the per-host stages on them.
+    
+    Runs in a worker process (or on a remote scanner node) and returns that
+    scanner's scan_results in to_dict() form. The scan's console output is
+    discarded.
+    
+    Args:
+        job: dict with 'targets', 'stages', 'scan_type' and optionally
+             'parallel' (hosts per process) and 'merge'
+    """
+    # The scanner module imports this one, so it is only imported once a shard runs
+    from nmap_network_scanner import NetworkScanner, ScanScheduler
+    
+    scanner = NetworkScanner()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        live_hosts = scanner.basic_host_discovery(job['targets'])
+        stages = [stage for stage in job.get('stages', []) if stage in NetworkScanner.STAGES]
+        if stages and live_hosts:
+            scheduler = ScanScheduler(scanner, max_workers=job.get('parallel', 1), merge=job.get('merge', True))
+            scheduler.run(live_hosts, stages, job.get('scan_type', 'quick'))
+    scanner.scan_results.metrics = scanner.metrics.to_dict()
+    return scanner.scan_results.to_dict()
+
+
+def run_sharded_scan(shards, stages, scan_type='quick', processes=None, parallel=1, merge=True):
+    """
+    Scan shards in parallel worker processes and merge their results.
+    
+    Args:
+        shards: Output of shard_targets()
+        processes: Worker processes (default: one per CPU, at most one per shard)
+        parallel: Hosts scanned concurrently inside each process
+    
+    Returns:
+        ScanResults: The merged results. Shards that failed leave every stage
+        marked partial, with their targets listed under 'failed_shards'.
+    """
+    processes = max(1, min(processes or os.cpu_count() or 1, len(shards)))
+    jobs = [{'targets': shard, 'stages': list(stages), 'scan_type': scan_type,
+             'parallel': parallel, 'merge': merge} for shard in shards]
+    
+    print(f"\n⚙️  Scanning {len(shards)} shards in {processes} processes")
+    results = []
+    failed = []
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {executor.submit(scan_shard, job): job for job in jobs}
+        for done, future in enumerate(as_completed(futures), 1):
+            job = futures[future]
+            try:
+                shard_results = future.result()
+            except Exception as e:
+                print(f"❌ Shard {' '.join(job['targets'])} failed: {e}")
+                failed.append(job['targets'])
+                continue
+            results.append(shard_results)
+            live = shard_results['summary']['live_hosts']
+            print(f"   [{done}/{len(jobs)}] {' '.join(job['targets'])}: {live} live hosts")
+    merged = merge_scan_results(results)
+    if failed:
+        # The failed shards' hosts are missing from every stage, not just unreachable
+        targets = [target for shard in failed for target in shard]
+        for stage in [stage for stage in ScanResults.STAGES if stage == 'host_discovery' or stage in stages]:
+            merged.add(stage, targets, [], partial=True, failed_shards=targets)
+    return merged
+
+
+class ShardQueue:
+    """
+    File-based work queue for spreading shards across scanner nodes.
+    
+    The queue is a directory (typically on shared storage) with pending/,
+    claimed/, done/, failed/ and results/ subdirectories. Jobs are claimed
+    with an atomic rename, so any number of workers can pull from it safely.
+    A claim is named after its worker and kept fresh by a heartbeat while the
+    shard is scanned, so only claims of dead workers go stale.
+    """
+
+    stale_after = 3600  # seconds without a heartbeat before a claim is assumed abandoned
+    heartbeat_interval = 60
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        for name in ('pending', 'claimed', 'done', 'failed', 'results'):
+            os.makedirs(os.path.join(directory, name), exist_ok=True)
+
+    def _path(self, *parts):
+        return os.path.join(self.directory, *parts)
+
+    def _claim_path(self, name):
+        return self._path('claimed', f"{name}@{self.worker_id}")
+
+    def enqueue(self, shards, stages, scan_type='quick', parallel=1, merge=True):
+        """Write one pending job per shard; returns the job names."""
+        names = []
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        for number, shard in enumerate(shards, 1):
+            name = f"shard_{stamp}_{number:05d}.json"
+            job = {'targets': shard, 'stages': list(stages), 'scan_type': scan_type,
+                   'parallel': parallel, 'merge': merge}
+            temp = self._path('pending', f".{name}.tmp")
+            with open(temp, 'w') as f:
+                json.dump(job, f)
+            os.replace(temp, self._path('pending', name))
+            names.append(name)
+        return names
+
+    def claim(self):
+        """Claim the next pending job; returns (name, job) or None when empty."""
+        for name in sorted(os.listdir(self._path('pending'))):
+            if name.startswith('.'):
+                continue
+            claimed = self._claim_path(name)
+            try:
+                os.rename(self._path('pending', name), claimed)
+            except (FileNotFoundError, FileExistsError):
+                continue  # another worker got it first
+            os.utime(claimed)  # claim time, used by requeue_stale
+            with open(claimed) as f:
+                return name, json.load(f)
+        return None
+
+    def _heartbeat(self, name, stop):
+        """Keep a claim's mtime fresh until `stop` is set or the claim is gone."""
+        while not stop.wait(self.heartbeat_interval):
+            try:
+                os.utime(self._claim_path(name))
+            except FileNotFoundError:
+                return
+
+    def complete(self, name, results):
+        """Store a job's results and mark it done."""
+        temp = self._path('results', f".{name}.tmp")
+        with open(temp, 'w') as f:
+            json.dump({'node': socket.gethostname(), 'results': results}, f, default=str)
+        os.replace(temp, self._path('results', name))
+        try:
+            os.replace(self._claim_path(name), self._path('done', name))
+        except FileNotFoundError:
+            # Requeued as stale (e.g. this node was suspended) and maybe claimed
+            # by another worker; that worker's claim is left alone
+            print(f"   ⚠️  {name} was requeued while it ran; results kept")
+
+    def fail(self, name, error):
+        """Move a job whose scan raised to failed/, with the error recorded."""
+        claimed = self._claim_path(name)
+        try:
+            with open(claimed) as f:
+                job = json.load(f)
+        except FileNotFoundError:
+            return
+        job['error'] = f"{type(error).__name__}: {error}"
+        job['node'] = socket.gethostname()
+        temp = self._path('failed', f".{name}.tmp")
+        with open(temp, 'w') as f:
+            json.dump(job, f)
+        os.replace(temp, self._path('failed', name))
+        os.remove(claimed)
+
+    def release(self, name):
+        """Give a claimed job back to pending (e.g. when the worker is stopped)."""
+        try:
+            os.rename(self._claim_path(name), self._path('pending', name))
+        except FileNotFoundError:
+            pass
+
+    def requeue_stale(self, max_age):
+        """Return jobs whose claim has not been refreshed for `max_age` seconds to pending."""
+        requeued = 0
+        now = datetime.now().timestamp()
+        for claim in os.listdir(self._path('claimed')):
+            path = self._path('claimed', claim)
+            try:
+                if now - os.path.getmtime(path) > max_age:
+                    os.rename(path, self._path('pending', claim.split('@', 1)[0]))
+                    requeued += 1
+            except FileNotFoundError:
+                continue
+        return requeued
+
+    def work(self):
+        """Process jobs until the queue is empty; returns the number processed."""
+        processed = 0
+        requeued = self.requeue_stale(self.stale_after)
+        if requeued:
+            print(f"   ♻️  Requeued {requeued} abandoned jobs")
+        while True:
+            claimed = self.claim()
+            if claimed is None:
+                return processed
+            name, job = claimed
+            print(f"   ▶️  {name}: {' '.join(job['targets'])}")
+            stop = threading.Event()
+            heartbeat = threading.Thread(target=self._heartbeat, args=(name, stop), daemon=True)
+            heartbeat.start()
+            try:
+                results = scan_shard(job)
+            except KeyboardInterrupt:
+                self.release(name)
+                raise
+            except Exception as e:
+                print(f"   ❌ {name} failed: {e}")
+                self.fail(name, e)
+                continue
+            finally:
+                stop.set()
+                heartbeat.join()
+            self.complete(name, results)
+            processed += 1
+
+    def status(self):
+        return {name: len([f for f in os.listdir(self._path(name)) if not f.startswith('.')])
+                for name in ('pending', 'claimed', 'done', 'failed')}
+
+    def collect(self):
+        """Merge the results of all completed jobs."""
+        results = []
+        for name in sorted(os.listdir(self._path('results'))):
+            if name.startswith('.'):
+                continue
+            with open(self._path('results', name)) as f:
+                results.append(json.load(f)['results'])
+        return merge_scan_results(results)
+
+
+def _read_target_file(filename):
+    """Targets from a file: whitespace/comma separated, '#' starts a comment."""
+    items = []
+    with open(filename) as f:
+        for line in f:
+            items += line.split('#', 1)[0].replace(',', ' ').split()
+    return items
+
+
+class AddressBlock(str):
+    """
+    A CIDR block left over when an exclusion was cut out of a range.
+    
+    It is a plain string to nmap, but expand_targets() yields every address
+    in it except the network and broadcast addresses of the range the user
+    asked for (`parent`): the block's own first and last addresses are
+    ordinary hosts of that range.
+    """
+
+    def __new__(cls, network, parent):
+        block = super().__new__(cls, str(network))
+        # The addresses ip_network.hosts() leaves out of the parent range
+        skipped = set()
+        if parent.num_addresses > 2:
+            skipped.add(str(parent.network_address))
+            if parent.version == 4:
+                skipped.add(str(parent.broadcast_address))
+        block.skipped = frozenset(skipped)
+        return block
+
+    def __reduce__(self):
+        return _address_block, (str(self), tuple(self.skipped))
+
+    def addresses(self):
+        return (str(address) for address in ipaddress.ip_network(self) if str(address) not in self.skipped)
+
+
+def _address_block(network, skipped):
+    """Unpickle an AddressBlock (shard jobs cross process boundaries)."""
+    block = str.__new__(AddressBlock, network)
+    block.skipped = frozenset(skipped)
+    return block
+
+
+def load_targets(targets=(), target_files=(), excludes=(), exclude_files=()):
+    """
+    Build a deduplicated target list from command line targets and files.
+    
+    IP addresses and CIDR ranges are merged with ipaddress.collapse_addresses
+    (overlaps and duplicates disappear, adjacent ranges join) and IP
+    exclusions are cut out of them; the blocks left around a hole are
+    AddressBlocks. Hostnames and nmap-only syntax (10.0.0.1-20) are kept as
+    given. Exclusions that are not IP addresses or CIDR ranges cannot be cut
+    out here and are returned for nmap's --exclude (targets equal to one of
+    them are dropped as well).
+    
+    Network and broadcast addresses are skipped per range as given: a block
+    carved out of 10.0.0.0/24 keeps its own first and last addresses (they are
+    hosts of the /24), while 10.0.0.0 and 10.0.0.255 stay skipped even when an
+    exclusion leaves one of them on its own.
+    
+    Returns:
+        tuple: (targets, address_count, nmap_excludes) -- targets as strings;
+        address_count counts the addresses in the IP ranges
+    """
+    items = [item for value in targets for item in value.replace(',', ' ').split()]
+    for filename in target_files:
+        items += _read_target_file(filename)
+    excluded = [item for value in excludes for item in value.replace(',', ' ').split()]
+    for filename in exclude_files:
+        excluded += _read_target_file(filename)
+
+    networks, others = {4: [], 6: []}, []
+    for item in items:
+        try:
+            network = ipaddress.ip_network(item, strict=False)
+            networks[network.version].append(network)
+        except ValueError:
+            if item not in others:
+                others.append(item)
+
+    excluded_networks, excluded_names = [], set()
+    for item in excluded:
+        try:
+            excluded_networks.append(ipaddress.ip_network(item, strict=False))
+        except ValueError:
+            excluded_names.add(item)
+
+    result, address_count = [], 0
+    for version in (4, 6):
+        remaining = list(ipaddress.collapse_addresses(networks[version]))
+        whole = set(remaining)
+        for exclusion in excluded_networks:
+            if exclusion.version != version:
+                continue
+            kept = []
+            for network in remaining:
+                if network.overlaps(exclusion):
+                    if not exclusion.supernet_of(network):
+                        kept += network.address_exclude(exclusion)
+                else:
+                    kept.append(network)
+            remaining = kept
+        for network in ipaddress.collapse_addresses(remaining):
+            address_count += network.num_addresses
+            parent = next(whole_network for whole_network in whole if whole_network.supernet_of(network))
+            target = network if network.num_addresses > 1 else network.network_address
+            # A lone address left over can still be the network or broadcast address of its range
+            result.append(str(target) if network == parent else AddressBlock(target, parent))
+    result += [item for item in others if item not in excluded_names]
+    return result, address_count, [item for item in excluded if item in excluded_names]
@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+Tests for github_stats.py
+
+Everything runs offline: the repositories are built in memory instead of
+being fetched from the GitHub API.
+
+Usage:
+    python -m pytest -q test_github_stats.py
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+import requests
+
+import github_stats
+from github_stats import CircuitBreaker, GitHubAPIError, GitHubStats, RepoSnapshot
+
+
+def make_repo(number, **fields):
+    repo = {
+        'name': f'repo-{number}',
+        'full_name': f'octocat/repo-{number}',
+        'description': f'Repository number {number}',
+        'html_url': f'https://github.com/octocat/repo-{number}',
+        'languages_url': f'https://api.github.com/repos/octocat/repo-{number}/languages',
+        'language': 'Python',
+        'created_at': '2020-01-01T00:00:00Z',
+        'updated_at': '2024-06-01T12:00:00Z',
+        'pushed_at': '2024-06-01T12:00:00Z',
+        'license': {'key': 'mit', 'name': 'MIT License', 'spdx_id': 'MIT'},
+        'topics': ['cli', 'stats'],
+        'stargazers_count': 10 * number,
+        'forks_count': number,
+        'watchers_count': 10 * number,
+        'size': 1024 + number,
+        'open_issues_count': 2 * number,
+        'private': False,
+        'fork': False,
+        'archived': False,
+        'has_issues': True,
+        'has_wiki': True,
+        'has_projects': False,
+        'has_downloads': True,
+    }
+    repo.update(fields)
+    return repo
+
+
+@pytest.fixture
+def stats():
+    stats = GitHubStats('octocat')
+    stats.user_data = {'login': 'octocat', 'name': 'The Octocat', 'followers': 42, 'public_repos': 3,
+                       'created_at': '2011-01-25T18:44:36Z', 'updated_at': '2024-06-01T12:00:00Z'}
+    stats.repos_data = [
+        make_repo(1),
+        make_repo(2, description=None, license=None, topics=[], language=None, fork=True),
+        make_repo(3, description='Ünïcödé ✨', stargazers_count=2 ** 40, archived=True),
+    ]
+    stats.calculate_statistics()
+    stats.languages.update({'Python': 2048, 'Shell': 100})
+    return stats
+
+
+def test_snapshot_round_trip(stats, tmp_path):
+    path = str(tmp_path / 'octocat.ghsnap')
+    assert stats.export_snapshot(path)
+
+    loaded = GitHubStats.from_snapshot(path)
+    assert loaded.username == 'octocat'
+    assert loaded.user_data == stats.user_data
+    assert loaded.languages == stats.languages
+    assert (loaded.total_stars, loaded.total_forks, loaded.total_watchers, loaded.total_size) == (
+        stats.total_stars, stats.total_forks, stats.total_watchers, stats.total_size)
+
+    repos = loaded.repos_data
+    assert len(repos) == 3
+    assert [repo['name'] for repo in repos] == ['repo-1', 'repo-2', 'repo-3']
+    assert repos[2]['stargazers_count'] == 2 ** 40
+    assert repos[2]['description'] == 'Ünïcödé ✨' and repos[2]['archived'] is True
+    assert repos[1]['description'] is None and repos[1]['language'] is None
+    assert repos[1]['license'] is None and repos[1]['topics'] == [] and repos[1]['fork'] is True
+    assert repos[0]['license']['name'] == 'MIT License' and repos[0]['topics'] == ['cli', 'stats']
+    assert repos[-1] == repos[2] and repos[0:2] == [repos[0], repos[1]]
+    assert list(repos.column('forks_count')) == [1, 2, 3]
+    with pytest.raises(IndexError):
+        repos[3]
+
+
+def test_empty_snapshot(tmp_path):
+    path = str(tmp_path / 'empty.ghsnap')
+    assert GitHubStats('nobody').export_snapshot(path)
+    loaded = GitHubStats.from_snapshot(path)
+    assert len(loaded.repos_data) == 0 and list(loaded.repos_data) == []
+
+
+def test_snapshot_rejects_other_files(tmp_path):
+    path = tmp_path / 'stats.json'
+    path.write_text('{"username": "octocat"}')
+    with pytest.raises(ValueError):
+        RepoSnapshot(str(path))
+
+
+def test_snapshot_rejects_damaged_files(stats, tmp_path):
+    path = tmp_path / 'octocat.ghsnap'
+    stats.export_snapshot(str(path))
+    data = path.read_bytes()
+    for damaged in (b'', data[:10], data[:16] + b'\0' * (len(data) - 16)):
+        path.write_bytes(damaged)
+        with pytest.raises(ValueError):
+            RepoSnapshot(str(path))
+
+
+def test_snapshot_stats_export_to_json(stats, tmp_path):
+    stats.repos_data[0].update(owner={'login': 'octocat', 'id': 583231}, default_branch='main', homepage='')
+    stats.repos_data[1].update(description='', open_issues_count=None, has_wiki=None)
+    path = str(tmp_path / 'octocat.ghsnap')
+    stats.export_snapshot(path)
+    original, exported = tmp_path / 'original.json', tmp_path / 'exported.json'
+    stats.export_to_json(str(original))
+
+    loaded = GitHubStats.from_snapshot(path)
+    try:
+        assert loaded.export_to_json(str(exported))
+    finally:
+        loaded.close()
+    before, after = json.loads(original.read_text()), json.loads(exported.read_text())
+    for key in ('username', 'profile', 'statistics', 'languages'):
+        assert after[key] == before[key]
+    # Every field of the API payload comes back, including the full license objects
+    assert after['repositories'] == before['repositories']
+
+
+def test_snapshot_report_reads_columns_only(stats, tmp_path, monkeypatch, capsys):
+    path = str(tmp_path / 'octocat.ghsnap')
+    stats.export_snapshot(path)
+    capsys.readouterr()
+    stats.display_all()
+    expected = capsys.readouterr().out
+
+    def no_rows(*args):
+        raise AssertionError('the report built a whole row')
+
+    monkeypatch.setattr(RepoSnapshot, '_build_row', no_rows)
+    loaded = GitHubStats.from_snapshot(path)
+    try:
+        capsys.readouterr()
+        loaded.display_all()
+    finally:
+        loaded.close()
+    assert capsys.readouterr().out == expected
+
+
+def test_snapshot_close_unmaps_the_file(stats, tmp_path):
+    path = str(tmp_path / 'octocat.ghsnap')
+    stats.export_snapshot(path)
+    with RepoSnapshot(path) as repos:
+        assert sum(repos.column('stargazers_count')) == stats.total_stars
+    assert repos._mmap.closed
+
+
+# --- API retries ------------------------------------------------------------
+
+def make_response(status, headers=None, body=b'{}'):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    response._content = body
+    return response
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """Replays queued responses (or exceptions) for requests.get and records the sleeps."""
+    class FakeAPI:
+        def __init__(self):
+            self.queue = []
+            self.calls = []
+            self.sleeps = []
+
+        def get(self, url, **kwargs):
+            self.calls.append(url)
+            item = self.queue.pop(0)
+            if isinstance(item, Exception):
+                raise item
+            return item
+
+    fake = FakeAPI()
+    monkeypatch.setattr(requests, 'get', fake.get)
+    monkeypatch.setattr(github_stats.time, 'sleep', fake.sleeps.append)
+    return fake
+
+
+URL = 'https://api.github.com/users/octocat'
+
+
+def test_transient_errors_are_retried(api):
+    api.queue = [make_response(503), requests.exceptions.ConnectTimeout('timed out'), make_response(200)]
+    stats = GitHubStats('octocat')
+    assert stats._get(URL, 'user profile').status_code == 200
+    assert len(api.calls) == 3
+    assert stats.retry_stats['transient'] == 2 and stats.failed_requests == []
+    # Full jitter: each delay is somewhere below the exponential cap
+    assert 0 <= api.sleeps[0] <= 1.0 and 0 <= api.sleeps[1] <= 2.0
+
+
+def test_permanent_errors_fail_at_once(api):
+    api.queue = [make_response(404)]
+    stats = GitHubStats('octocat')
+    with pytest.raises(GitHubAPIError) as error:
+        stats._get(URL, 'user profile')
+    assert (error.value.kind, error.value.status) == ('permanent', 404)
+    assert len(api.calls) == 1 and api.sleeps == []
+    assert stats.failed_requests == [('user profile', f'HTTP 404 for {URL}')]
+
+
+def test_rate_limits_wait_for_retry_after(api):
+    api.queue = [make_response(429, {'Retry-After': '7'}), make_response(200)]
+    stats = GitHubStats('octocat')
+    stats._get(URL, 'user profile')
+    assert api.sleeps[0] >= 7 and stats.retry_stats['rate_limited'] == 1
+
+
+def test_long_rate_limit_resets_give_up(api):
+    reset = str(int(github_stats.time.time()) + 3600)
+    api.queue = [make_response(403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': reset})]
+    stats = GitHubStats('octocat')
+    with pytest.raises(GitHubAPIError) as error:
+        stats._get(URL, 'user profile')
+    assert error.value.kind == 'rate_limited'
+    assert api.sleeps == [] and stats.retry_stats['gave_up'] == 1
+
+
+def test_retries_give_up_after_max_attempts(api):
+    api.queue = [make_response(502)] * GitHubStats.max_attempts
+    stats = GitHubStats('octocat')
+    with pytest.raises(GitHubAPIError):
+        stats._get(URL, 'user profile')
+    assert len(api.calls) == GitHubStats.max_attempts
+    assert stats.retry_stats['gave_up'] == 1 and len(stats.failed_requests) == 1
+
+
+def test_circuit_breaker_opens_and_recovers():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+    github_stats.time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.allow() and breaker.failures == 0
+
+
+def test_half_open_circuit_allows_a_single_trial():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    breaker.record_failure()
+    github_stats.time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+    github_stats.time.sleep(0.06)
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.allow() and not breaker.allow()
+
+
+def test_permanent_errors_leave_the_circuit_alone(api):
+    stats = GitHubStats('octocat')
+    breaker = stats.breakers['api.github.com'] = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    api.queue = [make_response(404)]
+    with pytest.raises(GitHubAPIError):
+        stats._get(URL, 'user profile')
+    assert breaker.failures == 1
+    breaker.record_failure()
+    assert not breaker.allow()
+
+
+@pytest.mark.parametrize('headers', [
+    {'Retry-After': '3'},
+    {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(int(github_stats.time.time()) + 3)},
+])
+def test_secondary_rate_limits_are_retried(api, headers):
+    api.queue = [make_response(403, headers), make_response(200)]
+    stats = GitHubStats('octocat')
+    assert stats._get(URL, 'user profile').status_code == 200
+    assert 1 <= api.sleeps[0] <= 4 and stats.retry_stats['rate_limited'] == 1
+
+
+def test_open_circuit_fails_fast(api):
+    api.queue = [make_response(500)] * 3
+    stats = GitHubStats('octocat')
+    stats.max_attempts = 3
+    stats.breakers['api.github.com'] = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    with pytest.raises(GitHubAPIError):
+        stats._get(URL, 'user profile')
+    with pytest.raises(GitHubAPIError) as error:
+        stats._get(URL + '/repos', 'repositories page 1')
+    assert error.value.kind == 'circuit_open'
+    assert len(api.calls) == 3 and stats.retry_stats['circuit_open'] == 1
+
+
+# --- startup and worker mode ------------------------------------------------
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def new_modules(code):
+    """Modules `code` imports on top of what a bare interpreter already has loaded."""
+    probe = f"import sys; before = set(sys.modules); {code}; import json; print(json.dumps(sorted(set(sys.modules) - before)))"
+    result = subprocess.run([sys.executable, '-c', probe], capture_output=True, text=True, cwd=HERE)
+    assert result.returncode == 0, result.stderr
+    return set(json.loads(result.stdout.splitlines()[-1]))
+
+
+DEFERRED = {'requests', 'urllib3', 'mmap', 'zlib', 'array', 'random', 'urllib.parse'}
+
+
+def test_import_defers_heavy_modules():
+    assert not new_modules('import github_stats') & DEFERRED
+
+
+def test_startup_bench_ignores_modules_the_interpreter_preloads():
+    import github_stats_startup_bench
+    assert github_stats_startup_bench.heavy_modules_loaded() == []
+
+
+def test_snapshot_report_runs_without_requests(stats, tmp_path):
+    path = str(tmp_path / 'octocat.ghsnap')
+    stats.export_snapshot(path)
+    loaded = new_modules(f"import github_stats; github_stats.main(['--from-snapshot', {path!r}])")
+    assert 'requests' not in loaded and 'mmap' in loaded
+
+
+def test_serve_shares_one_session(monkeypatch, capsys):
+    sessions = []
+
+    class FakeSession:
+        def __init__(self):
+            sessions.append(self)
+
+        def get(self, url, **kwargs):
+            return make_response(404)
+
+    monkeypatch.setattr(requests, 'Session', FakeSession)
+    github_stats.serve(stream=['octocat\n', '# comment\n', '\n', 'torvalds --export\n'])
+    lines = [line for line in capsys.readouterr().out.splitlines() if line.startswith('###')]
+    assert lines == ['### octocat FAILED', '### torvalds FAILED']
+    assert len(sessions) == 1
@@ -0,0 +1,1392 @@
+#!/usr/bin/env python3
+"""
+Tests for nmap_network_scanner.py
+
+Nothing here touches a real network or needs nmap installed.
+
+Usage:
+    python -m pytest -q test_nmap_network_scanner.py
+"""
+
+import argparse
+import asyncio
+import errno
+import gzip
+import io
+import ipaddress
+import json
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import pytest
+
+import nmap_network_scanner as scanner_module
+import nmap_scanner_sweep as sweep_module
+
+HOST_TEMPLATE = (
+    '<host><status state="up" reason="syn-ack"/>\n'
+    '<address addr="{addr}" addrtype="ipv4"/>\n'
+    '<address addr="AA:BB:CC:DD:{last:02X}:01" addrtype="mac" vendor="Acme"/>\n'
+    '<hostnames><hostname name="host-{last}.lan" type="PTR"/></hostnames>\n'
+    '<ports><extraports state="closed" count="996"/>\n'
+    '<port protocol="tcp" portid="22"><state state="open" reason="syn-ack"/>'
+    '<service name="ssh" product="OpenSSH" version="8.9p1" extrainfo="Ubuntu">'
+    '<cpe>cpe:/a:openbsd:openssh:8.9p1</cpe></service>'
+    '<script id="ssh-hostkey" output="256 aa:bb:cc (ECDSA)"/></port>\n'
+    '<port protocol="tcp" portid="80"><state state="open" reason="syn-ack"/>'
+    '<service name="http" product="nginx" version="1.18.0"/></port>\n'
+    '<port protocol="tcp" portid="443"><state state="filtered" reason="no-response"/>'
+    '<service name="https"/></port>\n'
+    '<port protocol="udp" portid="53"><state state="open" reason="udp-response"/>'
+    '<service name="domain" product="dnsmasq" version="2.80"/>'
+    '<script id="vulners" output="CVE-2020-25681 VULNERABLE"/></port>\n'
+    '</ports>\n'
+    '<os><osmatch name="Linux 5.0 - 5.14" accuracy="96"><osclass type="general purpose" vendor="Linux" '
+    'osfamily="Linux" osgen="5.X"><cpe>cpe:/o:linux:linux_kernel:5</cpe></osclass></osmatch></os>\n'
+    '<times srtt="812" rttvar="244" to="100000"/>\n'
+    '</host>\n'
+)
+XML_HEADER = '<?xml version="1.0"?>\n<nmaprun scanner="nmap" args="nmap {args}" version="7.94">\n'
+XML_FOOTER = '<runstats><finished elapsed="10.00" exit="success"/></runstats>\n</nmaprun>\n'
+SCAN_INFO = ('<scaninfo type="syn" protocol="tcp" numservices="1000" services="1-1000"/>\n'
+             '<scaninfo type="udp" protocol="udp" numservices="3" services="53,67-68"/>\n')
+
+
+def synthetic_xml(host_count):
+    hosts = ''.join(HOST_TEMPLATE.format(addr=f'10.0.0.{index}', last=index) for index in range(host_count))
+    return (XML_HEADER.format(args='-sV -O') + SCAN_INFO + hosts + XML_FOOTER).encode()
+
+
+def parse_hosts(host_count, chunk_size=65536):
+    return list(scanner_module.iter_nmap_xml(io.BytesIO(synthetic_xml(host_count)), chunk_size=chunk_size))
+
+
+def results_from(hosts, target='10.0.0.0/24'):
+    results = scanner_module.ScanResults()
+    results.add('host_discovery', target, hosts)
+    results.add('port_scan', target, hosts)
+    results.add('os_detection', target, hosts)
+    return results
+
+
+# --- nmap XML ---------------------------------------------------------------
+
+def test_parser_reads_every_host_field():
+    host = parse_hosts(1)[0]
+    assert (host.address, host.mac, host.vendor, host.hostname) == ('10.0.0.0', 'AA:BB:CC:DD:00:01', 'Acme', 'host-0.lan')
+    assert host.is_up
+    assert [(port.label, port.state) for port in host.ports] == [
+        ('22/tcp', 'open'), ('80/tcp', 'open'), ('443/tcp', 'filtered'), ('53/udp', 'open')]
+    assert [port.label for port in host.open_ports] == ['22/tcp', '80/tcp', '53/udp']
+    ssh = host.ports[0]
+    assert (ssh.service, ssh.product, ssh.version) == ('ssh', 'OpenSSH', '8.9p1')
+    assert ssh.version_string == 'OpenSSH 8.9p1 Ubuntu'
+    assert ssh.cpe == ['cpe:/a:openbsd:openssh:8.9p1']
+    assert ssh.scripts == {'ssh-hostkey': '256 aa:bb:cc (ECDSA)'}
+    assert [(match.name, match.accuracy, match.family) for match in host.os_matches] == [('Linux 5.0 - 5.14', 96, 'Linux')]
+    assert host.times['srtt'] == 812
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 4096])
+def test_parser_handles_any_chunking(chunk_size):
+    hosts = parse_hosts(20, chunk_size=chunk_size)
+    assert [host.address for host in hosts] == [f'10.0.0.{index}' for index in range(20)]
+
+
+def test_parser_yields_hosts_as_they_complete():
+    parser = scanner_module.NmapXMLParser()
+    assert parser.feed(XML_HEADER.format(args='-sV')) == []
+    assert parser.run_info['version'] == '7.94'
+    hosts = parser.feed(HOST_TEMPLATE.format(addr='192.0.2.1', last=1))
+    assert [host.address for host in hosts] == ['192.0.2.1']
+    # Finished hosts are not kept in the tree
+    assert len(parser._root) == 0
+    assert parser.feed(XML_FOOTER) + parser.close() == []
+    assert parser.finished['exit'] == 'success'
+
+
+def test_parser_reports_progress():
+    seen = []
+    parser = scanner_module.NmapXMLParser(on_progress=seen.append)
+    parser.feed(XML_HEADER.format(args='-sS') +
+                '<taskprogress task="SYN Stealth Scan" time="1700000005" percent="42.00" remaining="7"/>')
+    assert seen == [{'task': 'SYN Stealth Scan', 'time': '1700000005', 'percent': '42.00', 'remaining': '7'}]
+
+
+def test_iter_nmap_xml_accepts_strings_and_paths(tmp_path):
+    xml = synthetic_xml(3)
+    path = tmp_path / 'scan.xml'
+    path.write_bytes(xml)
+    from_text = [host.address for host in scanner_module.iter_nmap_xml(xml.decode())]
+    from_path = [host.address for host in scanner_module.iter_nmap_xml(str(path))]
+    assert from_text == from_path == ['10.0.0.0', '10.0.0.1', '10.0.0.2']
+
+
+# --- concurrent host scans --------------------------------------------------
+
+class RecordingScanner(scanner_module.NetworkScanner):
+    """Runs no nmap; records which stages ran and how many hosts were in each at once."""
+
+    def __init__(self, delay=0.02):
+        super().__init__()
+        self.delay = delay
+        self.calls = []
+        self.active = Counter()
+        self.peak = Counter()
+        self.lock = threading.Lock()
+
+    def run_stage(self, stage, target, scan_type='quick', open_ports=None):
+        with self.lock:
+            self.calls.append((target, stage))
+            for key in (stage, 'all'):
+                self.active[key] += 1
+                self.peak[key] = max(self.peak[key], self.active[key])
+        print(f'{target} {stage} start')
+        time.sleep(self.delay)
+        print(f'{target} {stage} end')
+        with self.lock:
+            self.active[stage] -= 1
+            self.active['all'] -= 1
+        return [target]
+
+
+def test_scheduler_bounds_workers_and_stages(capsys):
+    scanner = RecordingScanner()
+    hosts = [f'10.0.0.{last}' for last in range(1, 9)]
+    stages = ['port_scan', 'vulnerability_scan']
+    scheduler = scanner_module.ScanScheduler(scanner, max_workers=4, merge=False)
+    results = scheduler.run(hosts, stages)
+
+    assert results == {host: {stage: [host] for stage in stages} for host in hosts}
+    assert scanner.peak['all'] == 4
+    assert scanner.peak['vulnerability_scan'] <= 2
+    # Every host runs its stages in order
+    for host in hosts:
+        assert [stage for target, stage in scanner.calls if target == host] == stages
+    # ... and its output is printed as one block
+    lines = [line for line in capsys.readouterr().out.splitlines() if line.startswith('10.0.0.')]
+    for index in range(0, len(lines), 4):
+        assert len({line.split()[0] for line in lines[index:index + 4]}) == 1
+
+
+def test_scheduler_stage_limits():
+    scanner = RecordingScanner()
+    scheduler = scanner_module.ScanScheduler(scanner, max_workers=3, stage_limits={'port_scan': 1}, merge=False)
+    scheduler.run([f'10.0.0.{last}' for last in range(1, 5)], ['port_scan'])
+    assert scanner.peak['port_scan'] == 1
+
+
+def test_parse_stage_limits():
+    assert scanner_module.parse_stage_limits(['vulnerability_scan=3', 'port_scan=1']) == {
+        'vulnerability_scan': 3, 'port_scan': 1}
+    for value in ('nmap=2', 'port_scan=0', 'port_scan'):
+        with pytest.raises(argparse.ArgumentTypeError):
+            scanner_module.parse_stage_limits([value])
+
+
+# --- merged deep scans ------------------------------------------------------
+
+STUB_NMAP = r'''#!{python}
+import ipaddress, json, os, sys, time
+HOST_TEMPLATE = {host_template!r}
+XML_HEADER = {xml_header!r}
+XML_FOOTER = {xml_footer!r}
+args = sys.argv[1:]
+with open(os.environ['STUB_NMAP_LOG'], 'a') as log:
+    log.write(json.dumps(args) + '\n')
+if args[:1] == ['--version']:
+    print('Nmap version 7.94 ( https://nmap.org )')
+    sys.exit(0)
+if args[:1] == ['--script-help']:
+    print('\nvulners\nCategories: vuln safe external\n')
+    sys.exit(0)
+if os.environ.get('STUB_NMAP_FAIL') in args:
+    sys.stderr.write('QUITTING!\n')
+    sys.exit(1)
+closed = os.environ.get('STUB_NMAP_CLOSED', '').split()
+hang = float(os.environ.get('STUB_NMAP_HANG', '0'))
+with_value = {with_value!r}
+targets = [arg for previous, arg in zip([''] + args, args)
+           if not arg.startswith('-') and previous not in with_value]
+sys.stdout.write(XML_HEADER.format(args=' '.join(args)))
+for target in targets:
+    network = ipaddress.ip_network(target, strict=False)
+    for address in map(str, network.hosts() if network.num_addresses > 2 else network):
+        if '-sn' in args or address in closed:
+            sys.stdout.write('<host><status state="up" reason="arp-response"/>'
+                             '<address addr="%s" addrtype="ipv4"/>'
+                             '<times srtt="812" rttvar="244" to="100000"/></host>\n' % address)
+        else:
+            sys.stdout.write(HOST_TEMPLATE.format(addr=address, last=int(address.split('.')[-1])))
+        sys.stdout.flush()
+        time.sleep(hang)
+sys.stdout.write(XML_FOOTER)
+'''
+
+
+# nmap options that take a value
+NMAP_VALUE_OPTIONS = {'-p', '--top-ports', '--script', '-oX', '--initial-rtt-timeout', '--max-rtt-timeout',
+                      '--max-retries', '--host-timeout', '--min-rate', '--max-parallelism', '--exclude'}
+
+
+def nmap_targets(args):
+    return [arg for previous, arg in zip([''] + args, args) if not arg.startswith('-') and previous not in NMAP_VALUE_OPTIONS]
+
+
+def option(args, name):
+    return args[args.index(name) + 1] if name in args else None
+
+
+class StubNmap:
+    """A fake `nmap` on PATH that answers from HOST_TEMPLATE and logs its arguments."""
+
+    def __init__(self, directory, monkeypatch):
+        self.log = directory / 'nmap-calls.log'
+        self.log.write_text('')
+        path = directory / 'nmap'
+        path.write_text(STUB_NMAP.format(python=sys.executable, host_template=HOST_TEMPLATE,
+                                         xml_header=XML_HEADER, xml_footer=XML_FOOTER,
+                                         with_value=NMAP_VALUE_OPTIONS))
+        path.chmod(0o755)
+        self.monkeypatch = monkeypatch
+        monkeypatch.setenv('PATH', f"{directory}{os.pathsep}{os.environ.get('PATH', '')}")
+        monkeypatch.setenv('STUB_NMAP_LOG', str(self.log))
+
+    def hang(self, seconds):
+        """Sleep this long after every host, e.g. to run into a timeout."""
+        self.monkeypatch.setenv('STUB_NMAP_HANG', str(seconds))
+
+    def fail_on(self, arg):
+        """Exit with an error and no XML whenever this argument is passed."""
+        self.monkeypatch.setenv('STUB_NMAP_FAIL', arg)
+
+    def close_hosts(self, *addresses):
+        """Report these hosts without any open ports."""
+        self.monkeypatch.setenv('STUB_NMAP_CLOSED', ' '.join(addresses))
+
+    @property
+    def runs(self):
+        """Arguments of every scan (not --version / --script-help) so far."""
+        runs = [json.loads(line) for line in self.log.read_text().splitlines()]
+        return [args for args in runs if args[0] not in ('--version', '--script-help')]
+
+
+@pytest.fixture
+def nmap_stub(tmp_path, monkeypatch):
+    directory = tmp_path / 'bin'
+    directory.mkdir()
+    return StubNmap(directory, monkeypatch)
+
+
+@pytest.fixture
+def as_root(monkeypatch):
+    monkeypatch.setattr(scanner_module.os, 'geteuid', lambda: 0)
+
+
+def test_plan_deep_scan(as_root):
+    open_ports = parse_hosts(1)[0].open_ports
+    scanner = scanner_module.NetworkScanner()
+    assert scanner.plan_deep_scan(['service_detection', 'os_detection', 'vulnerability_scan'], open_ports) == [
+        '-sV', '--version-all', '-O', '--osscan-guess', '--script', 'default,vuln',
+        '-sS', '-sU', '-p', 'T:22,80,U:53']
+    assert scanner.plan_deep_scan(['vulnerability_scan']) == ['--script', 'vuln']
+    assert scanner.plan_deep_scan(['port_scan']) is None
+    # A port scan that found nothing leaves nothing to probe
+    assert scanner.plan_deep_scan(['service_detection'], []) is None
+
+
+def test_scan_host_merges_deep_stages(nmap_stub, as_root):
+    scanner = scanner_module.NetworkScanner()
+    results = scanner.scan_host('192.0.2.1', list(scanner_module.NetworkScanner.STAGES))
+
+    port_scan, deep_scan = nmap_stub.runs
+    assert '-sV' not in port_scan
+    assert nmap_targets(deep_scan) == ['192.0.2.1']
+    assert option(deep_scan, '-p') == 'T:22,80,U:53'
+    assert set(results) == set(scanner_module.NetworkScanner.STAGES)
+    # The combined run's scripts are split between the stages again
+    services = scanner.scan_results.services()
+    assert {script for service in services for script in service['scripts']} == {'ssh-hostkey'}
+    findings = scanner.scan_results.findings()
+    assert [(finding['port'], finding['script']) for finding in findings] == [('53/udp', 'vulners')]
+    assert scanner.scan_results.hosts['192.0.2.1'].os_matches[0].name == 'Linux 5.0 - 5.14'
+    assert scanner.scan_results.stages['os_detection'].scripts == set()
+
+
+
+def test_separate_stages_probe_the_open_ports(nmap_stub, as_root):
+    nmap_stub.close_hosts('192.0.2.2')
+    scanner = scanner_module.NetworkScanner()
+    scheduler = scanner_module.ScanScheduler(scanner, merge=False)
+    scheduler.run(['192.0.2.1', '192.0.2.2'], ['port_scan', 'service_detection', 'vulnerability_scan'])
+
+    deep_runs = [args for args in nmap_stub.runs if '--top-ports' not in args]
+    assert [nmap_targets(args) for args in deep_runs] == [['192.0.2.1'], ['192.0.2.1']]
+    assert all(option(args, '-p') == 'T:22,80,U:53' for args in deep_runs)
+    assert '192.0.2.2' in scanner.scan_results.stages['vulnerability_scan'].targets
+
+
+def test_os_detection_without_root_is_skipped(nmap_stub, monkeypatch):
+    monkeypatch.setattr(os, 'geteuid', lambda: 1000)
+    scanner = scanner_module.NetworkScanner()
+    results = scanner.scan_host('192.0.2.1', ['port_scan', 'service_detection', 'os_detection'])
+
+    assert not any('-O' in args for args in nmap_stub.runs)
+    assert 'os_detection' not in results
+    info = scanner.scan_results.stages['os_detection']
+    assert info.partial and info.extra == {'skipped': 'requires root'}
+
+def test_failed_port_scan_leaves_deep_stages_unrecorded(nmap_stub, as_root):
+    nmap_stub.fail_on('--top-ports')
+    scanner = scanner_module.NetworkScanner()
+    assert scanner.port_scan('192.0.2.1') is None
+    # A host without open ports is a result, not a failure
+    nmap_stub.fail_on('--never')
+    nmap_stub.close_hosts('192.0.2.1')
+    assert [host.open_ports for host in scanner.port_scan('192.0.2.1')] == [[]]
+
+    nmap_stub.fail_on('--top-ports')
+    scanner = scanner_module.NetworkScanner()
+    assert scanner.scan_host('192.0.2.1', list(scanner_module.NetworkScanner.STAGES)) == {}
+    assert len(nmap_stub.runs) == 3 and not scanner.scan_results.stages and not scanner.deferred
+
+
+# --- discovery -> port scan -> deep scan pipeline ---------------------------
+
+def test_pipeline_deep_scans_only_hosts_with_open_ports(nmap_stub, as_root):
+    nmap_stub.close_hosts('192.0.2.3')
+    scanner = scanner_module.NetworkScanner()
+    pipeline = scanner_module.ScanPipeline(scanner, port_workers=2, deep_workers=2)
+    counts = pipeline.run('192.0.2.0/29', ['port_scan', 'service_detection', 'vulnerability_scan'])
+
+    assert counts == {'discovered': 6, 'port_scanned': 6, 'deep_scanned': 5}
+    assert len(scanner.scan_results.live_hosts) == 6
+    deep_runs = [args for args in nmap_stub.runs if '--script' in args]
+    assert sorted(target for args in deep_runs for target in nmap_targets(args)) == [
+        '192.0.2.1', '192.0.2.2', '192.0.2.4', '192.0.2.5', '192.0.2.6']
+    assert all(option(args, '-p') == 'T:22,80,U:53' for args in deep_runs)
+
+
+def test_pipeline_without_host_stages_only_discovers(nmap_stub):
+    scanner = scanner_module.NetworkScanner()
+    counts = scanner_module.ScanPipeline(scanner, port_workers=2, deep_workers=2).run('192.0.2.0/29', [])
+
+    assert counts == {'discovered': 6}
+    assert [args for args in nmap_stub.runs if '-sn' not in args] == []
+    assert set(scanner.scan_results.stages) == {'host_discovery'}
+
+
+def test_pipeline_skips_deep_scans_after_failed_port_scans(nmap_stub, as_root):
+    nmap_stub.fail_on('--top-ports')
+    scanner = scanner_module.NetworkScanner()
+    pipeline = scanner_module.ScanPipeline(scanner, port_workers=2, deep_workers=2)
+    counts = pipeline.run('192.0.2.0/30', ['port_scan', 'service_detection'])
+
+    assert counts == {'discovered': 2, 'port_scanned': 2}
+    assert set(scanner.scan_results.stages) == {'host_discovery'}
+
+
+# --- streamed nmap runs -----------------------------------------------------
+
+def test_hosts_reach_listeners_as_nmap_reports_them(nmap_stub):
+    scanner = scanner_module.NetworkScanner()
+    seen = []
+    scanner.host_listeners.append(lambda stage, host: seen.append((stage, host.address)))
+    hosts = scanner.port_scan('192.0.2.0/30', detect_services=False)
+    assert [host.address for host in hosts] == ['192.0.2.1', '192.0.2.2']
+    assert seen == [('port_scan', '192.0.2.1'), ('port_scan', '192.0.2.2')]
+    assert not scanner.scan_results.stages['port_scan'].partial
+
+
+def test_timeout_keeps_completed_hosts(nmap_stub, monkeypatch):
+    nmap_stub.hang(30)
+    monkeypatch.setitem(scanner_module.STAGE_TIMEOUTS, 'port_scan', 1)
+    scanner = scanner_module.NetworkScanner()
+    started = time.monotonic()
+    hosts = scanner.port_scan('192.0.2.0/30', detect_services=False)
+    assert time.monotonic() - started < 10
+    assert [host.address for host in hosts] == ['192.0.2.1']
+    assert scanner.scan_results.stages['port_scan'].partial
+    assert [port['port'] for port in scanner.scan_results.open_ports()] == [22, 80, 53]
+
+
+# --- asyncio scanner --------------------------------------------------------
+
+def test_async_pipeline_scans_every_live_host(nmap_stub, as_root):
+    nmap_stub.close_hosts('192.0.2.3')
+    scanner = scanner_module.AsyncNetworkScanner(concurrency=4)
+    results = asyncio.run(scanner.run_pipeline('192.0.2.0/29', ['port_scan', 'service_detection']))
+
+    assert sorted(results) == ['192.0.2.1', '192.0.2.2', '192.0.2.3', '192.0.2.4', '192.0.2.5', '192.0.2.6']
+    assert [host.address for host in results['192.0.2.1']['service_detection']] == ['192.0.2.1']
+    assert results['192.0.2.3']['service_detection'] == []
+    deep_runs = [args for args in nmap_stub.runs if '--version-all' in args]
+    assert len(deep_runs) == 5 and all(option(args, '-p') == 'T:22,80,U:53' for args in deep_runs)
+    assert len(scanner.scan_results.live_hosts) == 6
+
+
+def test_async_pipeline_without_host_stages_only_discovers(nmap_stub):
+    scanner = scanner_module.AsyncNetworkScanner(concurrency=4)
+    results = asyncio.run(scanner.run_pipeline('192.0.2.0/30', []))
+
+    assert results == {'192.0.2.1': {}, '192.0.2.2': {}}
+    assert all('-sn' in args for args in nmap_stub.runs)
+    assert set(scanner.scan_results.stages) == {'host_discovery'}
+
+
+def test_async_failed_port_scan_leaves_deep_stages_unrecorded(nmap_stub, as_root):
+    nmap_stub.fail_on('--top-ports')
+    scanner = scanner_module.AsyncNetworkScanner(concurrency=2)
+    results = asyncio.run(scanner.scan_targets(['192.0.2.1'], ['port_scan', 'service_detection']))
+    assert results == {'192.0.2.1': {}}
+    assert len(nmap_stub.runs) == 1 and not scanner.scan_results.stages
+
+
+def test_async_task_timeout_gives_up_on_slow_hosts(nmap_stub):
+    nmap_stub.hang(30)
+    scanner = scanner_module.AsyncNetworkScanner(concurrency=2, task_timeout=0.5)
+    started = time.monotonic()
+    results = asyncio.run(scanner.scan_targets(['192.0.2.1', '192.0.2.2'], ['port_scan']))
+    assert results == {'192.0.2.1': None, '192.0.2.2': None}
+    assert time.monotonic() - started < 10
+
+
+# --- sharding ---------------------------------------------------------------
+
+def test_shard_targets_balances_and_merges():
+    shards = scanner_module.shard_targets(['10.0.0.0/23', '10.0.1.0/24', '10.0.2.0/24', '10.0.3.0/24'], 4)
+    sizes = [sum(ipaddress.ip_network(block).num_addresses for block in shard) for shard in shards]
+    assert sizes == [256] * 4
+    blocks = [ipaddress.ip_network(block) for shard in shards for block in shard]
+    assert list(ipaddress.collapse_addresses(blocks)) == [ipaddress.ip_network('10.0.0.0/22')]
+
+    mixed = scanner_module.shard_targets(['192.0.2.1', '2001:db8::/126'], 8)
+    assert sorted(block for shard in mixed for block in shard) == [
+        '192.0.2.1/32', '2001:db8::/128', '2001:db8::1/128', '2001:db8::2/128', '2001:db8::3/128']
+    with pytest.raises(ValueError):
+        scanner_module.shard_targets(['host.lan'], 2)
+
+
+def test_run_sharded_scan(nmap_stub):
+    shards = scanner_module.shard_targets(['192.0.2.0/29'], 2)
+    assert len(shards) == 2
+    results = scanner_module.run_sharded_scan(shards, ['port_scan'], processes=2)
+    assert sorted(results.live_hosts) == [f'192.0.2.{last}' for last in range(8)]
+    assert len(results.open_ports()) == 8 * 3
+
+
+def test_failed_shards_mark_the_scan_partial(nmap_stub, tmp_path, monkeypatch, capsys):
+    real_scan_shard = scanner_module.scan_shard
+
+    def scan_shard(job):
+        if job['targets'][0] in ('192.0.2.4/30', '192.0.2.1/32'):
+            raise RuntimeError('worker died')
+        return real_scan_shard(job)
+
+    # Threads instead of processes, so the failing scan_shard is used
+    monkeypatch.setattr(sweep_module, 'ProcessPoolExecutor', ThreadPoolExecutor)
+    monkeypatch.setattr(sweep_module, 'scan_shard', scan_shard)
+    results = scanner_module.run_sharded_scan([['192.0.2.0/30'], ['192.0.2.4/30']], ['port_scan'])
+    assert sorted(results.live_hosts) == ['192.0.2.1', '192.0.2.2']
+    for stage in ('host_discovery', 'port_scan'):
+        assert results.stages[stage].partial
+        assert results.stages[stage].extra['failed_shards'] == ['192.0.2.4/30']
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'argv', ['nmap_network_scanner.py', '192.0.2.0/29', '--shards', '2', '--port-scan',
+                                      '-y', '--output', 'out.json'])
+    with pytest.raises(SystemExit) as exit_info:
+        scanner_module.main()
+    assert exit_info.value.code == 1
+    assert 'Shard scans failed for 192.0.2.1/32 192.0.2.3/32' in capsys.readouterr().out
+    assert scanner_module.ScanResults.load(str(tmp_path / 'out.json')).stages['port_scan'].partial
+
+
+def test_shard_queue(nmap_stub, tmp_path):
+    queue = scanner_module.ShardQueue(str(tmp_path / 'queue'))
+    names = queue.enqueue([['192.0.2.0/30'], ['192.0.2.4/30']], ['port_scan'])
+    assert queue.status() == {'pending': 2, 'claimed': 0, 'done': 0, 'failed': 0}
+
+    # A claim nobody finished goes back to pending
+    name, job = queue.claim()
+    assert name == names[0] and job['targets'] == ['192.0.2.0/30']
+    assert queue.requeue_stale(-1) == 1
+
+    assert queue.work() == 2
+    assert queue.status() == {'pending': 0, 'claimed': 0, 'done': 2, 'failed': 0}
+    assert len(queue.collect().live_hosts) == 4
+
+
+def test_shard_queue_heartbeats_and_records_failures(tmp_path, monkeypatch):
+    queue = scanner_module.ShardQueue(str(tmp_path / 'queue'))
+    queue.heartbeat_interval = 0.05
+    queue.enqueue([['192.0.2.0/30'], ['192.0.2.4/30']], ['port_scan'])
+    claimed = tmp_path / 'queue' / 'claimed'
+
+    def scan_shard(job):
+        if job['targets'] == ['192.0.2.4/30']:
+            raise RuntimeError('nmap exploded')
+        # A long shard: the heartbeat keeps its claim from going stale
+        claim, = claimed.iterdir()
+        assert '@' in claim.name
+        os.utime(claim, (0, 0))
+        time.sleep(0.3)
+        assert queue.requeue_stale(60) == 0
+        return scanner_module.ScanResults().to_dict()
+
+    monkeypatch.setattr(sweep_module, 'scan_shard', scan_shard)
+    assert queue.work() == 1
+    assert queue.status() == {'pending': 0, 'claimed': 0, 'done': 1, 'failed': 1}
+    failed, = (tmp_path / 'queue' / 'failed').iterdir()
+    assert json.loads(failed.read_text())['error'] == 'RuntimeError: nmap exploded'
+
+
+# --- TCP connect sweep ------------------------------------------------------
+
+@pytest.fixture
+def listeners():
+    """Two listening TCP ports on 127.0.0.1."""
+    sockets = []
+    for _ in range(2):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(64)
+        sockets.append(sock)
+    yield sorted(sock.getsockname()[1] for sock in sockets)
+    for sock in sockets:
+        sock.close()
+
+
+def sweep_ports(open_ports):
+    return sorted(set(open_ports) | {port + 1 for port in open_ports})
+
+
+def test_sweep_finds_local_listeners(listeners):
+    sweep = scanner_module.TCPSweep(ports=sweep_ports(listeners), concurrency=50)
+    hosts = asyncio.run(sweep.run('127.0.0.1'))
+    assert [host.address for host in hosts] == ['127.0.0.1']
+    assert sorted(port.port for port in hosts[0].open_ports) == listeners
+    assert hosts[0].reason == 'syn-ack'
+
+
+def test_sweep_backs_off_when_out_of_sockets(listeners, monkeypatch):
+    real_socket = socket.socket
+    created = []
+
+    def flaky_socket(family=-1, type=-1, proto=-1, fileno=None):
+        # Only the sweep's own sockets fail, not the event loop's socketpair()
+        if fileno is None and type == socket.SOCK_STREAM:
+            created.append(family)
+            if len(created) % 2:
+                raise OSError(errno.EMFILE, 'Too many open files')
+        return real_socket(family, type, proto, fileno)
+
+    monkeypatch.setattr(scanner_module.socket, 'socket', flaky_socket)
+    sweep = scanner_module.TCPSweep(ports=sweep_ports(listeners), concurrency=40)
+    hosts = asyncio.run(sweep.run('127.0.0.1'))
+    assert sorted(port.port for port in hosts[0].open_ports) == listeners
+    assert sweep.stats['backoffs'] > 0
+    assert sweep.min_concurrency <= sweep.effective_concurrency < 40
+
+
+def test_tcp_sweep_seeds_the_scan_stages(listeners):
+    scanner = scanner_module.NetworkScanner()
+    hosts = scanner.tcp_sweep('127.0.0.1', ports=sweep_ports(listeners), record_ports=True)
+    assert [host.address for host in hosts] == ['127.0.0.1']
+    assert scanner.scan_results.live_hosts == ['127.0.0.1']
+    assert sorted(port['port'] for port in scanner.scan_results.open_ports()) == listeners
+
+
+def test_incremental_sweep_skips_fresh_hosts(nmap_stub, listeners, tmp_path):
+    args = ('127.0.0.1', '--sweep', '--sweep-ports', ','.join(map(str, listeners)), '--all', '-y',
+            '--state-db', 'state.db', '--incremental')
+    first = run_scanner(*args, cwd=tmp_path)
+    assert first.returncode == 0, first.stdout + first.stderr
+    assert 'rescanning 1 of 1 hosts' in first.stdout and nmap_stub.runs
+    nmap_stub.log.write_text('')
+
+    second = run_scanner(*args, cwd=tmp_path)
+    assert second.returncode == 0, second.stdout + second.stderr
+    assert 'rescanning 0 of 1 hosts' in second.stdout
+    assert nmap_stub.runs == []
+
+
+def test_expand_targets():
+    assert list(scanner_module.expand_targets('192.0.2.0/30, 192.0.2.9 gw.lan')) == [
+        '192.0.2.1', '192.0.2.2', '192.0.2.9', 'gw.lan']
+    with pytest.raises(ValueError):
+        list(scanner_module.expand_targets('10.0.0.1-20'))
+
+
+# --- targets ----------------------------------------------------------------
+
+def test_exclusion_keeps_the_edges_of_carved_blocks():
+    targets, count, nmap_excludes = scanner_module.load_targets(['10.0.0.0/24'], excludes=['10.0.0.128'])
+    addresses = list(scanner_module.expand_targets(targets))
+    assert count == 255 and nmap_excludes == []
+    # Only the /24's own network and broadcast addresses are skipped
+    assert len(addresses) == 253
+    assert '10.0.0.0' not in addresses and '10.0.0.255' not in addresses and '10.0.0.128' not in addresses
+    assert {'10.0.0.127', '10.0.0.129', '10.0.0.192'} <= set(addresses)
+
+
+def test_load_targets_merges_ranges_and_passes_other_exclusions_to_nmap():
+    targets, count, nmap_excludes = scanner_module.load_targets(
+        ['10.0.0.0/25, 10.0.0.5 10.0.0.128/25', 'host.lan,10.1.0.1-20'],
+        excludes=['printer.lan host.lan'])
+    assert targets == ['10.0.0.0/24', '10.1.0.1-20']
+    assert count == 256
+    assert nmap_excludes == ['printer.lan', 'host.lan']
+
+
+def test_load_targets_reads_files(tmp_path):
+    targets_file = tmp_path / 'targets.txt'
+    targets_file.write_text('# lab\n192.0.2.0/30\n192.0.2.4\n')
+    excludes_file = tmp_path / 'excludes.txt'
+    excludes_file.write_text('192.0.2.1\n')
+    # .0 is left on its own, but it is still the /30's network address
+    targets, count, _ = scanner_module.load_targets(target_files=[str(targets_file)],
+                                                    exclude_files=[str(excludes_file)])
+    assert sorted(scanner_module.expand_targets(targets)) == ['192.0.2.2', '192.0.2.4']
+    assert count == 4
+
+
+def test_nmap_gets_the_exclusions_it_must_apply(nmap_stub):
+    scanner = scanner_module.NetworkScanner()
+    scanner.nmap_exclude = ['printer.lan', 'host.lan']
+    scanner.port_scan('192.0.2.0/30', detect_services=False)
+    assert option(nmap_stub.runs[0], '--exclude') == 'printer.lan,host.lan'
+
+
+# --- persistent scan state --------------------------------------------------
+
+@pytest.fixture
+def state_db(tmp_path):
+    db = scanner_module.ScanStateDB(str(tmp_path / 'state.db'))
+    yield db
+    db.close()
+
+
+def test_state_db_records_changes_between_runs(state_db):
+    state_db.begin_run('10.0.0.0/24', ['port_scan'])
+    for host in parse_hosts(3):
+        state_db('port_scan', host)
+    state_db.finish_run()
+    assert [change['kind'] for change in state_db.changes()] == ['host_new', 'port_opened', 'port_opened',
+                                                                 'port_opened'] * 3
+
+    hosts = parse_hosts(2)
+    hosts[0].ports = [port for port in hosts[0].ports if port.port != 80]
+    hosts[1].ports[0].version = '9.6p1'
+    hosts[1].os_matches[0].name = 'Linux 6.X'
+    state_db.begin_run('10.0.0.0/24', ['port_scan'])
+    for host in hosts:
+        state_db('port_scan', host)
+    assert state_db.mark_missing('10.0.0.0/24', ['10.0.0.0', '10.0.0.1']) == ['10.0.0.2']
+    changes = {(change['address'], change['kind'], change['detail']) for change in state_db.changes()}
+    assert changes == {('10.0.0.0', 'port_closed', '80/tcp'),
+                       ('10.0.0.1', 'service_changed', '22/tcp: OpenSSH 8.9p1 -> OpenSSH 9.6p1 Ubuntu'),
+                       ('10.0.0.1', 'os_changed', 'Linux 5.0 - 5.14 -> Linux 6.X'),
+                       ('10.0.0.2', 'host_down', '')}
+
+
+def test_state_db_only_closes_ports_the_scan_covered(state_db):
+    state_db.begin_run('10.0.0.0/24', ['port_scan'])
+    state_db('port_scan', parse_hosts(1)[0])
+    assert parse_hosts(1)[0].was_probed('udp', 67) and not parse_hosts(1)[0].was_probed('tcp', 8080)
+
+    # A follow-up scan of 22/tcp alone says nothing about 80/tcp or 53/udp
+    host = parse_hosts(1)[0]
+    host.ports = [port for port in host.ports if port.port == 22]
+    host.probed = {'tcp': ((22, 22),)}
+    state_db('port_scan', host)
+    unknown = parse_hosts(1)[0]
+    unknown.ports, unknown.probed = [], None
+    state_db('port_scan', unknown)
+    assert not any(change['kind'] == 'port_closed' for change in state_db.changes())
+
+    host.probed = {'tcp': ((1, 1000),)}
+    state_db('port_scan', host)
+    assert [change['detail'] for change in state_db.changes() if change['kind'] == 'port_closed'] == ['80/tcp']
+
+
+def test_state_db_picks_hosts_and_ports_for_incremental_scans(state_db):
+    state_db.begin_run('10.0.0.0/24', ['port_scan'])
+    hosts = parse_hosts(2)
+    for host in hosts:
+        state_db('port_scan', host)
+    state_db('deep_scan', hosts[0])
+    state_db._db.execute('UPDATE hosts SET last_scanned = ?, changed_at = ?', (state_db._ago(1), state_db._ago(2)))
+    # 10.0.0.1 changes after its last port scan, 10.0.0.9 was never seen
+    changed = parse_hosts(2)[1]
+    changed.mac = '00:11:22:33:44:55'
+    state_db('host_discovery', changed)
+
+    assert state_db.hosts_to_rescan(['10.0.0.0', '10.0.0.1', '10.0.0.9'], max_age_hours=24) == ['10.0.0.1', '10.0.0.9']
+    assert len(state_db.hosts_to_rescan(['10.0.0.0'], max_age_hours=-1)) == 1
+    assert state_db.ports_needing_deep_scan('10.0.0.0', hosts[0].open_ports, max_age_hours=24) == []
+    assert [port.label for port in state_db.ports_needing_deep_scan('10.0.0.1', hosts[1].open_ports, 24)] == [
+        '22/tcp', '80/tcp', '53/udp']
+
+
+# --- adaptive timing --------------------------------------------------------
+
+def measured_host(address, srtt, rttvar, status='up'):
+    host = scanner_module.HostRecord(address)
+    host.status = status
+    host.times = {'srtt': srtt, 'rttvar': rttvar}
+    return host
+
+
+def test_timing_budgets_follow_measured_rtt():
+    timing = scanner_module.TimingController()
+    timing('host_discovery', measured_host('10.0.0.1', 800, 400))
+    timing('host_discovery', measured_host('10.9.0.1', 250000, 50000))
+    timing('host_discovery', measured_host('10.8.0.1', 800, 400, status='down'))
+
+    assert timing.budget('10.0.0.1', ['port_scan']) == 60
+    assert timing.budget('10.9.0.1', ['port_scan']) == 255
+    assert timing.budget('10.9.0.1', ['port_scan'], 'comprehensive') == 2036
+    # Unmeasured hosts borrow their /24's RTT, or fall back to the defaults
+    assert timing.profile('10.0.0.7').source == 'subnet'
+    assert timing.profile('10.8.0.1').source == 'default'
+    assert timing.budget('10.8.0.1', ['port_scan', 'os_detection']) == 364
+
+    args = timing.nmap_args('10.0.0.1', 60)
+    assert option(args, '--max-retries') == '3' and option(args, '--host-timeout') == '60s'
+    assert option(args, '--min-rate') == '1000'
+    assert '--min-rate' not in timing.nmap_args('10.0.0.1', 60, 'stealth')
+    assert '--min-rate' not in timing.nmap_args('10.8.0.1', 60)
+
+
+def test_adaptive_timing_sets_per_host_options(nmap_stub, as_root):
+    scanner = scanner_module.NetworkScanner()
+    scanner.timing = scanner_module.TimingController()
+    scanner.host_listeners.append(scanner.timing)
+    scanner_module.ScanPipeline(scanner, port_workers=2, deep_workers=2).run('192.0.2.0/30', ['port_scan'])
+
+    discovery, *port_scans = nmap_stub.runs
+    assert '--host-timeout' not in discovery
+    assert sorted(nmap_targets(args)[0] for args in port_scans) == ['192.0.2.1', '192.0.2.2']
+    assert all(option(args, '--initial-rtt-timeout') == '50ms' for args in port_scans)
+    assert sorted(scanner.timing.timings) == ['192.0.2.1', '192.0.2.2']
+    runs = scanner.timing.timings['192.0.2.1']['runs']
+    assert [(run['stages'], run['status']) for run in runs] == [(['port_scan'], 'ok')]
+
+
+
+@pytest.mark.parametrize('args, message', [
+    (['--budget-scale', '2'], '--budget-scale requires --adaptive-timing'),
+    (['--adaptive-timing', '--budget-scale', '0'], '--budget-scale must be greater than 0'),
+])
+def test_budget_scale_needs_adaptive_timing(tmp_path, args, message):
+    result = run_scanner('192.0.2.1', *args, cwd=tmp_path)
+    assert result.returncode == 2 and message in result.stderr
+
+
+# --- host-keyed results -----------------------------------------------------
+
+def test_scan_results_merge_stages_per_host():
+    results = scanner_module.ScanResults()
+    discovered = scanner_module.HostRecord('10.0.0.0')
+    discovered.status = 'up'
+    results.add('host_discovery', '10.0.0.0/30', [discovered])
+    results.add('port_scan', '10.0.0.0', parse_hosts(1), scan_type='quick')
+    results.add('vulnerability_scan', '10.0.0.0', parse_hosts(1), script_filter=lambda script: script == 'vulners')
+
+    assert list(results.hosts) == ['10.0.0.0'] and len(results.hosts['10.0.0.0'].ports) == 4
+    assert results.host_stages('10.0.0.0') == ['host_discovery', 'port_scan', 'vulnerability_scan']
+    assert results.live_hosts == ['10.0.0.0']
+    assert len(results.open_ports()) == 3
+    assert [finding['script'] for finding in results.vulnerable()] == ['vulners']
+    assert results.stages['port_scan'].extra == {'scan_type': 'quick'}
+
+
+def test_scan_results_round_trip(tmp_path):
+    results = results_from(parse_hosts(3))
+    results.add('port_scan', '10.0.1.0', [], partial=True)
+    data = results.to_dict()
+    assert data['summary'] == {'live_hosts': 3, 'open_ports': 9, 'vulnerable': 0}
+    assert data['stages']['port_scan']['partial'] and data['stages']['port_scan']['targets'] == ['10.0.0.0/24', '10.0.1.0']
+
+    path = tmp_path / 'scan.json.gz'
+    with gzip.open(path, 'wt') as f:
+        json.dump(data, f)
+    loaded = scanner_module.ScanResults.load(str(path))
+    assert loaded.to_dict() == data
+    assert loaded.hosts['10.0.0.2'].ports[0].product == 'OpenSSH'
+
+
+def test_scan_results_update():
+    merged = results_from(parse_hosts(2))
+    merged.update(results_from(parse_hosts(4)[2:], target='10.0.1.0/24'))
+    assert sorted(merged.hosts) == ['10.0.0.0', '10.0.0.1', '10.0.0.2', '10.0.0.3']
+    assert list(merged.stages['port_scan'].targets) == ['10.0.0.0/24', '10.0.1.0/24']
+
+
+def test_scan_results_can_be_read_while_stages_record():
+    results = scanner_module.ScanResults()
+    hosts = parse_hosts(2000)
+
+    def record():
+        for host in hosts:
+            results.add('port_scan', host.address, [host])
+            results.add('vulnerability_scan', host.address, [host])
+
+    # Switch threads often so the readers and add() interleave
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    writer = threading.Thread(target=record)
+    writer.start()
+    try:
+        while writer.is_alive():
+            results.to_dict()
+            results.live_hosts, results.open_ports(), results.vulnerable()
+    finally:
+        writer.join()
+        sys.setswitchinterval(interval)
+    assert len(results.open_ports()) == 3 * 2000
+
+
+# --- deep-scan cache --------------------------------------------------------
+
+def test_cache_skips_deep_scans_of_unchanged_hosts(nmap_stub, as_root, tmp_path):
+    cache = scanner_module.ScanCache(str(tmp_path / 'cache.db'))
+    stages = ['port_scan', 'service_detection', 'os_detection']
+    for _ in range(2):
+        scanner = scanner_module.NetworkScanner()
+        scanner.cache = cache
+        scanner.scan_host('192.0.2.1', stages)
+        assert scanner.scan_results.hosts['192.0.2.1'].os_matches[0].name == 'Linux 5.0 - 5.14'
+
+    assert [('-sV' in args) for args in nmap_stub.runs] == [False, True, False]
+    assert (cache.stats['misses'], cache.stats['stored'], cache.stats['hits']) == (1, 1, 1)
+    # Other open ports are a different fingerprint
+    open_ports = parse_hosts(1)[0].open_ports
+    assert scanner._cache_key('192.0.2.1', ['-sV'], open_ports) != scanner._cache_key('192.0.2.1', ['-sV'], open_ports[:1])
+
+
+def test_cache_entries_expire(tmp_path):
+    cache = scanner_module.ScanCache(str(tmp_path / 'cache.db'), ttl_hours=1)
+    cache.put('fresh', '10.0.0.0', parse_hosts(1))
+    cache.put('stale', '10.0.0.0', parse_hosts(1))
+    with cache._db:
+        cache._db.execute("UPDATE cache SET created = created - 7200 WHERE key = 'stale'")
+    assert cache.get('stale') is None
+    assert [host.address for host in cache.get('fresh')] == ['10.0.0.0']
+    assert cache.evict() == 1
+    cache.close()
+
+
+# --- metrics ----------------------------------------------------------------
+
+def finished_run(hosts, ports_per_host=1000, timed_out=False):
+    run = scanner_module.NmapRun()
+    run.hosts = hosts
+    run.scan_info = [{'type': 'syn', 'protocol': 'tcp', 'numservices': str(ports_per_host)}]
+    run.timed_out = timed_out
+    return run
+
+
+def test_metrics_account_for_every_run():
+    metrics = scanner_module.ScanMetrics()
+    hosts = parse_hosts(3)
+    metrics.record_run('port_scan', finished_run(hosts), elapsed=2.0)
+    for host, elapsed in zip(hosts, (1.0, 3.0, 8.0)):
+        metrics.record_run('service_detection', finished_run([host]), elapsed=elapsed)
+    metrics.record_run('service_detection', finished_run([hosts[0]], timed_out=True), elapsed=0.0, cached=True)
+    metrics.record_progress('service_detection', {'task': 'Service scan', 'percent': '42.5', 'remaining': '30'})
+    for delta in (1, 1, -1):
+        metrics.adjust_gauge('queue_depth', 'deep_scan', delta)
+
+    snapshot = metrics.to_dict()
+    port_scan, deep = snapshot['stages']['port_scan'], snapshot['stages']['service_detection']
+    assert (port_scan['runs'], port_scan['hosts_up'], port_scan['ports_probed']) == (1, 3, 3000)
+    assert (deep['runs'], deep['cached'], deep['partial'], deep['busy_s']) == (4, 1, 1, 12.0)
+    # Cached runs don't count towards the per-host durations
+    assert deep['host_seconds'] == {'p50': 3.0, 'p90': 8.0, 'p100': 8.0}
+    assert snapshot['progress']['service_detection']['remaining_s'] == 30
+    assert snapshot['gauges']['queue_depth:deep_scan'] == 1 and snapshot['peaks']['queue_depth:deep_scan'] == 2
+
+    text = metrics.to_prometheus()
+    assert '# TYPE nmap_scanner_stage_runs_total counter' in text
+    assert 'nmap_scanner_stage_runs_total{stage="service_detection"} 4' in text
+    assert 'nmap_scanner_host_stage_seconds{stage="service_detection",quantile="0.5"} 3.0' in text
+    assert 'nmap_scanner_host_stage_seconds_count{stage="service_detection"} 3' in text
+    assert 'nmap_scanner_queue_depth_max{queue="deep_scan"} 2' in text
+
+
+def test_runs_without_a_stage_are_labelled_nmap():
+    metrics = scanner_module.ScanMetrics()
+    metrics.record_run(None, finished_run(parse_hosts(1)), elapsed=1.5)
+    assert metrics.to_dict()['host_durations'] == {'10.0.0.0': {'nmap': 1.5}}
+    assert 'stage="None"' not in metrics.to_prometheus()
+
+
+def test_pipeline_publishes_metrics(nmap_stub, as_root, tmp_path):
+    scanner = scanner_module.NetworkScanner()
+    path = tmp_path / 'scan.prom'
+    exporter = scanner_module.PrometheusExporter(scanner.metrics, str(path), interval=3600).start()
+    scanner_module.ScanPipeline(scanner, port_workers=2, deep_workers=2).run(
+        '192.0.2.0/29', ['port_scan', 'service_detection'])
+    exporter.close()
+
+    stages = scanner.metrics.to_dict()['stages']
+    assert stages['host_discovery']['hosts_up'] == 6
+    assert stages['port_scan']['runs'] == 6 and stages['deep_scan']['runs'] == 6
+    assert sorted(scanner.metrics.host_durations) == [f'192.0.2.{last}' for last in range(1, 7)]
+    text = path.read_text()
+    assert 'nmap_scanner_stage_runs_total{stage="port_scan"} 6' in text
+    assert 'nmap_scanner_queue_depth{queue="deep_scan"} 0' in text
+    assert not list(tmp_path.glob('*.tmp'))
+
+
+# --- result streams ---------------------------------------------------------
+
+@pytest.mark.parametrize('name', ['scan.ndjson', 'scan.ndjson.gz'])
+def test_stream_rebuilds_the_results(nmap_stub, as_root, tmp_path, name):
+    path = str(tmp_path / name)
+    scanner = scanner_module.NetworkScanner()
+    writer = scanner_module.ResultStreamWriter(path, fsync_every=2)
+    scanner.result_listeners.append(writer)
+    scanner.scan_host('192.0.2.1', list(scanner_module.NetworkScanner.STAGES))
+    writer.close(scanner.scan_results)
+
+    loaded = scanner_module.ScanResults.load(path)
+    assert loaded.complete
+    expected = scanner.scan_results.to_dict()
+    assert loaded.to_dict()['hosts'] == expected['hosts']
+    assert loaded.to_dict()['stages'] == expected['stages']
+    assert [finding['script'] for finding in loaded.findings()] == ['vulners']
+
+
+def test_truncated_stream_keeps_complete_records(tmp_path):
+    path = tmp_path / 'scan.ndjson'
+    writer = scanner_module.ResultStreamWriter(str(path))
+    writer.dump(results_from(parse_hosts(3)))
+    writer.close(complete=False)
+    # A crash in the middle of a write leaves half a line behind
+    with open(path, 'a') as f:
+        f.write('{"type":"host","stage":"port_sc')
+
+    records = list(scanner_module.read_result_stream(str(path)))
+    assert records[0]['type'] == 'header' and records[-1] == {'type': 'truncated'}
+    loaded = scanner_module.ScanResults.from_stream(records)
+    assert not loaded.complete
+    assert sorted(loaded.hosts) == ['10.0.0.0', '10.0.0.1', '10.0.0.2']
+    assert len(loaded.open_ports()) == 9
+
+
+# --- diffs ------------------------------------------------------------------
+
+def test_diff_results():
+    old = results_from(parse_hosts(4))
+    new_hosts = parse_hosts(5)
+    new_hosts[0].ports = [port for port in new_hosts[0].ports if port.port != 80]
+    new_hosts[1].ports[0].version = '9.6p1'
+    new_hosts[2].os_matches[0].name = 'Linux 6.X'
+    del new_hosts[3]
+    new = results_from(new_hosts)
+
+    changes = {(change['address'], change['kind']) for change in scanner_module.diff_results(old, new)}
+    assert changes == {('10.0.0.0', 'port_closed'), ('10.0.0.1', 'service_changed'), ('10.0.0.2', 'os_changed'),
+                       ('10.0.0.3', 'host_down'), ('10.0.0.4', 'host_new')}
+    assert scanner_module.diff_results(old, results_from(parse_hosts(4))) == []
+
+
+def test_diff_ignores_hosts_outside_the_new_scan():
+    old = results_from(parse_hosts(4))
+    new = results_from(parse_hosts(2), target='10.0.0.0/31')
+    assert scanner_module.diff_results(old, new) == []
+
+
+
+def test_diff_command_writes_a_change_report(tmp_path, monkeypatch, capsys):
+    old, new = tmp_path / 'old.json', tmp_path / 'new.json'
+    old.write_text(json.dumps(results_from(parse_hosts(2)).to_dict()))
+    new.write_text(json.dumps(results_from(parse_hosts(3)).to_dict()))
+    monkeypatch.setattr(sys, 'argv', ['nmap_network_scanner.py', '--diff', str(old), str(new),
+                                      '--output', str(tmp_path / 'changes.json')])
+    scanner_module.main()
+    assert '10.0.0.2' in capsys.readouterr().out
+    report = json.loads((tmp_path / 'changes.json').read_text())
+    assert [(change['address'], change['kind']) for change in report['changes']] == [('10.0.0.2', 'host_new')]
+
+
+# --- priorities and time budgets --------------------------------------------
+
+def test_prioritizer_orders_by_inventory_and_history(tmp_path, state_db):
+    inventory = tmp_path / 'inventory.txt'
+    inventory.write_text('# site\n10.0.5.0/24 critical dmz\nprinter.lan LOW\n10.0.0.2 high\n')
+    entries = scanner_module.load_inventory(str(inventory))
+    assert entries[1] == ('printer.lan', ['low'])
+
+    addresses = ['10.0.0.1', 'printer.lan', '10.0.0.0', '10.0.0.2', '10.0.5.7']
+    ordered, scores = scanner_module.HostPrioritizer(entries).order(addresses)
+    assert ordered == ['10.0.5.7', '10.0.0.2', '10.0.0.1', '10.0.0.0', 'printer.lan']
+    assert scores['10.0.5.7'] == (100, ['critical', 'dmz'])
+
+    # A previous run saw 10.0.0.0 with open ports and left 10.0.0.1 deferred
+    state_db.begin_run('10.0.0.0/24', ['port_scan'])
+    for host in parse_hosts(2):
+        state_db('port_scan', host)
+    state_db.update_deferred(['10.0.0.0'], {'10.0.0.1': ['vulnerability_scan']})
+    state_db._db.execute('UPDATE hosts SET first_seen = ?', (state_db._ago(1),))
+    state_db.begin_run('10.0.0.0/24', ['port_scan'])
+
+    ordered, scores = scanner_module.HostPrioritizer(entries, state_db).order(addresses)
+    assert ordered == ['10.0.5.7', '10.0.0.1', '10.0.0.2', '10.0.0.0', 'printer.lan']
+    assert scores['10.0.0.1'] == (80, ['3 known open ports', 'changed recently', 'deferred last run'])
+    assert scores['10.0.0.2'] == (60, ['high', 'new host'])
+    assert state_db.hosts_to_rescan(['10.0.0.0', '10.0.0.1'], max_age_hours=24) == ['10.0.0.1']
+
+
+def test_hosts_past_the_deadline_are_deferred(nmap_stub):
+    scanner = scanner_module.NetworkScanner()
+    scanner.deadline = time.monotonic() - 1
+    hosts = ['192.0.2.1', '192.0.2.2']
+    scanner_module.ScanScheduler(scanner, max_workers=2).run(hosts, ['port_scan', 'os_detection'])
+    assert nmap_stub.runs == []
+    assert scanner.deferred == {host: ['port_scan', 'os_detection'] for host in hosts}
+
+
+def test_runs_are_cut_off_at_the_deadline(nmap_stub, as_root):
+    nmap_stub.hang(30)
+    scanner = scanner_module.NetworkScanner()
+    scanner.deadline = time.monotonic() + 1
+    started = time.monotonic()
+    scanner.scan_host('192.0.2.1', ['port_scan', 'service_detection'])
+    assert time.monotonic() - started < 10
+    assert len(nmap_stub.runs) == 1
+    assert scanner.deferred == {'192.0.2.1': ['port_scan', 'service_detection']}
+
+
+def test_window_closing_while_queued_defers_instead_of_running(nmap_stub, as_root, capsys):
+    scanner = scanner_module.NetworkScanner()
+    scanner.deadline = time.monotonic() + 0.2
+
+    @contextmanager
+    def slow_guard(stages):
+        # e.g. waiting for a --stage-limit slot
+        time.sleep(0.3)
+        yield
+
+    scanner.scan_host('192.0.2.1', ['port_scan', 'service_detection'], stage_guard=slow_guard)
+    # nmap is not even started with a zero timeout
+    assert 'Command: nmap' not in capsys.readouterr().out
+    assert scanner.deferred == {'192.0.2.1': ['port_scan', 'service_detection']}
+    assert not scanner.scan_results.stages
+
+
+# --- local networks ---------------------------------------------------------
+
+def test_local_networks_prefer_the_default_route(monkeypatch):
+    network = scanner_module.LocalNetwork
+    found = [
+        network('lo', '127.0.0.1', ipaddress.ip_network('127.0.0.0/8')),
+        network('wlan0', 'fe80::1', ipaddress.ip_network('fe80::/64')),
+        network('docker0', '172.17.0.1', ipaddress.ip_network('172.17.0.0/16')),
+        network('eth0', '2001:db8::5', ipaddress.ip_network('2001:db8::/64')),
+        network('eth0', '10.20.30.5', ipaddress.ip_network('10.20.28.0/22')),
+        network('eth0', '10.20.30.6', ipaddress.ip_network('10.20.28.0/22')),
+    ]
+    calls = []
+    monkeypatch.setattr(scanner_module, '_local_networks', None)
+    monkeypatch.setattr(scanner_module, '_psutil_networks', lambda: calls.append(1) or list(found))
+    monkeypatch.setattr(scanner_module, '_default_route_interfaces', lambda: {'eth0'})
+
+    networks = scanner_module.local_networks(refresh=True)
+    assert [(entry.interface, str(entry.network), entry.default) for entry in networks] == [
+        ('eth0', '10.20.28.0/22', True), ('eth0', '2001:db8::/64', True), ('docker0', '172.17.0.0/16', False)]
+    scanner_module.local_networks()
+    assert len(calls) == 1
+    # The real netmask of the default interface, not a guessed /24
+    assert scanner_module.NetworkScanner().get_local_network_info() == '10.20.28.0/22'
+
+
+def test_local_networks_fall_back_to_proc(monkeypatch):
+    monkeypatch.setattr(scanner_module, '_local_networks', None)
+    monkeypatch.setattr(scanner_module, '_psutil_networks', lambda: None)
+    monkeypatch.setattr(scanner_module, '_proc_networks', lambda: [
+        scanner_module.LocalNetwork('eth0', '192.0.2.10', ipaddress.ip_network('192.0.2.0/28'))])
+    monkeypatch.setattr(scanner_module, '_default_route_interfaces', lambda: set())
+    assert [str(entry.network) for entry in scanner_module.local_networks(refresh=True)] == ['192.0.2.0/28']
+    monkeypatch.setattr(scanner_module, '_proc_networks', lambda: [])
+    scanner_module.local_networks(refresh=True)
+    assert scanner_module.NetworkScanner().get_local_network_info() == '192.168.1.0/24'
+
+
+# --- reverse DNS ------------------------------------------------------------
+
+class StubNameserver:
+    """
+    UDP nameserver on 127.0.0.1 answering PTR queries with host-N.lab.example;
+    NXDOMAIN for addresses ending in .13, no answer at all for .99. Queries
+    for .66 first get an answer with the same id but someone else's question.
+    """
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.address = self.sock.getsockname()
+        self.queries = []
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                data, client = self.sock.recvfrom(512)
+            except OSError:
+                return
+            question = data[12:data.index(b'\0', 12) + 5]
+            labels, offset = [], 0
+            while question[offset]:
+                labels.append(question[offset + 1:offset + 1 + question[offset]].decode())
+                offset += 1 + question[offset]
+            address = '.'.join(reversed(labels[:4]))
+            self.queries.append(address)
+            last = labels[0]
+            if last == '99':
+                continue
+            if last == '13':
+                self.sock.sendto(data[:2] + struct.pack('>HHHHH', 0x8183, 1, 0, 0, 0) + question, client)
+                continue
+            if last == '66':
+                forged = question.replace(b'\x0266', b'\x0267', 1)
+                self.sock.sendto(data[:2] + struct.pack('>HHHHH', 0x8180, 1, 1, 0, 0) + forged +
+                                 self._answer('forged.example'), client)
+            self.sock.sendto(data[:2] + struct.pack('>HHHHH', 0x8180, 1, 1, 0, 0) + question +
+                             self._answer(f'host-{last}.lab.example'), client)
+
+    @staticmethod
+    def _answer(name):
+        rdata = b''.join(bytes([len(label)]) + label.encode() for label in name.split('.')) + b'\0'
+        return b'\xc0\x0c' + struct.pack('>HHIH', 12, 1, 300, len(rdata)) + rdata
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def nameserver():
+    server = StubNameserver()
+    yield server
+    server.close()
+
+
+def test_ptr_resolver(nameserver):
+    resolver = scanner_module.PTRResolver([nameserver.address], timeout=0.2, retries=1)
+
+    async def lookups():
+        try:
+            first = await resolver.resolve_many(['192.0.2.7', '192.0.2.13', '192.0.2.99', '192.0.2.7', '192.0.2.66'])
+            second = await resolver.resolve_many(['192.0.2.7', '192.0.2.13'])
+            return first, second
+        finally:
+            resolver.close()
+
+    first, second = asyncio.run(lookups())
+    # The answer to a question that was not asked is ignored
+    assert first == {'192.0.2.7': 'host-7.lab.example', '192.0.2.13': None, '192.0.2.99': None,
+                     '192.0.2.66': 'host-66.lab.example'}
+    assert second == {'192.0.2.7': 'host-7.lab.example', '192.0.2.13': None}
+    # Answers (NXDOMAIN included) come from the cache the second time; the
+    # dropped query was sent once and retried once
+    assert sorted(nameserver.queries) == ['192.0.2.13', '192.0.2.66', '192.0.2.7', '192.0.2.99', '192.0.2.99']
+    assert resolver.stats['resolved'] == 2 and resolver.stats['no_name'] == 1 and resolver.stats['failed'] == 1
+    assert resolver.stats['cached'] == 2
+
+
+def test_dns_cache_expiry(tmp_path):
+    cache = scanner_module.DNSCache(str(tmp_path / 'rdns.db'), negative_ttl=0)
+    cache.put('192.0.2.1', 'a.example', ttl=300)
+    cache.put('192.0.2.2', None)
+    assert cache.get('192.0.2.1') == (True, 'a.example')
+    assert cache.get('192.0.2.2') == (False, None)
+    cache.close()
+
+
+def test_parse_dns_server():
+    assert scanner_module.parse_dns_server('192.0.2.53') == ('192.0.2.53', 53)
+    assert scanner_module.parse_dns_server('127.0.0.1:5353') == ('127.0.0.1', 5353)
+    assert scanner_module.parse_dns_server('[::1]:5353') == ('::1', 5353)
+
+
+def test_names_are_resolved_while_nmap_scans(nmap_stub, nameserver):
+    scanner = scanner_module.NetworkScanner()
+    scanner.nmap_dns = False
+    resolver = scanner_module.PTRResolver([nameserver.address], timeout=0.2, retries=0)
+    enricher = scanner_module.HostnameEnricher(resolver)
+    scanner.host_listeners.append(enricher)
+    renamed = []
+    try:
+        scanner.basic_host_discovery('192.0.2.12/30')
+        names = enricher.finish(scanner.scan_results, [lambda stage, host: renamed.append((stage, host.address))])
+    finally:
+        enricher.close()
+
+    assert nmap_stub.runs[0][:2] == ['-n', '-sn']
+    assert names == {'192.0.2.14': 'host-14.lab.example'}
+    assert scanner.scan_results.hosts['192.0.2.14'].hostname == 'host-14.lab.example'
+    assert scanner.scan_results.hosts['192.0.2.13'].hostname is None
+    assert renamed == [('rdns', '192.0.2.14')]
+
+
+# --- query index ------------------------------------------------------------
+
+@pytest.fixture
+def index():
+    hosts = parse_hosts(6)
+    hosts[1].ports[0].version = '7.4p1'
+    hosts[2].ports[0].product = 'Dropbear sshd'
+    hosts[3].os_matches = []
+    index = scanner_module.ResultIndex()
+    index.add(results_from(hosts), 'scan.json')
+    yield index
+    index.close()
+
+
+def addresses(matches):
+    return sorted({match['address'] for match in matches})
+
+
+def test_index_queries(index):
+    assert index.stats() == {'sources': 1, 'hosts': 6, 'ports': 24}
+    assert addresses(index.query(product='openssh', version=('<', '8.0'))) == ['10.0.0.1']
+    assert addresses(index.query(product='OpenSSH', version=('>=', '8.0'))) == ['10.0.0.0', '10.0.0.3',
+                                                                               '10.0.0.4', '10.0.0.5']
+    assert addresses(index.query(product='drop*')) == ['10.0.0.2']
+    assert addresses(index.query(net=ipaddress.ip_network('10.0.0.4/31'))) == ['10.0.0.4', '10.0.0.5']
+    assert addresses(index.query(os_family='linux')) == ['10.0.0.0', '10.0.0.1', '10.0.0.2', '10.0.0.4', '10.0.0.5']
+    assert index.query(port=443) == []
+    assert len(index.query(port=443, state='filtered')) == 6
+    assert len(index.query(limit=2)) == 2
+
+
+def test_index_parses_cli_queries(index):
+    filters = scanner_module.parse_query('port=22/53 protocol=udp net=10.0.0.0/30')
+    matches = index.query(**filters)
+    assert {(match['address'], match['port']) for match in matches} == {
+        (f'10.0.0.{last}', 53) for last in range(4)}
+
+
+def test_index_replaces_rescanned_hosts(index):
+    hosts = parse_hosts(1)
+    hosts[0].ports = hosts[0].ports[:1]
+    index.add(results_from(hosts), 'rescan.json')
+    assert index.stats()['hosts'] == 6
+    assert [match['port'] for match in index.query(address='10.0.0.0', port=[22, 80])] == [22]
+
+
+# --- checkpoints and --resume -----------------------------------------------
+
+def test_load_checkpoint(tmp_path):
+    path = tmp_path / 'scan.ndjson'
+    hosts = parse_hosts(4)
+    # A scan killed during its third port scan: no end record, a line cut off mid-write
+    writer = scanner_module.ResultStreamWriter(str(path), fsync_every=1)
+    writer('host_discovery', '10.0.0.0/29', hosts, {'partial': False})
+    for index, host in enumerate(hosts):
+        partial = index >= 2
+        writer('port_scan', host.address, [host], {'partial': partial}, partial=partial)
+    with open(path, 'a') as f:
+        f.write('{"type": "host", "stage": "port_sc')
+
+    results, completed = scanner_module.load_checkpoint(str(path))
+    assert not results.complete
+    assert sorted(results.hosts) == ['10.0.0.0', '10.0.0.1', '10.0.0.2', '10.0.0.3']
+    assert completed == {('10.0.0.0/29', 'host_discovery'), ('10.0.0.0', 'port_scan'), ('10.0.0.1', 'port_scan')}
+    assert results.stages['port_scan'].partial
+
+
+def test_checkpoint_counts_only_stages_that_ran(nmap_stub, as_root, tmp_path):
+    nmap_stub.close_hosts('192.0.2.2')
+    path = str(tmp_path / 'scan.ndjson')
+    scanner = scanner_module.NetworkScanner()
+    writer = scanner_module.ResultStreamWriter(path)
+    scanner.result_listeners.append(writer)
+    for host in ('192.0.2.1', '192.0.2.2'):
+        scanner.scan_host(host, ['port_scan', 'service_detection'])
+    writer.close(scanner.scan_results)
+
+    # No open ports: service detection was recorded as empty, but never ran
+    results, completed = scanner_module.load_checkpoint(path)
+    assert completed == {('192.0.2.1', 'port_scan'), ('192.0.2.1', 'service_detection'), ('192.0.2.2', 'port_scan')}
+    assert '192.0.2.2' in results.stages['service_detection'].targets
+
+
+def run_scanner(*args, cwd):
+    return subprocess.run([sys.executable, scanner_module.__file__, *args], cwd=cwd, stdin=subprocess.DEVNULL,
+                          capture_output=True, text=True, timeout=120)
+
+
+def interrupt_scanner(*args, cwd, stream, until):
+    """Run the scanner and press Ctrl+C once its stream contains the text `until`."""
+    with open(cwd / 'interrupted.log', 'w') as log:
+        process = subprocess.Popen([sys.executable, scanner_module.__file__, *args], cwd=cwd,
+                                   stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            deadline = time.monotonic() + 60
+            while not (stream.exists() and until in stream.read_text()):
+                assert process.poll() is None and time.monotonic() < deadline, (cwd / 'interrupted.log').read_text()
+                time.sleep(0.05)
+            process.send_signal(signal.SIGINT)
+            assert process.wait(timeout=60) == 0
+        finally:
+            if process.poll() is None:
+                process.kill()
+    return (cwd / 'interrupted.log').read_text()
+
+
+def test_interrupted_scan_is_not_marked_complete(nmap_stub, tmp_path):
+    nmap_stub.hang(0.3)
+    stream = tmp_path / 'scan.ndjson'
+    output = interrupt_scanner('192.0.2.0/29', '--all', '-y', '--stream', str(stream), '--fsync-every', '1',
+                               cwd=tmp_path, stream=stream, until='"stage":"host_discovery"')
+    assert 'Scan interrupted by user' in output
+
+    records = list(scanner_module.read_result_stream(str(stream)))
+    assert records[-1]['type'] == 'stopped'
+    assert not any(record['type'] == 'end' for record in records)
+    assert not scanner_module.ScanResults.load(str(stream)).complete
+
+
+def test_resume_skips_finished_hosts(nmap_stub, tmp_path):
+    nmap_stub.hang(0.3)
+    stream = tmp_path / 'scan.ndjson'
+    interrupt_scanner('192.0.2.0/29', '--all', '-y', '--resume', str(stream), '--fsync-every', '1',
+                      cwd=tmp_path, stream=stream, until='"stage":"vulnerability_scan","target":["192.0.2.2"]')
+    _, completed = scanner_module.load_checkpoint(str(stream))
+    stages = scanner_module.NetworkScanner.STAGES
+    done = sorted({host for host, stage in completed if all((host, other) in completed for other in stages)})
+    assert '192.0.2.2' in done and len(done) < 6
+    nmap_stub.hang(0)
+    nmap_stub.log.write_text('')
+
+    second = run_scanner('192.0.2.0/29', '--all', '-y', '--resume', str(stream), '--output', 'out.json', cwd=tmp_path)
+    assert second.returncode == 0, second.stdout + second.stderr
+    assert f'Resuming: {len(done)} of 6 hosts already done' in second.stdout
+
+    runs = nmap_stub.runs
+    assert not any('-sn' in args for args in runs)
+    scanned = {target for args in runs for target in nmap_targets(args)}
+    assert scanned == {f'192.0.2.{last}' for last in range(1, 7)} - set(done)
+    results = scanner_module.ScanResults.load(str(tmp_path / 'out.json'))
+    assert len(results.hosts_in('vulnerability_scan')) == 6
+    assert scanner_module.ScanResults.load(str(stream)).complete
+
+
+def test_resume_rejects_other_stream(tmp_path):
+    result = run_scanner('192.0.2.1', '--resume', 'a.ndjson', '--stream', 'b.ndjson', cwd=tmp_path)
+    assert result.returncode == 2
+    assert '--resume FILE already streams results' in result.stderr